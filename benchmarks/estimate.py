@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmark the CCF and chi-squared initial estimators in Model.estimate. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import argparse
+from time import time
+
+import numpy as np
+
+import sick.models
+from sick.specutils import Spectrum1D
+
+
+def synthesise(model, channel, index, z=1e-4, snr=50, seed=None):
+    """
+    Create a noisy, redshifted spectrum from a point in the model grid, with
+    a linear continuum.
+    """
+
+    i = list(model.channel_names).index(channel)
+    si = sum(model.meta["channel_sizes"][:i])
+    wavelengths = model.wavelengths[si:si + model.meta["channel_sizes"][i]]
+
+    flux = np.array(model._intensities()[index, si:si + wavelengths.size],
+        dtype=float)
+
+    # Observe it with a coarser sampling, inside the model wavelength range.
+    disp = np.linspace(wavelengths[0] * (1 + 2*z), wavelengths[-1] * (1 - 2*z),
+        wavelengths.size // 2)
+    continuum = 1 + 0.1 * (disp - disp.mean())/np.ptp(disp)
+    flux = np.interp(disp/(1 + z), wavelengths, flux) * continuum
+
+    random = np.random.RandomState(seed)
+    sigma = np.nanmedian(flux)/snr
+    flux += random.normal(0, sigma, size=flux.size)
+    return Spectrum1D(disp, flux, sigma**2 * np.ones(disp.size))
+
+
+def benchmark(model, spectra, truths, methods=("ccf", "chisq")):
+
+    results = {}
+    names = model.grid_points.dtype.names
+    for method in methods:
+        model._configuration.setdefault("settings", {})["estimate_method"] \
+            = method
+
+        t_init, recovered = time(), 0
+        for spectrum, truth in zip(spectra, truths):
+            theta = model.estimate([spectrum])
+            recovered += all(theta[name] == model.grid_points[truth][name] \
+                for name in names)
+        results[method] = ((time() - t_init)/len(spectra), recovered)
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model", help="the model filename")
+    parser.add_argument("--channel", default=None,
+        help="the model channel to observe (default: the first channel)")
+    parser.add_argument("--stars", type=int, default=20,
+        help="the number of synthetic spectra to estimate parameters for")
+    parser.add_argument("--snr", type=float, default=50,
+        help="the signal-to-noise ratio of the synthetic spectra")
+    args = parser.parse_args()
+
+    model = sick.models.Model(args.model)
+    channel = args.channel or model.channel_names[0]
+
+    random = np.random.RandomState(0)
+    truths = random.randint(0, model.grid_points.size, size=args.stars)
+    spectra = [synthesise(model, channel, index, snr=args.snr, seed=i) \
+        for i, index in enumerate(truths)]
+
+    for method, (duration, recovered) \
+    in sorted(benchmark(model, spectra, truths).items()):
+        print("{0:>5s}: {1:.3f} s per star, recovered {2}/{3} grid points"\
+            .format(method, duration, recovered, len(spectra)))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmark the scalar and vectorised ensemble samplers in Model.infer. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import argparse
+from time import time
+
+import numpy as np
+
+import sick.models
+from estimate import synthesise
+
+
+def benchmark(model, data, initial_theta, walkers=100, steps=50):
+    """
+    Return the number of ensemble steps per second and the mean acceptance
+    fraction for the scalar and the vectorised log-probability functions.
+    """
+
+    results = {}
+    for vectorised in (False, True):
+        # Start both samplers from the same walker positions.
+        np.random.seed(0)
+
+        t_init = time()
+        theta, chains, lnprobability, acceptance_fractions, sampler, metadata \
+            = model.infer(data, initial_proposal=initial_theta.copy(),
+                walkers=walkers, burn=steps, sample=steps, threads=1,
+                vectorised=vectorised, full_output=True,
+                __show_progress_bar=False)
+        results[vectorised] = (2 * steps/(time() - t_init),
+            acceptance_fractions[-1])
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model", help="the model filename")
+    parser.add_argument("--channel", default=None,
+        help="the model channel to observe (default: the first channel)")
+    parser.add_argument("--walkers", type=int, default=100,
+        help="the number of walkers in the ensemble")
+    parser.add_argument("--steps", type=int, default=50,
+        help="the number of burn-in and production steps")
+    args = parser.parse_args()
+
+    model = sick.models.Model(args.model)
+    channel = args.channel or model.channel_names[0]
+    data = [synthesise(model, channel, model.grid_points.size // 2, seed=0)]
+    initial_theta = model.estimate(data)
+
+    results = benchmark(model, data, initial_theta, walkers=args.walkers,
+        steps=args.steps)
+    for vectorised in (False, True):
+        steps_per_second, acceptance_fraction = results[vectorised]
+        print("{0:>10s}: {1:.2f} steps per second ({2:.1f}x), mean acceptance "
+            "fraction {3:.2f}".format(("scalar", "vectorised")[vectorised],
+                steps_per_second, steps_per_second/results[False][0],
+                acceptance_fraction))
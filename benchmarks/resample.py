@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmark the vectorised flux-conserving resampling matrix builder. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+from time import time
+
+import numpy as np
+
+from sick.specutils import sample
+
+
+def benchmark(old_wavelengths, new_wavelengths, repeats=3):
+
+    timings = []
+    for function in (sample._slow_resample, sample.resample):
+        t_init = time()
+        for i in range(repeats):
+            matrix = function(old_wavelengths, new_wavelengths)
+        timings.append((time() - t_init)/repeats)
+
+    # Check that both approaches give the same matrix.
+    difference = np.abs((sample._slow_resample(old_wavelengths, new_wavelengths)
+        - sample.resample(old_wavelengths, new_wavelengths)).data)
+    return timings + [np.nanmax(difference)]
+
+
+if __name__ == "__main__":
+
+    for N_old, N_new in ((4000, 2000), (20000, 10000), (40000, 20000)):
+        old_wavelengths = np.linspace(4000, 6000, N_old).astype("float32")
+        new_wavelengths = np.linspace(4100, 5900, N_new)
+
+        loop, vectorised, difference = benchmark(old_wavelengths,
+            new_wavelengths)
+        print("{0:6.0f} -> {1:6.0f} pixels: loop {2:.3f} s, vectorised {3:.4f} "
+            "s ({4:.0f}x faster; max abs. difference {5:.1e})".format(N_old,
+                N_new, loop, vectorised, loop/vectorised, difference))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmark the Gauss-Newton and curve_fit label solvers in a Cannon model. """
+
+from __future__ import division, print_function
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import argparse
+from time import time
+
+import numpy as np
+
+import sick.models
+
+
+def chi_sq(model, flux, variance, labels):
+    """ Return the chi-squared difference between the Cannon model and data. """
+
+    names = model.grid_points.dtype.names
+    row = sick.models.cannon._build_label_vector_rows(
+        model._cannon_label_vector,
+        np.array([labels[name] for name in names]) - model._cannon_offsets)
+    expected = np.dot(model._cannon_coefficients, row[0])
+    finite = np.isfinite(expected * flux * variance)
+    return np.sum((flux - expected)[finite]**2 \
+        / (model._cannon_scatter[finite]**2 + variance[finite]))
+
+
+def benchmark(model, spectra, warm_start=0):
+    """
+    Return the time per solve and the labels found by each label solver. If
+    `warm_start` is not zero then each solve starts from the first solution,
+    with the labels moved by that fraction of the range of the grid.
+    """
+
+    results = {}
+    for method in ("curve_fit", "gauss-newton"):
+        labels = []
+        t_init = time()
+        for flux, variance, initial_labels in spectra:
+            labels.append(model._solve_labels(flux, variance, method=method,
+                initial_labels=initial_labels if warm_start else None))
+        results[method] = ((time() - t_init)/len(spectra), labels)
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model", help="the (trained) Cannon model filename")
+    parser.add_argument("--stars", type=int, default=20,
+        help="the number of grid spectra to solve labels for")
+    parser.add_argument("--snr", type=float, default=50,
+        help="the signal-to-noise ratio of the spectra")
+    parser.add_argument("--warm-start", type=float, default=0.01,
+        help="the distance of the warm start from the solution, as a fraction "
+            "of the range of each grid parameter")
+    args = parser.parse_args()
+
+    model = sick.models.Model(args.model)
+    if not hasattr(model, "_cannon_coefficients"):
+        model.train_global(__progressbar=False)
+
+    names = model.grid_points.dtype.names
+    random = np.random.RandomState(0)
+    intensities = model._intensities()
+    spectra = []
+    for index in random.randint(0, model.grid_points.size, size=args.stars):
+        flux = np.array(intensities[index], dtype=float)
+        sigma = np.nanmedian(flux)/args.snr
+        flux += random.normal(0, sigma, size=flux.size)
+        spectra.append([flux, sigma**2 * np.ones(flux.size), None])
+    del intensities
+
+    results = benchmark(model, spectra)
+    for spectrum, labels in zip(spectra, results["gauss-newton"][1]):
+        spectrum[2] = dict([(name, labels[name] + args.warm_start \
+            * np.ptp(model.grid_points[name])) for name in names])
+    warm_results = benchmark(model, spectra, warm_start=args.warm_start)
+
+    print("{0} pixels, {1} label vector terms".format(
+        *model._cannon_coefficients.shape))
+    for description, result in (("cold", results), ("warm", warm_results)):
+        for method in ("curve_fit", "gauss-newton"):
+            duration, labels = result[method]
+            difference = [chi_sq(model, spectrum[0], spectrum[1], l) \
+                - chi_sq(model, spectrum[0], spectrum[1], r) for spectrum, l, r \
+                in zip(spectra, labels, result["curve_fit"][1])]
+            print("{0} {1:>12s}: {2:.2f} ms per solve ({3:.1f}x), chi-squared "
+                "difference from curve_fit {4:.2g} to {5:.2g}".format(
+                    description, method, 1e3 * duration,
+                    result["curve_fit"][0]/duration, min(difference),
+                    max(difference)))
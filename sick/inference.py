@@ -8,6 +8,7 @@ from __future__ import division, print_function
 __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
 import logging
+import multiprocessing
 import numpy as np
 from functools import partial
 
@@ -141,6 +142,52 @@ def ln_prior(theta, model, debug=False):
     return ln_prior
 
 
+def ln_prior_batch(theta, model, debug=False):
+    """
+    Return the log-prior for many points in parameter space at once. If a prior
+    cannot be evaluated for an array of values then each point is evaluated in
+    turn with :func:`ln_prior`.
+
+    :param theta:
+        A dictionary with an array of values for each parameter.
+
+    :type theta:
+        dict
+    """
+
+    N = max([np.size(value) for value in theta.values()] + [1])
+    ln_priors = np.zeros(N)
+
+    # Resolution parameters must not be negative, Po must be between 0 and 1,
+    # and Vo must be positive.
+    with np.errstate(invalid="ignore"):
+        for resolution_parameter in model._resolution_parameters:
+            ln_priors[0 > theta.get(resolution_parameter, 1) * np.ones(N)] \
+                = -np.inf
+
+        Po = theta.get("Po", 0.5) * np.ones(N)
+        ln_priors[~((1 > Po) * (Po > 0)) + (0 >= theta.get("Vo", 1))] = -np.inf
+
+    for parameter, rule in model._configuration.get("priors", {}).items():
+        if parameter not in theta or not rule: continue
+
+        try:
+            f = eval(rule, _prior_eval_env_)
+            ln_priors += f(theta[parameter] * np.ones(N))
+
+        except:
+            logger.debug("Evaluating the prior for {0} at each of {1} points "
+                "because it could not be evaluated for all of them at once"\
+                .format(parameter, N))
+            parameters = list(theta.keys())
+            return np.array([ln_prior(dict(zip(parameters, theta_)), model,
+                debug=debug) for theta_ in \
+                    np.array([theta[p] * np.ones(N) for p in parameters]).T])
+
+    logger.debug("Returning log priors for {} points".format(N))
+    return ln_priors
+
+
 def _ln_probability(theta_dict, model, data, debug, **kwargs):
     prior = ln_prior(theta_dict, model, debug=debug)
     if not np.isfinite(prior):
@@ -151,3 +198,297 @@ def _ln_probability(theta_dict, model, data, debug, **kwargs):
 def ln_probability(theta, parameters, model, data, debug=False, **kwargs):
     theta_dict = dict(zip(parameters, theta))
     return _ln_probability(theta_dict, model, data, debug, **kwargs)
+
+
+def ln_likelihood_batch(theta, model, data, debug=False, **kwargs):
+    """
+    Return the log-likelihood for many points in parameter space at once.
+
+    :param theta:
+        A dictionary with an array of values for each parameter.
+
+    :type theta:
+        dict
+    """
+
+    N = max([np.size(value) for value in theta.values()] + [1])
+    sigma_clip = model._configuration.get("settings", {}).get("sigma_clip", -1)
+
+    parameters = list(theta.keys())
+    thetas = np.array([theta[p] * np.ones(N) for p in parameters]).T
+    try:
+        model_fluxes, model_variances, channels, continua = model.batch_call(
+            thetas, data, parameters=parameters, debug=True, full_output=True,
+            **kwargs)
+
+    except:
+        if debug: raise
+        # Evaluate each point in turn, so that only the points that cannot be
+        # generated have a log-likelihood of -inf.
+        logger.debug("Evaluating the likelihood for each of {} points because "
+            "the model data couldn't be generated for all of them at once"\
+            .format(N))
+        return np.array([ln_likelihood(dict(zip(parameters, theta_)), model,
+            data, **kwargs) for theta_ in thetas])
+
+    ln_likelihoods, num_pixels = np.zeros(N), np.zeros(N, dtype=int)
+    for channel, spectrum, model_flux, model_variance, continuum \
+    in zip(channels, data, model_fluxes, model_variances, continua):
+        if channel is None: # no finite model fluxes
+            continue
+
+        # Observed and model variance (where it exists)
+        variance = spectrum.variance + model_variance * continuum**2
+
+        # Any on-the-fly sigma-clipping?
+        if sigma_clip > 0:
+            with np.errstate(invalid="ignore"):
+                mask = (spectrum.flux - model_flux)**2 / variance \
+                    > sigma_clip**2
+            mask *= (mask.sum(axis=1)/variance.shape[1] < 0.05)[:, None]
+            variance[mask] = np.nan
+
+        # Any underestimated variance?
+        ln_f = theta.get("ln_f", theta.get("ln_f_{}".format(channel), None))
+        if ln_f is not None:
+            variance += model_flux**2 \
+                * np.exp(2.0 * np.ones(N) * ln_f)[:, None]
+
+        # Calculate pixel likelihoods.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ivar = 1.0/variance
+            likelihood = -0.5 * ((spectrum.flux - model_flux)**2 * ivar \
+                - np.log(ivar))
+
+            # Only allow for positive flux to be produced!
+            pixels = np.isfinite(likelihood) * (model_flux > 0)
+
+            # Outliers?
+            if "Po" in theta:
+                # Calculate outlier likelihoods.
+                Vo = (np.ones(N) * theta["Vo"])[:, None]
+                outlier_ivar = 1.0/(variance + Vo)
+                outlier_likelihood = -0.5 * ((spectrum.flux - continuum)**2 \
+                    * outlier_ivar - np.log(outlier_ivar))
+
+                Po = (np.ones(N) * theta["Po"])[:, None]
+                pixels *= np.isfinite(outlier_likelihood)
+                likelihood = np.logaddexp(np.log(1. - Po) + likelihood,
+                    np.log(Po) + outlier_likelihood)
+
+        ln_likelihoods += np.where(pixels, likelihood, 0).sum(axis=1)
+        num_pixels += pixels.sum(axis=1)
+
+    ln_likelihoods[num_pixels == 0] = -np.inf
+    logger.debug("Returning ln(L) for {0} points with {1} to {2} pixels".format(
+        N, num_pixels.min(), num_pixels.max()))
+    return ln_likelihoods
+
+
+def ln_probability_batch(thetas, parameters, model, data, debug=False,
+    **kwargs):
+    """
+    Return the log-probability for many points in parameter space at once. The
+    priors are evaluated together with :func:`ln_prior_batch`, and the model
+    fluxes for all points with a finite prior are generated together with
+    :func:`sick.models.Model.batch_call`.
+
+    :param thetas:
+        An array of shape (N_theta, N_parameters) of the parameter values.
+
+    :type thetas:
+        :class:`numpy.array`
+
+    :param parameters:
+        The names of the parameters in each column of `thetas`.
+
+    :type parameters:
+        list of str
+    """
+
+    thetas = np.atleast_2d(thetas)
+    ln_probability = ln_prior_batch(dict(zip(parameters, thetas.T)), model,
+        debug=debug)
+
+    finite = np.isfinite(ln_probability)
+    ln_probability[~finite] = -np.inf
+    if np.any(finite):
+        ln_probability[finite] += ln_likelihood_batch(
+            dict(zip(parameters, thetas[finite].T)), model, data, debug=debug,
+            **kwargs)
+    return ln_probability
+
+
+
+class BatchPool(object):
+    """
+    A stand-in for a multiprocessing pool that lets an
+    :class:`emcee.EnsembleSampler` evaluate the log-probability of all walkers
+    in one call to :func:`ln_probability_batch`, instead of once per walker.
+
+    :param parameters:
+        The names of the parameters in each walker position.
+
+    :type parameters:
+        list of str
+
+    :param model:
+        The model to evaluate.
+
+    :type model:
+        :class:`sick.models.Model`
+
+    :param data:
+        The observed spectra.
+
+    :type data:
+        list of :class:`sick.specutils.Spectrum1D` objects
+
+    Any additional keyword arguments are passed to :func:`ln_probability_batch`.
+    """
+
+    def __init__(self, parameters, model, data, debug=False, **kwargs):
+        self.parameters = parameters
+        self.model = model
+        self.data = data
+        self.debug = debug
+        self.kwargs = kwargs
+
+
+    def map(self, function, positions):
+        """
+        Return the log-probability at each position. The sampler's own
+        (per-walker) log-probability function is ignored.
+        """
+        return list(ln_probability_batch(np.array(positions), self.parameters,
+            self.model, self.data, self.debug, **self.kwargs))
+
+
+    def close(self):
+        None
+
+
+    def join(self):
+        None
+
+
+
+# The model and data used by each worker process of a ProcessPool.
+_worker = {}
+
+def _initialise_worker(model, data, parameters, approximator_kwargs, debug,
+    vectorised, kwargs):
+    """
+    Prepare a worker process to evaluate log-probabilities: the approximator
+    and convolution functions are created once in each worker.
+    """
+
+    # This also sets the resolution parameters used by the priors.
+    model.parameters
+
+    model._initialise_approximator(force=True, **approximator_kwargs)
+    model._create_convolution_functions(kwargs["matched_channels"], data,
+        parameters)
+    _worker.update({
+        "model": model,
+        "data": data,
+        "parameters": parameters,
+        "debug": debug,
+        "vectorised": vectorised,
+        "kwargs": kwargs
+    })
+
+
+def _evaluate_in_worker(thetas):
+    """ Return the log-probability at each position, in a worker process. """
+
+    if _worker["vectorised"]:
+        return ln_probability_batch(thetas, _worker["parameters"],
+            _worker["model"], _worker["data"], _worker["debug"],
+            **_worker["kwargs"])
+
+    return np.array([ln_probability(theta, _worker["parameters"],
+        _worker["model"], _worker["data"], _worker["debug"],
+        **_worker["kwargs"]) for theta in thetas])
+
+
+
+class ProcessPool(object):
+    """
+    A pool of worker processes for an :class:`emcee.EnsembleSampler`.
+
+    The model, data and approximator settings are sent to each worker once,
+    when the pool is created. Models are pickled as their filename and
+    configuration, so each worker memory-maps the model intensities itself and
+    creates its own approximator. At each step the walker positions are split
+    into one chunk per worker, so only arrays of parameter values are sent to
+    the workers.
+
+    :param processes:
+        The number of worker processes.
+
+    :type processes:
+        int
+
+    :param parameters:
+        The names of the parameters in each walker position.
+
+    :type parameters:
+        list of str
+
+    :param model:
+        The model to evaluate.
+
+    :type model:
+        :class:`sick.models.Model`
+
+    :param data:
+        The observed spectra.
+
+    :type data:
+        list of :class:`sick.specutils.Spectrum1D` objects
+
+    :param approximator_kwargs:
+        Keyword arguments to initialise the approximator with in each worker
+        (e.g., `closest_point` and `wavelengths_required`).
+
+    :type approximator_kwargs:
+        dict
+
+    :param vectorised: [optional]
+        Evaluate each chunk of walkers together with
+        :func:`ln_probability_batch`.
+
+    :type vectorised:
+        bool
+
+    Any additional keyword arguments (e.g., `matched_channels`) are passed to
+    the log-probability function.
+    """
+
+    def __init__(self, processes, parameters, model, data, approximator_kwargs,
+        debug=False, vectorised=False, **kwargs):
+
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes,
+            initializer=_initialise_worker, initargs=(model, data, parameters,
+                approximator_kwargs, debug, vectorised, kwargs))
+
+
+    def map(self, function, positions):
+        """
+        Return the log-probability at each position. The sampler's own
+        log-probability function is ignored.
+        """
+
+        chunks = np.array_split(np.array(positions),
+            min(self.processes, len(positions)))
+        return list(np.hstack(self._pool.map(_evaluate_in_worker, chunks)))
+
+
+    def close(self):
+        self._pool.close()
+
+
+    def join(self):
+        self._pool.join()
@@ -11,16 +11,19 @@ import cPickle as pickle
 import logging
 import os
 import sys
+import threading
 import yaml
 from hashlib import md5
-from time import strftime
+from time import (strftime, time)
 
 import numpy as np
 from astropy.constants import c as speed_of_light
 from scipy.ndimage import gaussian_filter1d
+from scipy.spatial import cKDTree
 
 # sick
 from .. import specutils
+import storage
 import utils
 
 logger = logging.getLogger("sick")
@@ -62,9 +65,36 @@ class BaseModel(object):
         with open(filename, "r") as fp:
             content = yaml.load(fp)
 
-        self._initialised = False
+        self._filename = filename
         self._configuration = utils.update_recursively(
             self._default_configuration.copy(), content)
+        self._cache_lock = threading.RLock()
+        self._load_model_grid()
+
+
+    def __getstate__(self):
+        """
+        Pickle the model as its filename and configuration. The grid points,
+        wavelengths and intensities are read (or memory-mapped) from disk again
+        when the model is unpickled, so the model can be sent to other processes
+        cheaply. The approximator (in the model's default engine) must be
+        initialised again after unpickling.
+        """
+
+        return {
+            "_filename": self._filename,
+            "_configuration": self._configuration
+        }
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.RLock()
+        self._load_model_grid()
+
+
+    def _load_model_grid(self):
+        """ Load the grid points, metadata, and model wavelengths from disk. """
 
         # Load the grid points and the metadata.
         with open(self._configuration["model_grid"]["grid_points"], "rb") as fp:
@@ -115,6 +145,147 @@ class BaseModel(object):
         return True
 
 
+    def _intensities(self):
+        """
+        Return read-only access to the intensities of all grid points, in
+        whichever storage format the model uses.
+        """
+
+        return storage.load_intensities(
+            self._configuration["model_grid"]["intensities"],
+            shape=(self.grid_points.size, self.wavelengths.size),
+            format=self._configuration["model_grid"].get("intensities_format",
+                "memmap"))
+
+
+    def _pixel_major_intensities(self, persist=True):
+        """
+        Return the intensities of all grid points in pixel-major order, as an
+        array of shape (N_pixels, N_points), so that the intensities of one
+        pixel across the grid are contiguous.
+
+        The pixel-major intensities are kept in memory for subsequent calls. If
+        persisted, they are stored as a memory-mapped file next to the model
+        intensities: it is built if it does not exist, or rebuilt if the model
+        intensities have changed since it was built.
+
+        :param persist: [optional]
+            Load the pixel-major intensities from disk, or save them to disk
+            once they are built.
+
+        :type persist:
+            bool
+        """
+
+        filename = self._configuration["model_grid"]["intensities"]
+        stat = os.stat(filename)
+        key = "{0} {1!r} {2} {3}".format(stat.st_size, stat.st_mtime,
+            self.grid_points.size, self.wavelengths.size)
+
+        try:
+            pixel_major_key, pixel_major = self._pixel_major
+
+        except AttributeError:
+            None
+
+        else:
+            if pixel_major_key == key \
+            and (not persist or isinstance(pixel_major, np.memmap)):
+                return pixel_major
+
+        shape = (self.wavelengths.size, self.grid_points.size)
+        prefix = "{}-pixel-major".format(os.path.splitext(filename)[0])
+        path, key_path = (prefix + ".memmap", prefix + ".key")
+
+        pixel_major = None
+        if persist and os.path.exists(key_path):
+            with open(key_path, "r") as fp:
+                if fp.read() == key:
+                    pixel_major = np.memmap(path, dtype="float32", mode="r",
+                        shape=shape)
+                else:
+                    logger.info("Rebuilding pixel-major intensities {0} "
+                        "because the model intensities have changed".format(
+                            path))
+
+        if pixel_major is None:
+            t = time()
+            if persist and os.path.exists(key_path):
+                os.remove(key_path)
+
+            pixel_major = storage.transpose_intensities(self._intensities(),
+                path if persist else None)
+
+            if persist:
+                with open(key_path, "w") as fp:
+                    fp.write(key)
+
+            logger.info("Built pixel-major intensities in {0:.0f} seconds{1}"\
+                .format(time() - t,
+                    " and saved them to {}".format(path) if persist else ""))
+
+        self._pixel_major = (key, pixel_major)
+        return pixel_major
+
+
+    def convert_intensities(self, filename, format="chunked", clobber=False,
+        **kwargs):
+        """
+        Copy the model intensities to a new file in the given storage format and
+        use it for this model. Save the model configuration afterwards to keep
+        the change.
+
+        :param filename:
+            The filename to save the intensities to.
+
+        :type filename:
+            str
+
+        :param format: [optional]
+            The storage format of the new intensities: `memmap` or `chunked`.
+            Any additional keyword arguments (e.g., `dtype`, `compression` and
+            `block_size`) are passed to the writer for chunked intensities.
+
+        :type format:
+            str
+
+        :param clobber: [optional]
+            Clobber the filename if it already exists.
+
+        :type clobber:
+            bool
+
+        :returns:
+            True
+
+        :raises:
+            IOError if the filename exists and clobber is False.
+        """
+
+        if os.path.exists(filename) and not clobber:
+            raise IOError("filename {} already exists".format(filename))
+
+        shape = (self.grid_points.size, self.wavelengths.size)
+        intensities = self._intensities()
+        converted_intensities = storage.create_intensities(filename, shape,
+            self.meta["channel_sizes"], format=format, **kwargs)
+
+        # Copy the intensities in blocks of grid points to bound memory use.
+        block_size = kwargs.get("block_size", 64)
+        for i in xrange(0, shape[0], block_size):
+            converted_intensities[i:i + block_size] \
+                = intensities[i:i + block_size]
+
+        converted_intensities.flush()
+        del intensities, converted_intensities
+
+        self._configuration["model_grid"].update({
+            "intensities": filename,
+            "intensities_format": format
+        })
+        return True
+
+
     def __str__(self):
         return unicode(self).encode("utf-8")
 
@@ -307,6 +478,96 @@ class BaseModel(object):
 
         return (masked_data, pixels_affected)
 
+    def _scaled_grid_points(self):
+        """
+        Return the grid points as an array of shape (N_points, N_dimensions),
+        with each parameter scaled by its range, and the scale of each
+        parameter.
+        """
+
+        with self._cache_lock:
+            try:
+                return self._scaled_grid
+
+            except AttributeError:
+                None
+
+            dtype = [(name, '<f8') for name in self.grid_points.dtype.names]
+            grid_points = self.grid_points.astype(dtype).view(float)\
+                .reshape(-1, len(dtype))
+            scale = np.ptp(grid_points, axis=0)
+            scale[scale == 0] = 1.
+
+            self._scaled_grid = (grid_points/scale, scale)
+            return self._scaled_grid
+
+
+    def _nearest_grid_indices(self, points, N):
+        """
+        Return the indices of the `N` nearest grid points to each of the given
+        points, ordered by distance. Distances are measured with the L1 norm
+        in grid space, where each parameter is scaled by its range.
+
+        A k-d tree of the scaled grid points is built the first time this is
+        called. If more than half of the grid is requested then a partial sort
+        of the distances is faster than querying the tree. Either way, grid
+        points at the same distance are ordered by their index in the grid.
+
+        :param points:
+            A point, or an array of shape (N_points, N_dimensions), in the grid
+            parameters.
+
+        :type points:
+            :class:`numpy.array`
+
+        :param N:
+            The number of nearest grid points to return.
+
+        :type N:
+            int
+
+        :returns:
+            An array of shape (N, ) for a single point, or (N_points, N) for
+            many points.
+        """
+
+        grid_points, scale = self._scaled_grid_points()
+        N = int(min(max(N, 1), grid_points.shape[0]))
+        single = np.ndim(points) == 1
+        points = np.atleast_2d(np.array(points, dtype=float))/scale
+
+        # Every grid point that is as close as the N-th nearest one is a
+        # candidate, so that ties at the N-th distance are broken by index.
+        if N > grid_points.shape[0]/2.:
+            candidates = [np.arange(grid_points.shape[0])] * points.shape[0]
+            distances = [np.abs(grid_points - point).sum(axis=1) \
+                for point in points]
+            radii = [np.partition(distance, N - 1)[N - 1] \
+                for distance in distances]
+
+        else:
+            with self._cache_lock:
+                try:
+                    tree = self._grid_tree
+
+                except AttributeError:
+                    tree = self._grid_tree = cKDTree(grid_points)
+
+            radii = tree.query(points, k=N, p=1)[0].reshape(-1, N)[:, -1]
+            candidates = [np.sort(tree.query_ball_point(point,
+                radius * (1 + 1e-8) + 1e-12, p=1)) \
+                    for point, radius in zip(points, radii)]
+            distances = [np.abs(grid_points[candidate] - point).sum(axis=1) \
+                for point, candidate in zip(points, candidates)]
+
+        indices = np.array([candidate[distance <= radius][np.argsort(
+            distance[distance <= radius], kind="mergesort")[:N]] \
+                for candidate, distance, radius \
+                in zip(candidates, distances, radii)])
+
+        return indices[0] if single else indices
+
+
     def _model_mask(self, wavelengths=None):
         """
         Apply pre-defined model masks.
@@ -398,6 +659,30 @@ class BaseModel(object):
             for i in range(size)])
 
 
+    def _proposal_closest_point(self, parameters, initial_proposal,
+        fixed=None):
+        """
+        Return the grid point at the middle of an initial proposal, taking any
+        grid parameters that are not sampled from the `fixed` values. If a grid
+        parameter has no value then None is returned so that the whole grid is
+        considered.
+        """
+
+        if fixed is None:
+            fixed = {}
+
+        closest_point = np.array([\
+            np.median(initial_proposal[:, parameters.index(p)]) \
+                if p in parameters else fixed.get(p, None) \
+            for p in self.grid_points.dtype.names], dtype=float)
+
+        if not np.all(np.isfinite(closest_point)):
+            logger.warn("No closest grid point for the initial proposal because"
+                " not all grid parameters are sampled or fixed")
+            return None
+        return list(closest_point)
+
+
     def _chi_sq(self, theta, data, **kwargs):
 
         chi_sq, dof = 0, -1
@@ -445,11 +730,15 @@ class BaseModel(object):
                 raise ValueError("spectral resolution for the new channel {} "
                     "must be a positive value".format(name))
 
+        # The cast model uses the same intensities format as this model.
+        intensities_format = self._configuration["model_grid"].get(
+            "intensities_format", "memmap")
+
         # Clobber.
         if not clobber:
             # Check to make sure the output files won't exist already.
             output_suffixes = (".yaml", ".pkl", "-wavelengths.memmap",
-                "-intensities.memmap")
+                storage.suffixes[intensities_format])
             for path in [output_prefix + suffix for suffix in output_suffixes]:
                 if os.path.exists(path):
                     raise IOError("output filename {} already exists"\
@@ -521,7 +810,9 @@ class BaseModel(object):
                 "model_grid": {
                     "grid_points": output_prefix + ".pkl",
                     "wavelengths": output_prefix + "-wavelengths.memmap",
-                    "intensities": output_prefix + "-intensities.memmap"
+                    "intensities": output_prefix \
+                        + storage.suffixes[intensities_format],
+                    "intensities_format": intensities_format
                 }
             })
             fp.write(header + "\n" + yaml.safe_dump(configuration, stream=None, 
@@ -581,16 +872,14 @@ class BaseModel(object):
                             new_wavelengths, new_resolution=spectral_resolution))
             
         # Load the intensities.
-        intensities = np.memmap(
-            self._configuration["model_grid"]["intensities"],
-            shape=(self.grid_points.size, self.wavelengths.size),
-            mode="r", dtype="float32")
+        intensities = self._intensities()
 
         # Create a new intensities grid.
-        cast_intensities = np.memmap(
-            output_prefix + "-intensities.memmap",
+        cast_intensities = storage.create_intensities(
+            output_prefix + storage.suffixes[intensities_format],
             shape=(self.grid_points.size, num_pixels),
-            mode="w+", dtype="float32")
+            channel_sizes=channel_sizes, format=intensities_format,
+            **kwargs.pop("intensities_options", {}))
 
         n = self.grid_points.size
         increment = int(n / 100)
@@ -9,23 +9,27 @@ __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
 import cPickle as pickle
 import logging
+import multiprocessing
 import os
 import sys
-from collections import OrderedDict
+from collections import (namedtuple, OrderedDict)
+from hashlib import md5
 
 import numpy as np
 from scipy import optimize as op
 
-import generate
 from model import Model
 
 # Since the Cannon can algebraically solve for astrophysical parameters, given
 # some rest-frame intensities, we can make use of a different optimisation
 # approach. Thus, we need the sick optimise and inference modules.
-from .. import (inference, optimise, specutils)
+from .. import (inference, optimise, specutils, utils)
 
 logger = logging.getLogger("sick")
 
+_CannonCacheInfo = namedtuple("CannonCacheInfo", ["hits", "misses", "maxsize",
+    "currsize", "hit_rate", "nbytes"])
+
 
 class CannonModel(Model):
 
@@ -53,18 +57,50 @@ class CannonModel(Model):
         return None
 
 
+    def __getstate__(self):
+        """
+        Pickle the model as its filename and configuration, and the trained
+        Cannon coefficients, scatter, label vector and offsets.
+        """
+
+        state = super(CannonModel, self).__getstate__()
+        state.update(dict([(k, v) for k, v in self.__dict__.items() \
+            if k.startswith("_cannon_")]))
+        return state
+
+
     def _load_trained_model(self, filename):
 
         logger.info("Loading model from {}".format(filename))
         with open(filename, "rb") as fp:
             trained_model = pickle.load(fp)
 
+        return self._set_trained_model(trained_model)
+
+
+    def _set_trained_model(self, trained_model):
+        """
+        Keep the trained coefficients, scatter, label vector, offsets and grid
+        indices as the Cannon model.
+        """
+
         self._cannon_coefficients, self._cannon_scatter, \
         self._cannon_label_vector, self._cannon_offsets, \
         self._cannon_grid_indices = trained_model
         return trained_model
 
 
+    @property
+    def _trained_model(self):
+        """
+        Return the trained coefficients, scatter, label vector, offsets and grid
+        indices of the Cannon model.
+        """
+        return (self._cannon_coefficients, self._cannon_scatter,
+            self._cannon_label_vector, self._cannon_offsets,
+            self._cannon_grid_indices)
+
+
     def train_global(self, label_vector_description=None, N=None, limits=None,
         pivot=True, **kwargs):
         """
@@ -76,7 +112,8 @@ class CannonModel(Model):
             self._interpret_label_vector(label_vector_description)
         lv_array, grid_indices, offsets = _build_label_vector_array(
             self.grid_points, lv, N, limits, pivot=pivot)
-        return self._train(lv_array, grid_indices, offsets, lv, **kwargs)
+        return self._set_trained_model(
+            self._train(lv_array, grid_indices, offsets, lv, **kwargs))
 
 
     def train_local(self, closest_point, label_vector_description=None, N=None,
@@ -87,6 +124,17 @@ class CannonModel(Model):
         regime.
         """
 
+        return self._set_trained_model(self._train_local(closest_point,
+            label_vector_description, N, pivot, **kwargs))
+
+
+    def _train_local(self, closest_point, label_vector_description=None,
+        N=None, pivot=True, **kwargs):
+        """
+        Train a local Cannon model (see :func:`train_local`) without keeping it
+        as the Cannon model, so that each fit can train its own.
+        """
+
         lv = self._cannon_label_vector if label_vector_description is None else\
             self._interpret_label_vector(label_vector_description)
 
@@ -101,13 +149,7 @@ class CannonModel(Model):
         logger.debug("Using {} nearest points for local Cannon model".format(N))
 
         # Use closest N points.
-        dtype = [(name, '<f8') for name in self.grid_points.dtype.names]
-        grid_points \
-            = self.grid_points.astype(dtype).view(float).reshape(-1, len(dtype))
-
-        distance = np.sum(np.abs(grid_points - np.array(closest_point))/
-            np.ptp(grid_points, axis=0), axis=1)
-        grid_indices = np.argsort(distance)[:N]
+        grid_indices = self._nearest_grid_indices(closest_point, N)
         
         lv_array, _, offsets = _build_label_vector_array(
             self.grid_points[grid_indices], lv, pivot=pivot)
@@ -118,16 +160,25 @@ class CannonModel(Model):
         clobber=False, **kwargs):
         """
         Train the Cannon coefficients.
+
+        Training is checkpointed next to the Cannon data file (unless another
+        `checkpoint` path prefix is given), so if it is interrupted then running
+        it again will resume from the blocks of pixels that have finished.
         """
 
         if any(map(os.path.exists,
             (model_filename, cannon_data_filename))) and not clobber:
             raise IOError("output file already exists")
 
-        trained = self.train_global(**kwargs)
+        checkpoint = kwargs.pop("checkpoint", "{}-checkpoint".format(
+            os.path.splitext(cannon_data_filename)[0]))
+        trained = self.train_global(checkpoint=checkpoint, **kwargs)
         with open(cannon_data_filename, "wb") as fp:
             pickle.dump(trained, fp, -1)
 
+        if checkpoint is not None:
+            _remove_training_checkpoint(checkpoint)
+
         self._configuration["model_grid"]["cannon_data"] = cannon_data_filename
         logger.info("Cannon coefficients pickled to {}".format(
             cannon_data_filename))
@@ -137,11 +188,19 @@ class CannonModel(Model):
         return True
 
 
-    def optimise(self, data, initial_theta=None, full_output=False, **kwargs):
+    def optimise(self, data, initial_theta=None, full_output=False,
+        engine=None, **kwargs):
         """
         Optimise the model parameters, given the data.
+
+        The approximator and convolution functions are kept in the given
+        :class:`sick.models.generate.SpectrumEngine`, or the model's default
+        engine.
         """
 
+        if engine is None:
+            engine = self.engine
+
         data = self._format_data(data)
 
         if initial_theta is None:
@@ -171,7 +230,7 @@ class CannonModel(Model):
         # (If necessary,..) train the Cannon model around the closest point.
         subset_bounds = self._initialise_approximator(closest_point=\
             [initial_theta[p] for p in self.grid_points.dtype.names], 
-            wavelengths_required=wavelengths_required, **kwargs)
+            wavelengths_required=wavelengths_required, engine=engine, **kwargs)
         
         # Get the optimisation keyword arguments.
         op_kwargs = self._configuration.get("optimise", {}).copy()
@@ -213,7 +272,8 @@ class CannonModel(Model):
         masked_data, pixels_affected = self._apply_data_mask(data)
 
         # Prepare the convolution functions.
-        self._create_convolution_functions(matched_channels, data, parameters)
+        self._create_convolution_functions(matched_channels, data, parameters,
+            engine=engine)
 
         logger.info("Optimising parameters: {0}".format(", ".join(parameters)))
         logger.info("Optimisation keywords: {0}".format(op_kwargs))
@@ -222,6 +282,7 @@ class CannonModel(Model):
         # continuum-normalise the observed spectra, put it at rest, then solve
         # for the best astrophysical parameters, then *generate* that spectrum.
         debug = kwargs.get("debug", False)
+        previous_labels = {}
         def nlp(t, return_labels=False):
             # Apply fixed keywords.
             theta = dict(zip(parameters, t))
@@ -268,16 +329,21 @@ class CannonModel(Model):
             observed_intensities \
                 = np.nanmean(np.vstack(observed_intensities), axis=0)
 
-            # Solve for the astrophysical parameters.
+            # Solve for the astrophysical parameters, starting from the labels
+            # found in the previous call.
             try:
                 labels = self._solve_labels(observed_intensities,
-                    observed_variances)
+                    observed_variances, initial_labels=previous_labels or None,
+                    trained_model=engine.trained_model)
 
             except:
                 logger.exception("Could not determine labels:")
                 if debug: raise
                 return np.inf
 
+            if np.all(np.isfinite(list(labels.values()))):
+                previous_labels.update(labels)
+
             if return_labels:
                 return labels
 
@@ -287,7 +353,7 @@ class CannonModel(Model):
             # Make the log-probability call.
             # Note: The inference._ln_probability call takes a dictionary.
             return -inference._ln_probability(theta, self, data, debug,
-                matched_channels=matched_channels)
+                matched_channels=matched_channels, engine=engine)
 
         # Do the optimisation.
         p0 = np.array([initial_theta[p] for p in parameters])
@@ -303,15 +369,33 @@ class CannonModel(Model):
 
         if full_output:
             # Create model fluxes and calculate some metric.
-            chi_sq, dof, model_fluxes = self._chi_sq(result, data)
+            chi_sq, dof, model_fluxes = self._chi_sq(result, data,
+                engine=engine)
             result = (result, chi_sq, dof, model_fluxes)
 
+        info = self.cache_info(engine)
+        if info.maxsize > 0:
+            logger.info("Cannon spectrum cache: {0:.0%} hit rate ({1} hits, {2}"
+                " misses), {3} of {4} spectra using {5:.1f} MB".format(
+                    info.hit_rate, info.hits, info.misses, info.currsize,
+                    info.maxsize, info.nbytes/1024**2))
+
         # Remove any prepared convolution functions.
-        self._destroy_convolution_functions()
+        self._destroy_convolution_functions(engine)
 
         return result
 
 
+    def cache_info(self, engine=None):
+        """
+        Return the number of hits, misses, maximum size, current size, hit rate
+        and memory (in bytes) of the cache of spectra generated by the
+        approximator in the given engine, or the model's default engine.
+        """
+        return (self.engine if engine is None else engine).intensities\
+            .cache_info()
+
+
     def _approximate_intensities(self, theta, data, debug=False, **kwargs):
 
         if kwargs.get("__intensities", None) is not None:
@@ -322,16 +406,16 @@ class CannonModel(Model):
             model_variances = 0
 
         else:
-            if not self._initialised:
+            engine = kwargs.get("engine", None) or self.engine
+            if not engine.initialised:
                 self._initialise_approximator(**kwargs)
 
             try:
                 # Get the wavelengths and intensities.
-                model_wavelengths = generate.wavelengths[-1]
-                func = generate.intensities[-1]
+                model_wavelengths, func, model_variances \
+                    = engine.approximator()
                 model_intensities = func([theta.get(p, np.nan) \
                     for p in self.grid_points.dtype.names]).flatten()
-                model_variances = generate.variances[-1]
 
             except:
                 if debug: raise
@@ -341,8 +425,33 @@ class CannonModel(Model):
         return (model_wavelengths, model_intensities, model_variances)
 
 
+    def _approximate_intensities_batch(self, theta, data, debug=False,
+        **kwargs):
+        """
+        Generate model intensities at many points at once.
+        """
+
+        engine = kwargs.get("engine", None) or self.engine
+        if not engine.initialised:
+            self._initialise_approximator(**kwargs)
+
+        N = max([np.size(value) for value in theta.values()] + [1])
+        points = np.array([theta.get(p, np.nan) * np.ones(N) \
+            for p in self.grid_points.dtype.names]).T
+
+        model_wavelengths, func, model_variances = engine.approximator()
+        try:
+            model_intensities = func(points)
+
+        except:
+            if debug: raise
+            model_intensities = np.nan * np.ones((N, model_wavelengths.size))
+
+        return (model_wavelengths, model_intensities, model_variances)
+
+
     def _initialise_approximator(self, closest_point=None,
-        wavelengths_required=None, **kwargs):
+        wavelengths_required=None, engine=None, **kwargs):
 
         # What wavelengths will be required? Assume all if not specified.
         if wavelengths_required is not None:
@@ -359,7 +468,11 @@ class CannonModel(Model):
         mask *= self._model_mask()
 
         # Do we have a globally-trained model, or should we do a local train?
-        if "cannon_data" not in self._configuration["model_grid"]:
+        # A local model is kept in the engine, so each fit can train its own.
+        if "cannon_data" in self._configuration["model_grid"]:
+            trained_model = self._trained_model
+
+        else:
             # Local Cannon. Train around the closest point.
             if closest_point is None:
                 raise WTFError("you want a local Cannon model but you haven't "\
@@ -374,14 +487,14 @@ class CannonModel(Model):
             and os.path.exists(os.path.join(local_store_folder, local_store_filename)):
 
                 # Load that filename.
-                coefficients, scatter, lv, offsets, grid_indices \
-                    = self._load_trained_model(os.path.join(local_store_folder,
-                        local_store_filename))
+                with open(os.path.join(local_store_folder,
+                    local_store_filename), "rb") as fp:
+                    trained_model = pickle.load(fp)
 
             else:
                 # Locally train.
-                coefficients, scatter, lv, offsets, grid_indices \
-                    = self.train_local(closest_point, mask=mask, **kwargs)
+                trained_model = self._train_local(closest_point, mask=mask,
+                    **kwargs)
 
                 if local_store_folder is not None:
                     # Save it
@@ -390,36 +503,36 @@ class CannonModel(Model):
                     logger.info("Saving locally trained Cannon model to {}"\
                         .format(local_store_path))
                     with open(local_store_path, "wb") as fp:
-                        pickle.dump((coefficients, scatter, lv, offsets,
-                            grid_indices), fp, -1)
+                        pickle.dump(trained_model, fp, -1)
 
         # Apply masks to cannoniser.
         # This ensures the plots don't look like they are interpolating over
         # masked regions, while minimising the number of nan-multiplications
         # required,
-        coefficients = self._cannon_coefficients.copy()
+        coefficients, scatter, lv, offsets, grid_indices = trained_model
+        coefficients = coefficients.copy()
         coefficients[~mask, :] = np.nan
 
         # Slice only to the left and right most nans.
         _ = np.where(mask)[0]
         lhs, rhs = np.clip([_.min(), _.max() + 1], 0, self.wavelengths.size)
         
-        cannoniser = lambda pt: np.dot(coefficients[lhs:rhs],
-            _build_label_vector_rows(self._cannon_label_vector,
-                pt - self._cannon_offsets.copy()).T).flatten()
-
-        generate.init()
-        generate.wavelengths.append(self.wavelengths[lhs:rhs])
-        generate.intensities.append(cannoniser)
-        generate.variances[-1] = self._cannon_scatter[lhs:rhs]**2
+        # Generated spectra can be cached (this is off by default).
+        settings = self._configuration.get("settings", {})
+        cannoniser = _CannonApproximator(coefficients[lhs:rhs], lv,
+            offsets.copy(), cache_size=settings.get("cannon_cache_size", 0),
+            tolerance=settings.get("cannon_cache_tolerance", 3))
 
-        self._initialised = True
-        self._subset_bounds = {}
+        subset_bounds = {}
         for name in self.grid_points.dtype.names:
-            points = self.grid_points[name][self._cannon_grid_indices]
-            self._subset_bounds[name] = (min(points), max(points))
+            points = self.grid_points[name][grid_indices]
+            subset_bounds[name] = (min(points), max(points))
 
-        return self._subset_bounds
+        (self.engine if engine is None else engine).set_approximator(
+            self.wavelengths[lhs:rhs], cannoniser,
+            variances=scatter[lhs:rhs]**2, subset_bounds=subset_bounds,
+            trained_model=trained_model)
+        return subset_bounds
 
 
     def _interpret_label_vector(self, human_readable_label_vector):
@@ -497,56 +610,117 @@ class CannonModel(Model):
         return " + ".join(string)
 
 
-    def _solve_labels(self, normalised_flux, variance=0, **kwargs):
+    def _solve_labels(self, normalised_flux, variance=0, initial_labels=None,
+        method="gauss-newton", trained_model=None, **kwargs):
+        """
+        Solve for the astrophysical labels, given a normalised rest-frame
+        spectrum on the model wavelengths.
+
+        The weighted products of the Cannon coefficients with themselves and
+        with the data are calculated once, so that each Gauss-Newton iteration
+        does not depend on the number of pixels. The Jacobian of the label
+        vector is calculated analytically.
+
+        :param normalised_flux:
+            The normalised rest-frame flux at each model wavelength.
+
+        :type normalised_flux:
+            :class:`numpy.array`
+
+        :param variance: [optional]
+            The variance in the normalised flux.
+
+        :type variance:
+            :class:`numpy.array`
+
+        :param initial_labels: [optional]
+            The labels to start from (e.g., those from a previous call). By
+            default the linear terms of a linear inversion are used.
+
+        :type initial_labels:
+            dict
+
+        :param method: [optional]
+            The solver to use: `gauss-newton`, or `curve_fit` to use
+            :func:`scipy.optimize.curve_fit`.
+
+        :type method:
+            str
+
+        :param trained_model: [optional]
+            The trained coefficients, scatter, label vector, offsets and grid
+            indices to use (e.g., those kept in an engine). By default those of
+            the Cannon model are used.
+
+        :type trained_model:
+            tuple
+        """
 
         if not isinstance(variance, (np.ndarray, )):
             variance = np.zeros_like(normalised_flux)
 
+        coefficients, scatter, label_vector, offsets, _ \
+            = self._trained_model if trained_model is None else trained_model
+
         # Which parameters are actually in the Cannon model?
         # (These are the ones we have to solve for.)
         indices = np.unique(np.hstack(
             [[term[0] for term in vector_terms if term[1] != 0] \
-            for vector_terms in self._cannon_label_vector]))
-
-        finite = np.isfinite(self._cannon_coefficients[:, 0] * normalised_flux \
-            * variance)
-
-        # Get an initial estimate of those parameters from a simple inversion.
-        # (This is very much incorrect for non-linear terms).
-        Cinv = 1.0 / (self._cannon_scatter[finite]**2 + variance[finite])
-        A = np.dot(self._cannon_coefficients[finite, :].T,
-            Cinv[:, None] * self._cannon_coefficients[finite, :])
-        B = np.dot(self._cannon_coefficients[finite, :].T,
-            Cinv * normalised_flux[finite])
-        initial_vector_labels = np.linalg.solve(A, B)
-        
-        # p0 contains all coefficients, but we need only the linear terms for
-        # the initial estimate
-        _ = np.array([i for i, vector_terms \
-            in enumerate(self._cannon_label_vector) if len(vector_terms) == 1 \
-            and vector_terms[0][1] == 1])
-        if len(_) == 0:
-            raise ValueError("no linear terms in Cannon model")
-
-        p0 = initial_vector_labels[1 + _]
-
-        # Create the function.
-        def f(coefficients, *labels):
-            return np.dot(coefficients, _build_label_vector_rows(
-                self._cannon_label_vector, labels).T).flatten()
-
-        # Optimise the curve to solve for the parameters and covariance.
+            for vector_terms in label_vector]))
+        names = np.array(self.grid_points.dtype.names)[indices]
+
+        # Pixels without any scatter or variance would have infinite weight.
+        finite = np.isfinite(coefficients[:, 0] * normalised_flux * variance) \
+            * (scatter**2 + variance > 0)
+
+        # Calculate the weighted products once.
+        Cinv = 1.0 / (scatter[finite]**2 + variance[finite])
+        CTCinv = coefficients[finite, :].T * Cinv
+        A = np.dot(CTCinv, coefficients[finite, :])
+        B = np.dot(CTCinv, normalised_flux[finite])
+
+        if initial_labels is not None \
+        and all(name in initial_labels for name in names):
+            p0 = np.array([initial_labels[name] for name in names]) - offsets
+
+        else:
+            # Get an initial estimate of those parameters from a simple
+            # inversion. (This is very much incorrect for non-linear terms).
+            initial_vector_labels = np.linalg.solve(A, B)
+
+            # p0 contains all coefficients, but we need only the linear terms
+            # for the initial estimate
+            _ = np.array([i for i, vector_terms in enumerate(label_vector) \
+                if len(vector_terms) == 1 and vector_terms[0][1] == 1])
+            if len(_) == 0:
+                raise ValueError("no linear terms in Cannon model")
+
+            p0 = initial_vector_labels[1 + _]
+
         full_output = kwargs.pop("full_output", False)
-        kwds = kwargs.copy()
-        kwds.setdefault("maxfev", 10000)
-        labels, covariance = op.curve_fit(f, self._cannon_coefficients[finite],
-            normalised_flux[finite], p0=p0, sigma=1.0/np.sqrt(Cinv),
-            absolute_sigma=True, **kwds)
+        if method == "gauss-newton":
+            labels, covariance = _gauss_newton_labels(A, B, label_vector, p0,
+                **kwargs)
+
+        elif method == "curve_fit":
+            # Create the function.
+            def f(coefficients, *labels):
+                return np.dot(coefficients, _build_label_vector_rows(
+                    label_vector, labels).T).flatten()
+
+            # Optimise the curve to solve for the parameters and covariance.
+            kwds = kwargs.copy()
+            kwds.setdefault("maxfev", 10000)
+            labels, covariance = op.curve_fit(f, coefficients[finite],
+                normalised_flux[finite], p0=p0, sigma=1.0/np.sqrt(Cinv),
+                absolute_sigma=True, **kwds)
+
+        else:
+            raise ValueError("method must be either gauss-newton or curve_fit")
 
         # Since we might not have solved for every parameter, let's return a 
         # dictionary. Don't forget to apply the offsets to the inferred labels.
-        labels = dict(zip(np.array(self.grid_points.dtype.names)[indices],
-            labels + self._cannon_offsets))
+        labels = dict(zip(names, labels + offsets))
 
         if full_output:
             return (labels, covariance)
@@ -555,56 +729,357 @@ class CannonModel(Model):
 
 
     def _train(self, lv_array, grid_indices, offsets, lv, mask=None, **kwargs):
+        """
+        Train the coefficients and scatter at each pixel.
+
+        The pixels are trained in blocks of `pixel_batch_size` consecutive
+        pixels, and each block is read directly from the model intensities. By
+        default the pixels in a block are trained together with
+        :func:`_fit_pixels`. If `vectorised_training` is false then each pixel
+        is trained separately with :func:`_fit_pixel`. The blocks are shared
+        between `processes` worker processes.
+
+        If a `checkpoint` path prefix is given then the coefficients and scatter
+        are written to memory-mapped files as each block finishes, and training
+        again with the same checkpoint skips the blocks that have finished.
+
+        If `pixel_major` is true (or the `pixel_major_intensities` setting is
+        true) then the blocks are read from a pixel-major copy of the model
+        intensities (see :func:`BaseModel._pixel_major_intensities`), so that
+        the intensities of each block are contiguous. The copy is saved next to
+        the model intensities unless the `persist_pixel_major_intensities`
+        setting is false, but it is always saved when there are worker
+        processes so that they can share it.
+        """
+
+        N_pixels, N_terms = self.wavelengths.size, lv_array.shape[1]
+        u_intensities = kwargs.pop("u_intensities", None)
+        vectorised = kwargs.pop("vectorised_training", True)
+        batch_size = int(kwargs.pop("pixel_batch_size", 1000))
+        processes = int(kwargs.pop("processes", 1))
+        checkpoint = kwargs.pop("checkpoint", None)
+
+        settings = self._configuration.get("settings", {})
+        pixel_major = kwargs.pop("pixel_major",
+            settings.get("pixel_major_intensities", False))
+        persist = settings.get("persist_pixel_major_intensities", True) \
+            or processes > 1
+
+        if mask is None:
+            mask = np.ones(N_pixels, dtype=bool)
+        else:
+            logger.debug("Using mask for Cannon training")
 
-        N_models, N_pixels = self.grid_points.size, self.wavelengths.size
-        training_intensities = np.memmap(
-            self._configuration["model_grid"]["intensities"],dtype="float32",
-            mode="r", shape=(N_models, N_pixels))[grid_indices, :]
+        edges = np.arange(0, N_pixels + batch_size, batch_size).clip(0, N_pixels)
+        blocks = [(i, start, end, mask[start:end]) \
+            for i, (start, end) in enumerate(zip(edges[:-1], edges[1:]))]
 
-        scatter = np.nan * np.ones(N_pixels)
-        coefficients = np.nan * np.ones((N_pixels, lv_array.shape[1]))
-        u_intensities = kwargs.pop("u_intensities", 
-            np.zeros(training_intensities.shape))
+        if checkpoint is None:
+            coefficients = np.nan * np.ones((N_pixels, N_terms))
+            scatter = np.nan * np.ones(N_pixels)
+            done = np.zeros(len(blocks), dtype=bool)
+
+        else:
+            coefficients, scatter, done = _training_checkpoint(checkpoint,
+                (N_pixels, N_terms, batch_size, vectorised), lv_array, mask,
+                grid_indices)
+            if np.any(done):
+                logger.info("Resuming Cannon training from {0}: {1} of {2} "
+                    "blocks have finished".format(checkpoint, done.sum(),
+                        done.size))
+
+        blocks = [block for block in blocks if not done[block[0]]]
 
-        increment = int(N_pixels / 100)
         progressbar = kwargs.pop("__progressbar", True)
         if progressbar:
             sys.stdout.write("\rTraining Cannon model from {} points:\n".format(
                 grid_indices.size))
             sys.stdout.flush()
 
-        if mask is None:
-            mask = np.ones(N_pixels, dtype=bool)
-        else:
-            logger.debug("Using mask for Cannon training")
+        intensities = self._pixel_major_intensities(persist) if pixel_major \
+            else self._intensities()
 
-        for i in xrange(N_pixels):
-            if progressbar and (i % increment) == 0:
-                sys.stdout.write("\r[{done}{not_done}] {percent:3.0f}%".format(
-                    done="=" * int((i + 1) / increment),
-                    not_done=" " * int((N_pixels - i - 1)/ increment),
-                    percent=100. * (i + 1)/N_pixels))
-                sys.stdout.flush()
+        worker_args = (grid_indices, lv_array, u_intensities, vectorised,
+            pixel_major)
+        if processes > 1:
+            pool = multiprocessing.Pool(processes,
+                initializer=_initialise_training_worker,
+                initargs=(self, ) + worker_args)
+            results = pool.imap_unordered(_train_block_in_worker, blocks)
 
-            if not mask[i]: continue
-            coefficients[i, :], scatter[i] = _fit_pixel(
-                training_intensities[:, i], u_intensities[:, i], lv_array)
+        else:
+            results = (_train_block(intensities, block, *worker_args) \
+                for block in blocks)
+
+        try:
+            for i, block_coefficients, block_scatter in results:
+                start, end = edges[i], edges[i + 1]
+                coefficients[start:end] = block_coefficients
+                scatter[start:end] = block_scatter
+                if checkpoint is not None:
+                    # Only mark the block as done once its results are on disk.
+                    coefficients.flush()
+                    scatter.flush()
+
+                done[i] = True
+                if checkpoint is not None:
+                    done.flush()
+
+                if progressbar:
+                    percent = 100. * done.sum()/done.size
+                    sys.stdout.write("\r[{done}{not_done}] {percent:3.0f}%"\
+                        .format(done="=" * int(percent/2),
+                            not_done=" " * (50 - int(percent/2)),
+                            percent=percent))
+                    sys.stdout.flush()
+
+        finally:
+            if processes > 1:
+                pool.terminate()
+                pool.join()
 
         if progressbar:
                 sys.stdout.write("\r\n")
                 sys.stdout.flush()
 
-        # Save the coefficients, biases, and the label vector description
-        self._cannon_coefficients = coefficients
-        self._cannon_scatter = scatter
-        self._cannon_label_vector = lv
-        self._cannon_offsets = offsets
-        self._cannon_grid_indices = grid_indices
-        del training_intensities
-
+        coefficients, scatter = np.array(coefficients), np.array(scatter)
         return (coefficients, scatter, lv, offsets, grid_indices)
 
 
+
+class _CannonApproximator(object):
+    """
+    Generate Cannon spectra at some labels.
+
+    Spectra generated at a single point can be kept in a least-recently-used
+    cache. The labels are rounded to `tolerance` decimal places, so that labels
+    revisited by the optimiser or the walkers share a spectrum, which is
+    generated at the rounded labels.
+
+    :param coefficients:
+        The Cannon coefficients for each pixel, as an array of shape
+        (N_pixels, N_terms).
+
+    :type coefficients:
+        :class:`numpy.array`
+
+    :param label_vector:
+        The label vector description, as a list of cross terms.
+
+    :type label_vector:
+        list
+
+    :param offsets:
+        The offsets subtracted from the labels.
+
+    :type offsets:
+        :class:`numpy.array`
+
+    :param cache_size: [optional]
+        The maximum memory (in MB) of cached spectra. If it is zero (default)
+        then no spectra are cached.
+
+    :type cache_size:
+        float
+
+    :param tolerance: [optional]
+        The number of decimal places that labels are rounded to in the cache.
+
+    :type tolerance:
+        int
+    """
+
+    def __init__(self, coefficients, label_vector, offsets, cache_size=0,
+        tolerance=3):
+        self.coefficients = coefficients
+        self.label_vector = label_vector
+        self.offsets = offsets
+
+        # The cache is limited to the number of spectra that fit in memory.
+        self.spectrum_nbytes = coefficients.shape[0] * np.dtype(float).itemsize
+        maxsize = int(cache_size * 1024**2 // self.spectrum_nbytes)
+        self._spectrum = None if maxsize <= 0 else \
+            utils.lru_cache(maxsize=maxsize, tol=tolerance)(self._cache_spectrum)
+
+
+    def __call__(self, points):
+        """
+        Return the spectra at some points, as an array of shape
+        (N_points, N_pixels).
+        """
+
+        if self._spectrum is None or np.ndim(points) != 1 \
+        or not np.all(np.isfinite(points)):
+            return self._generate(points)
+        return self._spectrum(*map(float, points))
+
+
+    def _generate(self, points):
+        return np.dot(_build_label_vector_rows(self.label_vector,
+            np.atleast_2d(points) - self.offsets), self.coefficients.T)
+
+
+    def _cache_spectrum(self, *point):
+        spectrum = self._generate(point)
+        spectrum.flags.writeable = False
+        return spectrum
+
+
+    def cache_info(self):
+        """
+        Return the number of hits, misses, maximum size, current size, hit rate
+        and memory (in bytes) of the cache.
+        """
+
+        if self._spectrum is None:
+            return _CannonCacheInfo(0, 0, 0, 0, 0., 0)
+
+        info = self._spectrum.cache_info()
+        return _CannonCacheInfo(info.hits, info.misses, info.maxsize,
+            info.currsize, info.hits/max(info.hits + info.misses, 1),
+            info.currsize * self.spectrum_nbytes)
+
+
+
+def _training_checkpoint(prefix, shape, lv_array, mask, grid_indices):
+    """
+    Open the memory-mapped coefficients, scatter and finished-block flags for
+    a Cannon training checkpoint. They are created (or started again) unless
+    the checkpoint was made for the same training set-up.
+
+    :param prefix:
+        The path prefix of the checkpoint files.
+
+    :type prefix:
+        str
+
+    :param shape:
+        The number of pixels, the number of label vector terms, the number of
+        pixels in each block, and whether the training is vectorised.
+
+    :type shape:
+        tuple
+
+    :returns:
+        The coefficients, scatter and finished-block flags, as memory-mapped
+        arrays.
+    """
+
+    N_pixels, N_terms, batch_size, vectorised = shape
+    N_blocks = int(np.ceil(N_pixels/batch_size))
+    key = md5("{0}".format(shape).encode("utf-8") + lv_array.tobytes()
+        + np.array(mask, dtype=bool).tobytes()
+        + np.array(grid_indices, dtype=np.int64).tobytes()).hexdigest()
+
+    key_path = "{}-key".format(prefix)
+    mode = "r+"
+    if not os.path.exists(key_path) or open(key_path).read() != key:
+        if os.path.exists(key_path):
+            logger.warn("Starting Cannon training again because the checkpoint "
+                "{} was made for a different training set-up".format(prefix))
+        mode = "w+"
+
+    coefficients = np.memmap("{}-coefficients.memmap".format(prefix),
+        dtype=float, mode=mode, shape=(N_pixels, N_terms))
+    scatter = np.memmap("{}-scatter.memmap".format(prefix), dtype=float,
+        mode=mode, shape=(N_pixels, ))
+    done = np.memmap("{}-done.memmap".format(prefix), dtype=bool, mode=mode,
+        shape=(N_blocks, ))
+
+    if mode == "w+":
+        coefficients[:] = np.nan
+        scatter[:] = np.nan
+        done[:] = False
+        for array in (coefficients, scatter, done):
+            array.flush()
+        with open(key_path, "w") as fp:
+            fp.write(key)
+
+    return (coefficients, scatter, done)
+
+
+def _remove_training_checkpoint(prefix):
+    """ Remove the files for a Cannon training checkpoint. """
+
+    for suffix in ("key", "coefficients.memmap", "scatter.memmap",
+        "done.memmap"):
+        path = "{0}-{1}".format(prefix, suffix)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _train_block(intensities, block, grid_indices, lv_array, u_intensities,
+    vectorised=True, pixel_major=False):
+    """
+    Train the coefficients and scatter for a block of consecutive pixels.
+
+    :param intensities:
+        The model intensities of all grid points, or the pixel-major intensities
+        if `pixel_major` is true.
+
+    :param block:
+        The index of the block, the first and last (exclusive) pixel in the
+        block, and the mask for the pixels in the block.
+
+    :type block:
+        tuple
+
+    :returns:
+        The index of the block, and the coefficients and scatter for each pixel
+        in the block. Masked pixels are NaN.
+    """
+
+    i, start, end, mask = block
+    coefficients = np.nan * np.ones((end - start, lv_array.shape[1]))
+    scatter = np.nan * np.ones(end - start)
+    if not np.any(mask):
+        return (i, coefficients, scatter)
+
+    pixels = start + np.where(mask)[0]
+    if pixel_major:
+        block_intensities = np.take(intensities[start:end], grid_indices,
+            axis=1)[mask].T
+    else:
+        block_intensities = intensities[grid_indices, start:end][:, mask]
+    block_u_intensities = np.zeros(block_intensities.shape) \
+        if u_intensities is None else u_intensities[:, pixels]
+
+    if vectorised:
+        coefficients[mask], scatter[mask] = _fit_pixels(block_intensities,
+            block_u_intensities, lv_array)
+
+    else:
+        for j, k in enumerate(np.where(mask)[0]):
+            coefficients[k], scatter[k] = _fit_pixel(block_intensities[:, j],
+                block_u_intensities[:, j], lv_array)
+
+    return (i, coefficients, scatter)
+
+
+_training_worker = {}
+
+def _initialise_training_worker(model, grid_indices, lv_array, u_intensities,
+    vectorised, pixel_major):
+    """
+    Prepare a worker process to train blocks of pixels. Each worker reads the
+    model intensities (or the saved pixel-major intensities) itself.
+    """
+
+    _training_worker.update({
+        "intensities": model._pixel_major_intensities() if pixel_major \
+            else model._intensities(),
+        "args": (grid_indices, lv_array, u_intensities, vectorised,
+            pixel_major)
+    })
+
+
+def _train_block_in_worker(block):
+    """ Train a block of pixels in a worker process. """
+
+    return _train_block(_training_worker["intensities"], block,
+        *_training_worker["args"])
+
+
 def _fit_coefficients(intensities, u_intensities, scatter, lv_array,
     full_output=False):
 
@@ -675,6 +1150,202 @@ def _fit_pixel(intensities, u_intensities, lv_array, debug=False):
         return (coefficients, op_scatter)
 
 
+def _fit_coefficients_batch(intensities, inv_variance, lv_outer, lv_array):
+    """
+    Return the best-fit coefficients at many pixels, given the inverse variance
+    of each training intensity. Pixels where the coefficients cannot be solved
+    for are NaN.
+
+    :param intensities:
+        The training intensities, as an array of shape (N_models, N_pixels).
+
+    :type intensities:
+        :class:`numpy.array`
+
+    :param inv_variance:
+        The inverse variance of the training intensities (including the
+        scatter), with the same shape.
+
+    :type inv_variance:
+        :class:`numpy.array`
+
+    :param lv_outer:
+        The outer product of each row of the label vector array with itself,
+        as an array of shape (N_models, N_terms**2).
+
+    :type lv_outer:
+        :class:`numpy.array`
+
+    :param lv_array:
+        The label vector array, of shape (N_models, N_terms).
+
+    :type lv_array:
+        :class:`numpy.array`
+    """
+
+    N_terms = lv_array.shape[1]
+
+    # Stack the normal equations for all pixels: A^T C^-1 A and A^T C^-1 y.
+    ATCiA = np.dot(inv_variance.T, lv_outer).reshape(-1, N_terms, N_terms)
+    ATCiY = np.dot((intensities * inv_variance).T, lv_array)
+
+    try:
+        return np.linalg.solve(ATCiA, ATCiY[:, :, None])[:, :, 0]
+
+    except np.linalg.LinAlgError:
+        # Solve each pixel separately so only the singular ones are lost.
+        coefficients = np.nan * np.ones(ATCiY.shape)
+        for i in xrange(ATCiY.shape[0]):
+            try:
+                coefficients[i] = np.linalg.solve(ATCiA[i], ATCiY[i])
+            except np.linalg.LinAlgError:
+                continue
+        return coefficients
+
+
+def _fit_pixels(intensities, u_intensities, lv_array, tolerance=1e-4):
+    """
+    Fit the coefficients and scatter at many pixels at once.
+
+    At each pixel the log-likelihood is maximised with respect to the log of the
+    scatter, like :func:`_fit_pixel`, and the coefficients are solved for at
+    each scatter value. Where the intensities have no uncertainties this has an
+    exact solution. Otherwise the maximum is found for all pixels together with
+    :func:`_search_scatter`.
+
+    :param intensities:
+        The training intensities, as an array of shape (N_models, N_pixels).
+
+    :type intensities:
+        :class:`numpy.array`
+
+    :param u_intensities:
+        The uncertainties in the training intensities, with the same shape.
+
+    :type u_intensities:
+        :class:`numpy.array`
+
+    :param lv_array:
+        The label vector array, of shape (N_models, N_terms).
+
+    :type lv_array:
+        :class:`numpy.array`
+
+    :param tolerance: [optional]
+        The tolerance in the log-scatter.
+
+    :type tolerance:
+        float
+
+    :returns:
+        The coefficients, as an array of shape (N_pixels, N_terms), and the
+        scatter at each pixel. Pixels where the coefficients cannot be solved
+        for have zero coefficients and a very large scatter.
+    """
+
+    intensities = np.asarray(intensities, dtype=float)
+    u_intensities = np.asarray(u_intensities, dtype=float)
+
+    N_pixels, N_terms = intensities.shape[1], lv_array.shape[1]
+    coefficients = np.nan * np.ones((N_pixels, N_terms))
+    scatter = np.nan * np.ones(N_pixels)
+
+    # Without uncertainties in the intensities the coefficients do not depend on
+    # the scatter, and the most likely scatter is the rms of the residuals.
+    exact = ~np.any(u_intensities, axis=0)
+    if np.any(exact):
+        try:
+            coefficients[exact] = np.linalg.solve(np.dot(lv_array.T, lv_array),
+                np.dot(lv_array.T, intensities[:, exact])).T
+        except np.linalg.LinAlgError:
+            # These pixels are logged and given a giant scatter below.
+            pass
+        scatter[exact] = np.sqrt(np.mean((intensities[:, exact] \
+            - np.dot(lv_array, coefficients[exact].T))**2, axis=0))
+
+    if not np.all(exact):
+        coefficients[~exact], scatter[~exact] = _search_scatter(
+            intensities[:, ~exact], u_intensities[:, ~exact], lv_array,
+            tolerance)
+
+    # As in _fit_pixel, send back zeros and a giant scatter for any pixels that
+    # we could not solve for.
+    failed = ~np.all(np.isfinite(coefficients), axis=1)
+    if np.any(failed):
+        logger.warn("Failed to calculate coefficients at {0} pixels".format(
+            failed.sum()))
+        coefficients[failed] = 0
+        scatter[failed] = 10e8
+
+    return (coefficients, scatter)
+
+
+def _search_scatter(intensities, u_intensities, lv_array, tolerance=1e-4):
+    """
+    Find the most likely scatter at many pixels, where the training intensities
+    have uncertainties. The log-likelihood is first calculated on a coarse grid
+    of log-scatter values, then a golden-section search is made around the best
+    grid value.
+
+    :returns:
+        The coefficients, as an array of shape (N_pixels, N_terms), and the
+        scatter at each pixel. The coefficients are NaN where they could not be
+        solved for.
+    """
+
+    N_models, N_terms = lv_array.shape
+    lv_outer = (lv_array[:, :, None] * lv_array[:, None, :]).reshape(N_models,
+        -1)
+
+    u_variance = u_intensities**2
+
+    def inv_variance(ln_scatter):
+        return 1./(u_variance + np.exp(2 * ln_scatter))
+
+    def ln_likelihood(ln_scatter):
+        ivar = inv_variance(ln_scatter)
+        coefficients = _fit_coefficients_batch(intensities, ivar, lv_outer,
+            lv_array)
+        residuals = intensities - np.dot(lv_array, coefficients.T)
+        values = -0.5 * np.sum(residuals**2 * ivar - np.log(ivar), axis=0)
+        values[~np.isfinite(values)] = -np.inf
+        return values
+
+    # Get an initial guess of the scatter, as in _fit_pixel.
+    scatter = np.var(intensities, axis=0) - np.median(u_intensities, axis=0)**2
+    scatter = np.where(scatter >= 0, np.sqrt(np.abs(scatter)),
+        np.std(intensities, axis=0))
+    with np.errstate(divide="ignore"):
+        ln_scatter = np.log(scatter)
+    ln_scatter[~np.isfinite(ln_scatter)] = np.log(tolerance)
+
+    # The scatter about the model can be much smaller than the initial guess.
+    step = 2.
+    offsets = np.arange(-20, 4 + step, step)
+    grid = np.array([ln_likelihood(ln_scatter + o) for o in offsets])
+    ln_scatter = ln_scatter + offsets[np.argmax(grid, axis=0)]
+
+    # Golden-section search between the neighbouring grid values.
+    ratio = (np.sqrt(5) - 1)/2.
+    a, b = ln_scatter - step, ln_scatter + step
+    c, d = b - ratio * (b - a), a + ratio * (b - a)
+    f_c, f_d = ln_likelihood(c), ln_likelihood(d)
+    while np.max(b - a) > tolerance:
+        lower = f_c > f_d
+        a, b = np.where(lower, a, c), np.where(lower, d, b)
+        x = np.where(lower, b - ratio * (b - a), a + ratio * (b - a))
+        f_x = ln_likelihood(x)
+        c, d, f_c, f_d = np.where(lower, x, d), np.where(lower, c, x), \
+            np.where(lower, f_x, f_d), np.where(lower, f_c, f_x)
+
+    ln_scatter = (a + b)/2.
+    scatter = np.exp(ln_scatter)
+    coefficients = _fit_coefficients_batch(intensities,
+        inv_variance(ln_scatter), lv_outer, lv_array)
+
+    return (coefficients, scatter)
+
+
 def _build_label_vector_rows(label_vector, labels):
     labels = np.atleast_2d(labels)
     columns = [np.ones(labels.shape[0])]
@@ -687,6 +1358,158 @@ def _build_label_vector_rows(label_vector, labels):
     return np.vstack(columns).T
 
 
+def _label_vector_exponents(label_vector, N_labels):
+    """
+    Return the exponent of each label in each term of the label vector (except
+    the constant term), as an integer array of shape (N_terms - 1, N_labels).
+    """
+
+    exponents = np.zeros((len(label_vector), N_labels), dtype=int)
+    for i, cross_terms in enumerate(label_vector):
+        for index, order in cross_terms:
+            exponents[i, index] += order
+    return exponents
+
+
+def _build_label_vector_derivatives(label_vector, labels, second=False):
+    """
+    Return the derivatives of a label vector row with respect to each label, as
+    an array of shape (N_terms, N_labels). If `second` is true then also return
+    the second derivatives, as an array of shape (N_terms, N_labels, N_labels).
+
+    :param label_vector:
+        The label vector description, as a list of cross terms.
+
+    :type label_vector:
+        list
+
+    :param labels:
+        The labels to calculate the derivatives at.
+
+    :type labels:
+        :class:`numpy.array`
+    """
+
+    labels = np.atleast_1d(labels)
+    N_labels = labels.size
+    exponents = _label_vector_exponents(label_vector, N_labels)
+    identity = np.eye(N_labels, dtype=int)
+
+    # Differentiating a term by a label multiplies it by the exponent of that
+    # label, and reduces the exponent by one. (Terms without that label have a
+    # zero multiplier, so their negative exponents are clipped.)
+    derivatives = np.zeros((1 + len(label_vector), N_labels))
+    d_exponents = exponents[:, None, :] - identity
+    derivatives[1:] = exponents * np.prod(
+        labels**np.clip(d_exponents, 0, None), axis=2)
+
+    if not second:
+        return derivatives
+
+    second_derivatives = np.zeros((1 + len(label_vector), N_labels, N_labels))
+    dd_exponents = d_exponents[:, :, None, :] - identity
+    second_derivatives[1:] = exponents[:, :, None] * d_exponents * np.prod(
+        labels**np.clip(dd_exponents, 0, None), axis=3)
+    return (derivatives, second_derivatives)
+
+
+def _gauss_newton_labels(A, B, label_vector, p0, tolerance=1e-10,
+    max_iterations=100):
+    """
+    Solve for the labels that minimise the chi-squared difference between the
+    Cannon model and the data, with damped Gauss-Newton (Levenberg-Marquardt)
+    iterations.
+
+    For coefficients C and inverse variances W, the chi-squared at label vector
+    row v is v^T A v - 2 v^T B (plus a constant), where A = C^T W C and
+    B = C^T W y, so each iteration only depends on the number of terms. Because
+    the label vector is a polynomial of the labels, the second-order term that
+    Gauss-Newton ignores can also be calculated analytically. It is added once
+    the chi-squared changes by less than one between iterations, which stops the
+    iterations from zig-zagging near the minimum when the model does not fit the
+    data exactly. (Far from the minimum it can lead to spurious solutions.)
+
+    :param A:
+        The coefficients weighted by the inverse variances, multiplied by the
+        coefficients, as an array of shape (N_terms, N_terms).
+
+    :type A:
+        :class:`numpy.array`
+
+    :param B:
+        The coefficients weighted by the inverse variances, multiplied by the
+        data, as an array of shape (N_terms, ).
+
+    :type B:
+        :class:`numpy.array`
+
+    :param label_vector:
+        The label vector description, as a list of cross terms.
+
+    :type label_vector:
+        list
+
+    :param p0:
+        The initial labels.
+
+    :type p0:
+        :class:`numpy.array`
+
+    :returns:
+        The labels and their covariance matrix. If the covariance matrix cannot
+        be calculated then every entry is infinite, as with
+        :func:`scipy.optimize.curve_fit`.
+    """
+
+    def chi_sq(labels):
+        row = _build_label_vector_rows(label_vector, labels)[0]
+        return (np.dot(row, np.dot(A, row)) - 2 * np.dot(row, B), row)
+
+    labels = np.array(p0, dtype=float)
+    value, row = chi_sq(labels)
+    damping, second_order = 1e-3, False
+    for iteration in xrange(max_iterations):
+        residual = np.dot(A, row) - B
+        if second_order:
+            derivatives, second_derivatives = _build_label_vector_derivatives(
+                label_vector, labels, second=True)
+        else:
+            derivatives = _build_label_vector_derivatives(label_vector, labels)
+
+        gradient = np.dot(derivatives.T, residual)
+        gauss_newton = np.dot(derivatives.T, np.dot(A, derivatives))
+        hessian = gauss_newton + np.tensordot(residual, second_derivatives, 1) \
+            if second_order else gauss_newton
+        scale = np.diag(np.abs(np.diag(gauss_newton)))
+
+        while True:
+            try:
+                step = -np.linalg.solve(hessian + damping * scale, gradient)
+            except np.linalg.LinAlgError:
+                step = np.nan * gradient
+            new_value, new_row = chi_sq(labels + step)
+            if new_value <= value or damping > 1e10:
+                break
+            damping *= 10
+
+        if not new_value <= value:
+            break
+
+        second_order = second_order or value - new_value < 1
+        labels, value, row = labels + step, new_value, new_row
+        damping = max(damping/10, 1e-10)
+        if np.all(np.abs(step) <= tolerance * (np.abs(labels) + tolerance)):
+            break
+
+    derivatives = _build_label_vector_derivatives(label_vector, labels)
+    try:
+        covariance = np.linalg.inv(
+            np.dot(derivatives.T, np.dot(A, derivatives)))
+    except np.linalg.LinAlgError:
+        covariance = np.inf * np.ones((labels.size, labels.size))
+    return (labels, covariance)
+
+
 def _build_label_vector_array(grid_points, label_vector, N=None, limits=None,
     pivot=True):
 
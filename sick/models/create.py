@@ -19,6 +19,7 @@ from astropy.io import fits
 from astropy.table import Table
 
 from sick import __version__ as sick_version
+from sick.models import storage
 
 logger = logging.getLogger("sick")
 
@@ -47,16 +48,26 @@ def load_simple_data(filename, **kwargs):
 
 
 def create(output_prefix, grid_flux_filename, wavelength_filenames,
-    clobber=False, grid_flux_filename_format="csv", **kwargs):
+    clobber=False, grid_flux_filename_format="csv", intensities_format="memmap",
+    **kwargs):
     """
     Create a new *sick* model from files describing the parameter names, fluxes,
     and wavelengths.
+
+    The intensities are stored as a single memory-mapped array by default. With
+    `intensities_format="chunked"` they are stored in chunks of grid points and
+    channels, and the `intensities_options` keyword argument can be used to set
+    the chunk size, data type, and compression (see
+    :class:`sick.models.storage.ChunkedIntensitiesWriter`).
     """
 
+    intensities_filename = output_prefix + storage.suffixes[intensities_format]
+    intensities_options = kwargs.pop("intensities_options", {})
+
     if not clobber:
         # Check to make sure the output files won't exist already.
         output_suffixes = (".yaml", ".pkl", "-wavelengths.memmap",
-            "-intensities.memmap")
+            storage.suffixes[intensities_format])
         for path in [output_prefix + suffix for suffix in output_suffixes]:
             if os.path.exists(path):
                 raise IOError("output filename {} already exists".format(path))
@@ -109,7 +120,8 @@ def create(output_prefix, grid_flux_filename, wavelength_filenames,
             ])
         fp.write(header + "\n" + yaml.safe_dump({ "model_grid": {
                 "grid_points": output_prefix + ".pkl",
-                "intensities": output_prefix + "-intensities.memmap",
+                "intensities": intensities_filename,
+                "intensities_format": intensities_format,
                 "wavelengths": output_prefix + "-wavelengths.memmap"
             }}, stream=None, allow_unicode=True, default_flow_style=False))
 
@@ -134,11 +146,11 @@ def create(output_prefix, grid_flux_filename, wavelength_filenames,
     wavelengths_memmap.flush()
     del wavelengths_memmap
 
-    # Create the memory-mapped intensities file.
-    logger.debug("Creating memory-mapped intensities file.")
-    intensities_memmap = np.memmap(output_prefix + "-intensities.memmap",
-        shape=(grid_points.size, num_pixels), dtype="float32",
-        mode="w+")
+    # Create the intensities file.
+    logger.debug("Creating {} intensities file.".format(intensities_format))
+    intensities_memmap = storage.create_intensities(intensities_filename,
+        shape=(grid_points.size, num_pixels), channel_sizes=channel_sizes,
+        format=intensities_format, **intensities_options)
     
     n = len(grid_flux_tbl)
     for i, row in enumerate(grid_flux_tbl):
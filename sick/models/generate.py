@@ -1,21 +1,149 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-""" Global hacky approximator stuff. """
+""" Spectrum engines that hold the approximator and convolution functions. """
 
 from __future__ import division, print_function
 
+__all__ = ("SpectrumEngine", )
 __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
 import logging
+import threading
 
 logger = logging.getLogger("sick")
 
-# Now you're thinking with portals!
-def init():
-    logger.debug("Initialising approximator.")
-    global wavelengths, intensities, variances, binning_matrices
-    wavelengths = []
-    intensities = []
-    variances = [0] # In case no variances are set by whatever the model is.
-    binning_matrices = [None]
\ No newline at end of file
+
+class SpectrumEngine(object):
+    """
+    The spectrum approximator and convolution functions used to generate model
+    spectra for one fit.
+
+    Each model has a default engine, but an engine can be given to
+    :func:`sick.models.Model.optimise` and :func:`sick.models.Model.infer` so
+    that several stars can be fit at once (e.g., in threads), with one engine
+    for each concurrent fit. An engine can be reused for many stars one after
+    another: it is replaced whenever the approximator or the convolution
+    functions are created again. Access to the engine is serialised with a
+    lock, so the approximator and its wavelengths are always read together.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset()
+
+
+    def reset(self):
+        """ Remove the approximator and the convolution functions. """
+
+        with self._lock:
+            self.wavelengths = None
+            self.intensities = None
+            self.variances = 0
+            self.subset_bounds = None
+            self.trained_model = None
+            self.convolution_functions = None
+
+
+    @property
+    def initialised(self):
+        """ Return whether the approximator has been created. """
+        return self.intensities is not None
+
+
+    def set_approximator(self, wavelengths, intensities, variances=0,
+        subset_bounds=None, trained_model=None):
+        """
+        Set the approximator. Any existing convolution functions are removed,
+        because they may have been created for other model wavelengths.
+
+        :param wavelengths:
+            The model wavelengths that the approximator produces.
+
+        :type wavelengths:
+            :class:`numpy.array`
+
+        :param intensities:
+            A callable that takes a point in the grid parameters and returns the
+            approximate model intensities at those wavelengths.
+
+        :type intensities:
+            callable
+
+        :param variances: [optional]
+            The variance in the approximate model intensities.
+
+        :type variances:
+            float or :class:`numpy.array`
+
+        :param subset_bounds: [optional]
+            The range of each grid parameter that the approximator covers.
+
+        :type subset_bounds:
+            dict
+
+        :param trained_model: [optional]
+            Anything the approximator was trained to (e.g., the coefficients of
+            a locally-trained Cannon model), so that it belongs to this engine
+            and not to the model.
+        """
+
+        logger.debug("Initialising approximator.")
+        with self._lock:
+            self.wavelengths = wavelengths
+            self.intensities = intensities
+            self.variances = variances
+            self.subset_bounds = subset_bounds
+            self.trained_model = trained_model
+            self.convolution_functions = None
+
+
+    def approximator(self):
+        """
+        Return the model wavelengths, the approximator, and the model
+        variances.
+
+        :raises:
+            RuntimeError if the approximator has not been created.
+        """
+
+        with self._lock:
+            if not self.initialised:
+                raise RuntimeError("the approximator has not been initialised")
+            return (self.wavelengths, self.intensities, self.variances)
+
+
+    def set_convolution_functions(self, convolution_functions):
+        """
+        Set the convolution functions for each observed channel, or remove
+        them if `convolution_functions` is None.
+
+        :param convolution_functions:
+            A convolution function (or None) for each observed channel.
+
+        :type convolution_functions:
+            list of callables
+        """
+
+        with self._lock:
+            self.convolution_functions = convolution_functions
+
+
+    def convolution_function(self, index):
+        """
+        Return the convolution function for an observed channel.
+
+        :param index:
+            The index of the observed channel.
+
+        :type index:
+            int
+
+        :raises:
+            RuntimeError if no convolution functions have been created.
+        """
+
+        with self._lock:
+            if self.convolution_functions is None:
+                raise RuntimeError("no convolution functions have been created")
+            return self.convolution_functions[index]
@@ -7,29 +7,352 @@ from __future__ import division, print_function
 
 __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
+import cPickle as pickle
 import logging
+import os
+import threading
+from collections import OrderedDict
+from hashlib import md5
+from itertools import product
 
 import numpy as np
-from scipy import interpolate
+from scipy import (sparse, spatial)
 
-import generate
 from model import Model
-from .. import specutils
+from .. import (specutils, utils)
 
 logger = logging.getLogger("sick")
 
+# Triangulations of grid subsets that have been used in this process, keyed by
+# the model hash and the grid indices.
+_triangulations = OrderedDict()
+_triangulations_lock = threading.Lock()
+_MAX_TRIANGULATIONS = 8
+
+
+def _regular_grid(grid_points):
+    """
+    Return the unique values along each axis of the grid, and an array that maps
+    each combination of axis indices to a row in the grid, if every combination
+    exists exactly once. Otherwise return None.
+
+    :param grid_points:
+        The grid points as an array of shape (N_points, N_dimensions).
+
+    :type grid_points:
+        :class:`numpy.array`
+    """
+
+    axes = [np.unique(grid_points[:, i]) for i in range(grid_points.shape[1])]
+    if np.prod([axis.size for axis in axes]) != grid_points.shape[0]:
+        return None
+
+    indices = np.array([axis.searchsorted(grid_points[:, i]) \
+        for i, axis in enumerate(axes)])
+    lookup = -np.ones([axis.size for axis in axes], dtype=int)
+    lookup[tuple(indices)] = np.arange(grid_points.shape[0])
+    if np.any(lookup < 0):
+        return None
+    return (axes, lookup)
+
+
+
+class _LazyInterpolator(object):
+    """
+    A base class for interpolators that read grid spectra from the model
+    intensities only when they are needed. The most recently used spectra are
+    kept in a cache of bounded size, so that memory use does not depend on the
+    size of the grid.
+
+    :param intensities:
+        The model intensities for the entire grid.
+
+    :type intensities:
+        :class:`numpy.memmap` or :class:`storage.ChunkedIntensities`
+
+    :param pixels: [optional]
+        The indices of the pixels to interpolate. By default all pixels are
+        interpolated.
+
+    :type pixels:
+        :class:`numpy.array`
+
+    :param mask: [optional]
+        A boolean mask of the pixels to interpolate. Pixels outside the mask
+        are returned as non-finite values. If `pixels` is given then the mask
+        should have the same size.
+
+    :type mask:
+        :class:`numpy.array`
+
+    :param cache_size: [optional]
+        The maximum number of grid spectra to keep in memory.
+
+    :type cache_size:
+        int
+    """
+
+    def __init__(self, intensities, pixels=None, mask=None, cache_size=256):
+        self.intensities = intensities
+        self.mask = mask
+
+        # Read a contiguous range of pixels as a slice.
+        if pixels is None:
+            pixels = slice(None)
+        elif len(pixels) > 0 and pixels[-1] - pixels[0] + 1 == len(pixels):
+            pixels = slice(pixels[0], pixels[-1] + 1)
+        self.pixels = pixels
+        self.num_pixels = np.arange(intensities.shape[1])[pixels].size
+
+        self._spectrum = utils.lru_cache(maxsize=cache_size)(self._read_spectrum)
+
+
+    def _read_spectrum(self, index):
+        """ Read the (masked) spectrum of a grid point from the intensities. """
+
+        spectrum = np.array(self.intensities[index, self.pixels],
+            dtype=np.float32)
+        if self.mask is not None:
+            spectrum[~self.mask] = np.nan
+        return spectrum
+
+
+    def _weights(self, points):
+        """
+        Return the intensities rows and interpolation weights needed for each
+        point, and whether each point can be interpolated.
+
+        :param points:
+            An array of shape (N_points, N_dimensions).
+
+        :type points:
+            :class:`numpy.array`
+
+        :returns:
+            The rows and weights as arrays of shape (N_points, N_vertices), and
+            a boolean array of shape (N_points, ).
+        """
+        raise NotImplementedError("this should be overwritten in a subclass")
+
+
+    def __call__(self, *point):
+
+        point = np.array(point, dtype=float).flatten()
+        rows, weights, valid = self._weights(point.reshape(1, -1))
+        if not valid[0]:
+            return np.nan * np.ones(self.num_pixels)
+
+        intensities = np.zeros(self.num_pixels)
+        for row, weight in zip(rows[0], weights[0]):
+            if weight > 0:
+                intensities += weight * self._spectrum(int(row))
+        return intensities
+
+
+    def batch(self, points):
+        """
+        Interpolate spectra at many points at once.
+
+        The interpolation weights for all points are computed together and
+        stored in a sparse matrix of shape (N_points, N_spectra), where
+        N_spectra is the number of unique grid spectra that are needed. The
+        interpolated spectra are the product of this matrix and the stacked grid
+        spectra, and each grid spectrum is only read once.
+
+        :param points:
+            An array of shape (N_points, N_dimensions).
+
+        :type points:
+            :class:`numpy.array`
+
+        :returns:
+            An array of shape (N_points, N_pixels). Rows for points that cannot
+            be interpolated are non-finite.
+        """
+
+        points = np.atleast_2d(np.array(points, dtype=float))
+        rows, weights, valid = self._weights(points)
+
+        use = valid[:, None] * (weights > 0)
+        unique_rows, columns = np.unique(rows[use], return_inverse=True)
+        matrix = sparse.csr_matrix((weights[use], (np.where(use)[0], columns)),
+            shape=(points.shape[0], unique_rows.size))
+
+        spectra = np.zeros((unique_rows.size, self.num_pixels))
+        for i, row in enumerate(unique_rows):
+            spectra[i] = self._spectrum(int(row))
+
+        intensities = matrix.dot(spectra)
+        intensities[~valid] = np.nan
+        return intensities
+
+
+    def cache_info(self):
+        """
+        Return the number of hits, misses, maximum size and current size of the
+        cache of grid spectra.
+        """
+        return self._spectrum.cache_info()
+
+
+
+class MultilinearInterpolator(_LazyInterpolator):
+    """
+    Linearly interpolate spectra on a regular (rectilinear) grid.
+
+    The spectra at the (at most) 2^D corners of the grid cell that bracket a
+    point are read from the model intensities when the interpolator is called,
+    so no triangulation is required and only those spectra are read.
+
+    :param axes:
+        The unique values along each axis of the grid.
+
+    :type axes:
+        list of :class:`numpy.array`
+
+    :param lookup:
+        An array that maps each combination of axis indices to a row in the
+        intensities.
+
+    :type lookup:
+        :class:`numpy.array`
+
+    Any additional arguments are passed to :class:`_LazyInterpolator`.
+    """
+
+    def __init__(self, axes, lookup, intensities, **kwargs):
+        super(MultilinearInterpolator, self).__init__(intensities, **kwargs)
+        self.axes = axes
+        self.lookup = lookup
+        self._corners = np.array(list(product((0, 1), repeat=len(axes))))
+
+
+    def _weights(self, points):
+
+        if points.shape[1] != len(self.axes):
+            raise ValueError("expected a point with {0} dimensions but got {1}"\
+                .format(len(self.axes), points.shape[1]))
+
+        valid = np.all(np.isfinite(points), axis=1)
+        for x, axis in zip(points.T, self.axes):
+            with np.errstate(invalid="ignore"):
+                valid *= (axis[-1] >= x) * (x >= axis[0])
+
+        # Find the lower corner of the grid cell and the fractional distance
+        # along each axis. Axes with a single value are never interpolated.
+        lower = np.zeros(points.shape, dtype=int)
+        t = np.zeros(points.shape)
+        for i, axis in enumerate(self.axes):
+            if axis.size > 1:
+                x = np.where(valid, points[:, i], axis[0])
+                lower[:, i] = np.clip(axis.searchsorted(x, side="right") - 1,
+                    0, axis.size - 2)
+                t[:, i] = (x - axis[lower[:, i]]) \
+                    / (axis[lower[:, i] + 1] - axis[lower[:, i]])
+
+        weights = np.prod(np.where(self._corners[None, :, :],
+            t[:, None, :], 1 - t[:, None, :]), axis=2)
+        corners = np.minimum(lower[:, None, :] + self._corners[None, :, :],
+            np.array(self.lookup.shape) - 1)
+        rows = self.lookup[tuple(np.rollaxis(corners, 2))]
+        return (rows, weights, valid)
+
+
+
+class DelaunayInterpolator(_LazyInterpolator):
+    """
+    Linearly interpolate spectra on an irregular grid using a Delaunay
+    triangulation of the grid points.
+
+    Only the grid points are triangulated. The spectra at the vertices of the
+    simplex that contains a point are read from the model intensities when the
+    interpolator is called, and are combined with barycentric weights.
+
+    :param points:
+        The grid points to triangulate, as an array of shape
+        (N_points, N_dimensions).
+
+    :type points:
+        :class:`numpy.array`
+
+    :param indices:
+        The row in the intensities for each of the grid points.
+
+    :type indices:
+        :class:`numpy.array`
+
+    :param rescale: [optional]
+        Rescale the grid points to a unit hypercube before triangulating.
+
+    :type rescale:
+        bool
+
+    :param triangulation: [optional]
+        A previously computed triangulation of the (rescaled) grid points.
+
+    :type triangulation:
+        :class:`scipy.spatial.Delaunay`
+
+    Any additional arguments are passed to :class:`_LazyInterpolator`.
+    """
+
+    def __init__(self, points, indices, intensities, rescale=True,
+        triangulation=None, **kwargs):
+        super(DelaunayInterpolator, self).__init__(intensities, **kwargs)
+
+        points = np.atleast_2d(points)
+        self.indices = np.array(indices)
+        if rescale:
+            self._offset = points.min(axis=0)
+            self._scale = np.ptp(points, axis=0)
+            self._scale[self._scale == 0] = 1.
+        else:
+            self._offset, self._scale = (0., 1.)
+
+        if triangulation is None:
+            triangulation = spatial.Delaunay((points - self._offset)/self._scale)
+        self.triangulation = triangulation
+
+
+    def _weights(self, points):
+
+        points = (points - self._offset)/self._scale
+        finite = np.all(np.isfinite(points), axis=1)
+        simplices = -np.ones(points.shape[0], dtype=int)
+        if np.any(finite):
+            simplices[finite] = self.triangulation.find_simplex(points[finite])
+        valid = simplices >= 0
+        simplices[~valid] = 0
+
+        # Barycentric coordinates of each point in its simplex.
+        D = points.shape[1]
+        transform = self.triangulation.transform[simplices]
+        weights = np.einsum("ijk,ik->ij", transform[:, :D],
+            np.where(valid[:, None], points, 0) - transform[:, D])
+        weights = np.hstack([weights, 1 - weights.sum(axis=1)[:, None]])
+        weights[~valid] = 0
+
+        rows = self.indices[self.triangulation.simplices[simplices]]
+        return (rows, weights, valid)
+
+
+
 class InterpolationModel(Model):
 
     def _initialise_approximator(self, closest_point=None,
-        wavelengths_required=None, rescale=True, **kwargs):
+        wavelengths_required=None, rescale=True, engine=None, **kwargs):
         """
-        Initialise a spectrum interpolator.
+        Initialise a spectrum interpolator in the given engine, or the model's
+        default engine.
         """
 
-        if self._initialised and not kwargs.get("force", False):
+        if engine is None:
+            engine = self.engine
+
+        if engine.initialised and not kwargs.get("force", False):
             logger.debug("Ignoring call to re-initialise approximator because "
                 "we already have.")
-            return self._subset_bounds
+            return engine.subset_bounds
 
 
         logger.info("Initialising approximator near {0}".format(closest_point))
@@ -54,9 +377,8 @@ class InterpolationModel(Model):
                 grid_subset))
 
             # Use closest N points.
-            distance = np.sum(np.abs(grid_points - closest_point)/
-                np.ptp(grid_points, axis=0), axis=1)
-            grid_indices = np.argsort(distance)[:grid_subset]
+            grid_indices = self._nearest_grid_indices(closest_point,
+                grid_subset)
 
         else:
             grid_indices = np.ones(N, dtype=bool)
@@ -72,41 +394,157 @@ class InterpolationModel(Model):
         else:
             mask = np.ones(self.wavelengths.size, dtype=bool)
 
+        # Only the required pixels will be interpolated. We keep one (masked)
+        # pixel either side of each window so that nothing will be interpolated
+        # across the gaps between windows.
+        pixels = mask.copy()
+        pixels[:-1] |= mask[1:]
+        pixels[1:] |= mask[:-1]
+        pixels = np.where(pixels)[0]
+
         # Apply model masks.
         mask *= self._model_mask()
+        mask = mask[pixels]
+
+        # Use a multilinear interpolator if the grid is regular, otherwise
+        # triangulate the grid.
+        kind = self._configuration.get("settings", {}).get("interpolator",
+            "auto").lower()
+        if kind not in ("auto", "regular", "delaunay"):
+            raise ValueError("interpolator must be `auto`, `regular`, or "
+                "`delaunay`")
+
+        regular_grid = _regular_grid(grid_points) if kind != "delaunay" \
+            else None
+        if regular_grid is None and kind == "regular":
+            raise ValueError("a regular grid interpolator was requested but "
+                "the grid points are not on a regular grid")
+
+        # Spectra are only read from the intensities when they are needed, and
+        # a limited number of them are kept in memory.
+        kwds = {
+            "pixels": pixels,
+            "mask": mask,
+            "cache_size": self._configuration.get("settings", {}).get(
+                "interpolator_cache_size", 256)
+        }
+        if regular_grid is not None:
+            # The bounding box of the grid subset is also a regular grid.
+            axes, lookup = regular_grid
+            points = grid_points[grid_indices]
+            ranges = [np.where((axis >= lower) * (upper >= axis))[0] \
+                for axis, lower, upper \
+                in zip(axes, points.min(axis=0), points.max(axis=0))]
+            axes = [axis[r] for axis, r in zip(axes, ranges)]
+            lookup = lookup[np.ix_(*ranges)]
+
+            logger.debug("Using a multilinear interpolator on a regular grid "
+                "with shape {}".format(lookup.shape))
+            interpolator = MultilinearInterpolator(axes, lookup,
+                intensities=self._intensities(), **kwds)
 
-        # Slice small part of the intensities grid.
-        intensities = np.memmap(
-            self._configuration["model_grid"]["intensities"],
-            dtype="float32", mode="r", shape=(N, self.wavelengths.size))
-        subset = np.copy(intensities[grid_indices, :])
-        subset[:, ~mask] = np.nan
-        del intensities
-
-        # Create an interpolator.
-        try:
-            interpolator = interpolate.LinearNDInterpolator(
-                grid_points[grid_indices], subset, rescale=rescale)
-
-        except TypeError:
-            logger.warn("Could not rescale the LinearNDInterpolator because "\
-                "you need a newer version of scipy")
-            interpolator = interpolate.LinearNDInterpolator(
-                grid_points[grid_indices], subset)
-
-        generate.init()
-        generate.wavelengths.append(self.wavelengths)
-        generate.intensities.append(interpolator)
-        
-        self._initialised = True
+        else:
+            indices = np.sort(np.arange(N)[grid_indices])
+            interpolator = DelaunayInterpolator(grid_points[indices], indices,
+                intensities=self._intensities(), rescale=rescale,
+                triangulation=self._triangulation(grid_points, indices,
+                    rescale), **kwds)
 
         # Return the subset boundaries of the grid.
-        self._subset_bounds = {}
+        subset_bounds = {}
         for name in self.grid_points.dtype.names:
             points = self.grid_points[name][grid_indices]
-            self._subset_bounds[name] = (min(points), max(points))
+            subset_bounds[name] = (min(points), max(points))
+
+        engine.set_approximator(self.wavelengths[pixels], interpolator,
+            subset_bounds=subset_bounds)
+        return subset_bounds
+
+
+    def _triangulation(self, grid_points, indices, rescale=True):
+        """
+        Return the Delaunay triangulation of a subset of the grid points.
+
+        Triangulations are kept in memory for this process, and if the
+        `persist_triangulation` setting is true then they are also saved next to
+        the model intensities. They are keyed by the model hash and the grid
+        indices, so the geometry is only computed once for each grid subset.
+
+        :param grid_points:
+            The grid points as an array of shape (N_points, N_dimensions).
+
+        :type grid_points:
+            :class:`numpy.array`
+
+        :param indices:
+            The sorted indices of the grid points to triangulate.
 
-        return self._subset_bounds
+        :type indices:
+            :class:`numpy.array`
+
+        :param rescale: [optional]
+            Rescale the grid points to a unit hypercube before triangulating.
+
+        :type rescale:
+            bool
+        """
+
+        key = md5("{0}-{1}".format(self.hash, rescale).encode("utf-8")
+            + np.array(indices, dtype=np.int64).tobytes()).hexdigest()
+        with _triangulations_lock:
+            try:
+                triangulation = _triangulations.pop(key)
+
+            except KeyError:
+                pass
+
+            else:
+                _triangulations[key] = triangulation
+                return triangulation
+
+        persist = self._configuration.get("settings", {}).get(
+            "persist_triangulation", False)
+        path = "{0}-delaunay-{1}.pkl".format(os.path.splitext(
+            self._configuration["model_grid"]["intensities"])[0], key)
+
+        triangulation = None
+        if persist and os.path.exists(path):
+            with open(path, "rb") as fp:
+                triangulation = pickle.load(fp)
+            logger.debug("Loaded triangulation of {0} grid points from {1}"\
+                .format(len(indices), path))
+
+        if triangulation is None:
+            points = grid_points[indices]
+            if rescale:
+                scale = np.ptp(points, axis=0)
+                scale[scale == 0] = 1.
+                points = (points - points.min(axis=0))/scale
+
+            triangulation = spatial.Delaunay(points)
+            triangulation.transform # Compute this now so that it is cached.
+
+            if persist:
+                with open(path, "wb") as fp:
+                    pickle.dump(triangulation, fp, -1)
+                logger.debug("Saved triangulation of {0} grid points to {1}"\
+                    .format(len(indices), path))
+
+        with _triangulations_lock:
+            _triangulations[key] = triangulation
+            if len(_triangulations) > _MAX_TRIANGULATIONS:
+                _triangulations.popitem(last=False)
+        return triangulation
+
+
+    def cache_info(self, engine=None):
+        """
+        Return the number of hits, misses, maximum size and current size of the
+        cache of grid spectra used by the approximator in the given engine, or
+        the model's default engine.
+        """
+        return (self.engine if engine is None else engine).intensities\
+            .cache_info()
 
 
     def _approximate_intensities(self, theta, data, debug=False, **kwargs):
@@ -124,11 +562,11 @@ class InterpolationModel(Model):
         else:
             # Generate intensities at the astrophysical point.   
             try:
-                # Get the wavelengths.
-                model_wavelengths = generate.wavelengths[-1]
+                # Get the wavelengths and the interpolator.
+                model_wavelengths, func, _ \
+                    = (kwargs.get("engine", None) or self.engine).approximator()
                 
                 # Generate intensities.
-                func = generate.intensities[-1]
                 model_intensities = func(*[theta.get(p, np.nan) \
                     for p in self.grid_points.dtype.names]).flatten()
                 model_variances = np.zeros_like(model_wavelengths)
@@ -140,3 +578,24 @@ class InterpolationModel(Model):
 
         return (model_wavelengths, model_intensities, model_variances)
 
+
+    def _approximate_intensities_batch(self, theta, data, debug=False,
+        **kwargs):
+        """
+        Interpolate model intensities at many points at once.
+        """
+
+        N = max([np.size(value) for value in theta.values()] + [1])
+        points = np.array([theta.get(p, np.nan) * np.ones(N) \
+            for p in self.grid_points.dtype.names]).T
+
+        model_wavelengths, func, _ \
+            = (kwargs.get("engine", None) or self.engine).approximator()
+        try:
+            model_intensities = func.batch(points)
+
+        except:
+            if debug: raise
+            model_intensities = np.nan * np.ones((N, model_wavelengths.size))
+
+        return (model_wavelengths, model_intensities, 0)
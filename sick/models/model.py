@@ -9,7 +9,11 @@ __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
 import curses
 import logging
+import multiprocessing
+import os
 import sys
+import threading
+from multiprocessing.pool import ThreadPool
 from time import time
 from collections import OrderedDict
 
@@ -35,8 +39,9 @@ class Model(BaseModel):
         """
 
         # Number of model comparisons can be specified in the configuration.
-        num_model_comparisons = self._configuration.get("estimate", {}).get(
-            "num_model_comparisons", self.grid_points.size)
+        estimate_config = self._configuration.get("estimate", {})
+        num_model_comparisons = estimate_config.get("num_model_comparisons",
+            self.grid_points.size)
         # If it's a fraction, we need to convert that to an integer.
         if 1 > num_model_comparisons > 0:
             num_model_comparisons *= self.grid_points.size
@@ -47,6 +52,15 @@ class Model(BaseModel):
 
         logger.debug("Number of model comparisons to make for initial estimate:"
             " {0}".format(num_model_comparisons))
+
+        # Should the coarse grid search be refined around the best candidates?
+        refine = kwargs.pop("refine", estimate_config.get("refine", False))
+        refine_top_k = int(kwargs.pop("refine_top_k",
+            estimate_config.get("refine_top_k", 5)))
+        refine_neighbours = int(kwargs.pop("refine_neighbours",
+            estimate_config.get("refine_neighbours", 10)))
+        refine_iterations = int(kwargs.pop("refine_iterations",
+            estimate_config.get("refine_iterations", 3)))
         
         # Match the data to the model channels.
         matched_channels, missing_channels, ignore_parameters \
@@ -56,15 +70,11 @@ class Model(BaseModel):
             "parameters: {2}".format(matched_channels, missing_channels,
                 ignore_parameters))
 
-        # Load the intensities
-        t = time()
-        s = self.grid_points.size/num_model_comparisons # step size
-        grid_points = self.grid_points[::s]
-        intensities = np.memmap(
-            self._configuration["model_grid"]["intensities"], dtype="float32",
-            mode="r", shape=(self.grid_points.size, self.wavelengths.size))[::s]
-        logger.debug("Took {:.0f} seconds to load and slice intensities".format(
-            time() - t))
+        # The coarse search uses every s-th grid point.
+        s = max(1, self.grid_points.size // max(1, num_model_comparisons))
+        grid_indices = np.arange(0, self.grid_points.size, s)
+        intensities = self._intensities()
+
         # Which matched, data channel has the highest S/N?
         # (This channel will be used to estimate astrophysical parameters)
         data, pixels_affected = self._apply_data_mask(data)
@@ -90,6 +100,22 @@ class Model(BaseModel):
 
         z_limits = self._configuration["settings"].get("ccf_z_limits", None)
 
+        # Cross-correlate on a linear or log-wavelength grid? In log-wavelength
+        # the transformed templates are cached between calls, and can also be
+        # saved to disk as a CCF bank.
+        use_ccf_bank = self._configuration["settings"].get("ccf_bank", False)
+        ccf_mode = self._configuration["settings"].get("ccf_mode",
+            "log" if use_ccf_bank else "linear").lower()
+        if ccf_mode not in ("linear", "log"):
+            raise ValueError("ccf_mode must be either `linear` or `log`")
+
+        # Choose the best grid point by the CCF peak or by chi-squared?
+        estimate_method = self._configuration["settings"].get(
+            "estimate_method", "ccf").lower()
+        if estimate_method not in ("ccf", "chisq"):
+            raise ValueError("estimate_method must be either `ccf` or `chisq`")
+        block_size = int(estimate_config.get("block_size", 256))
+
         theta = {} # Dictionary for the estimated model parameters.
         best_grid_index = None
         c = speed_of_light.to("km/s").value
@@ -111,19 +137,43 @@ class Model(BaseModel):
                 logger.debug("Perfoming CCF on {0} channel with a continuum "
                     "degree of {1}".format(matched_channel, continuum_degree))
 
-                # Get model wavelength indices that match the data.
-                # get the points that are in the mask, and within the spectrum
-                # limits
-
-                # TODO: Make this CCF not model mask.
-                idx = np.where(self._model_mask() \
-                    * (self.wavelengths >= spectrum.disp[0]) \
-                    * (spectrum.disp[-1] >= self.wavelengths))[0]
-
-                v, v_err, R = spectrum.cross_correlate(
-                    (self.wavelengths[idx], intensities[:, idx]),
-                    #(self.wavelengths, intensities),
-                    continuum_degree=continuum_degree, z_limits=z_limits)
+                # Cross-correlate against the coarse subset of the grid.
+                t = time()
+                indices = grid_indices
+                v, v_err, R = self._cross_correlate_grid(spectrum,
+                    matched_channel, indices, intensities, continuum_degree,
+                    z_limits=z_limits, ccf_mode=ccf_mode,
+                    persist_ccf_bank=use_ccf_bank)
+                logger.debug("Took {0:.2f} seconds to cross-correlate against "
+                    "{1} grid points".format(time() - t, indices.size))
+
+                # Refine the search around the best candidates by
+                # cross-correlating against their nearest grid neighbours.
+                if refine and matched_channel == ccf_channel:
+                    for iteration in range(refine_iterations):
+                        t = time()
+                        candidates = indices[
+                            np.argsort(np.nan_to_num(R))[::-1][:refine_top_k]]
+                        neighbours = np.setdiff1d(self._grid_neighbours(
+                            candidates, refine_neighbours), indices)
+                        if neighbours.size == 0: break
+
+                        _v, _v_err, _R = self._cross_correlate_grid(spectrum,
+                            matched_channel, neighbours, intensities,
+                            continuum_degree, z_limits=z_limits,
+                            ccf_mode=ccf_mode, persist_ccf_bank=use_ccf_bank)
+
+                        indices = np.append(indices, neighbours)
+                        v, v_err, R = [np.append(*_) for _ in \
+                            ((v, _v), (v_err, _v_err), (R, _R))]
+
+                        logger.debug("Took {0:.2f} seconds to cross-correlate "
+                            "against {1} neighbouring grid points in refinement"
+                            " iteration {2}".format(time() - t,
+                                neighbours.size, iteration))
+
+                    logger.debug("Made {0} model comparisons in total".format(
+                        indices.size))
 
                 # Identify the best point by the CCF peak.
                 best = np.nanargmax(R)
@@ -143,10 +193,23 @@ class Model(BaseModel):
                     # spectra yet.
 
                 if matched_channel == ccf_channel:
+                    best_grid_index = indices[best]
+
+                    # Choose the grid point by the continuum-marginalised
+                    # chi-squared value at the CCF redshift?
+                    if estimate_method == "chisq":
+                        t = time()
+                        chi_sq = self._chi_sq_grid(spectrum, indices,
+                            intensities, v[best] / c, continuum_degree,
+                            block_size=block_size)
+                        best_grid_index = indices[np.nanargmin(chi_sq)]
+                        logger.debug("Took {0:.2f} seconds to calculate chi-"
+                            "squared values for {1} grid points".format(
+                                time() - t, indices.size))
+
                     # Update astrophysical parameters.
-                    theta.update(dict(zip(grid_points.dtype.names,
-                        grid_points[best])))
-                    best_grid_index = best
+                    theta.update(dict(zip(self.grid_points.dtype.names,
+                        self.grid_points[best_grid_index])))
 
         # If there are continuum parameters, calculate them from the best point.
         if any_continuum_parameters:
@@ -258,16 +321,416 @@ class Model(BaseModel):
 
         
 
-    def infer(self, data, initial_proposal=None, full_output=False,**kwargs):
+    def _cross_correlate_grid(self, spectrum, channel, indices, intensities,
+        continuum_degree, z_limits=None, ccf_mode="linear",
+        persist_ccf_bank=False):
+        """
+        Cross-correlate a spectrum against a subset of the model grid.
+
+        :param spectrum:
+            The observed spectrum.
+
+        :type spectrum:
+            :class:`sick.specutils.Spectrum1D`
+
+        :param channel:
+            The name of the model channel matched to the spectrum.
+
+        :type channel:
+            str
+
+        :param indices:
+            The grid indices of the templates to cross-correlate against.
+
+        :type indices:
+            :class:`numpy.array`
+
+        :param intensities:
+            The model intensities for the entire grid.
+
+        :type intensities:
+            :class:`numpy.memmap` or :class:`storage.ChunkedIntensities`
+
+        :param continuum_degree:
+            The degree of the polynomial to fit to the observed continuum.
+
+        :type continuum_degree:
+            int
+
+        :param z_limits: [optional]
+            The lower and upper limits on the redshift.
+
+        :type z_limits:
+            tuple
+
+        :param ccf_mode: [optional]
+            Cross-correlate on a `linear` or `log` wavelength grid.
+
+        :type ccf_mode:
+            str
+
+        :param persist_ccf_bank: [optional]
+            Load or save the bank of templates used in `log` mode from disk.
+
+        :type persist_ccf_bank:
+            bool
+
+        :returns:
+            The velocity, velocity uncertainty and peak CCF value for each
+            template.
+        """
+
+        if ccf_mode == "log":
+            bank = self._ccf_bank(channel, persist=persist_ccf_bank)
+            return bank.cross_correlate(spectrum,
+                continuum_degree=continuum_degree, z_limits=z_limits,
+                indices=indices)
+
+        # If the indices are a regular stride through the grid then we can use
+        # the unmasked channel intensities that are kept in memory.
+        stride = indices[1] - indices[0] if indices.size > 1 \
+            else self.grid_points.size
+        if np.array_equal(indices, np.arange(0, self.grid_points.size, stride)):
+            wavelengths, templates = self._channel_intensities(channel, stride)
+
+        else:
+            index = list(self.channel_names).index(channel)
+            si = sum(self.meta["channel_sizes"][:index])
+            size = self.meta["channel_sizes"][index]
+
+            # TODO: Make this CCF not model mask.
+            mask = self._model_mask(self.wavelengths[si:si + size])
+            wavelengths = self.wavelengths[si:si + size][mask]
+            templates = intensities[indices, si:si + size][:, mask]
+
+        # Only use the model pixels within the spectrum limits. These are
+        # contiguous, so this is a view and not a copy.
+        idx = (wavelengths.searchsorted(spectrum.disp[0], side="left"),
+            wavelengths.searchsorted(spectrum.disp[-1], side="right"))
+        return spectrum.cross_correlate(
+            (wavelengths[idx[0]:idx[1]], templates[:, idx[0]:idx[1]]),
+            continuum_degree=continuum_degree, z_limits=z_limits)
+
+
+    def _channel_intensities(self, channel, stride=1):
+        """
+        Return the unmasked wavelengths and intensities of a model channel for
+        every `stride`-th point in the grid.
+
+        The intensities are read from disk once and kept in memory as a
+        contiguous array for subsequent calls on this model, so that slicing
+        them by wavelength does not require any copies. At most
+        `channel_intensities_cache_size` megabytes (default 512) are kept, and
+        the least recently used arrays are released first. Setting it to zero
+        disables the cache.
+
+        :param channel:
+            The name of the model channel.
+
+        :type channel:
+            str
+
+        :param stride: [optional]
+            The step size between grid points.
+
+        :type stride:
+            int
+        """
+
+        # The model mask can be changed in the configuration at any time.
+        key = (channel, stride,
+            repr(self._configuration.get("masks", {}).get("model", [])))
+        # Threads fitting different stars share the cache.
+        with self._cache_lock:
+            try:
+                cache = self._channel_intensities_cache
+
+            except AttributeError:
+                cache = self._channel_intensities_cache = OrderedDict()
+
+            try:
+                wavelengths, compact = cache.pop(key)
+
+            except KeyError:
+                pass
+
+            else:
+                # Keep the most recently used arrays at the end.
+                cache[key] = (wavelengths, compact)
+                return (wavelengths, compact)
+
+            t = time()
+            index = list(self.channel_names).index(channel)
+            si = sum(self.meta["channel_sizes"][:index])
+            size = self.meta["channel_sizes"][index]
+            mask = self._model_mask(self.wavelengths[si:si + size])
+
+            intensities = self._intensities()
+            wavelengths = np.array(self.wavelengths[si:si + size][mask])
+            compact = np.ascontiguousarray(
+                intensities[::stride, si:si + size][:, mask])
+            del intensities
+
+            logger.debug("Took {0:.2f} seconds to load {1} intensities in "
+                "channel {2}".format(time() - t, compact.shape[0], channel))
+
+            max_nbytes = 1024**2 * self._configuration.get("settings", {}).get(
+                "channel_intensities_cache_size", 512)
+            if compact.nbytes <= max_nbytes:
+                nbytes = sum([_[1].nbytes for _ in cache.values()])
+                while cache and nbytes + compact.nbytes > max_nbytes:
+                    nbytes -= cache.popitem(last=False)[1][1].nbytes
+                cache[key] = (wavelengths, compact)
+
+            return (wavelengths, compact)
+
+
+    def _chi_sq_grid(self, spectrum, indices, intensities, z,
+        continuum_degree, block_size=256):
+        """
+        Calculate the continuum-marginalised chi-squared value of a spectrum
+        against a subset of the model grid at a fixed redshift.
+
+        The continuum is a polynomial of degree `continuum_degree` that
+        multiplies the model spectrum. It is solved for analytically for every
+        template and marginalised over with a uniform prior, which adds the
+        log-determinant of the normal matrix to the minimum chi-squared value.
+        The intensities are read from disk in blocks of `block_size` templates
+        and each block is evaluated with dense matrix products, so the memory
+        required is bounded by the block size.
+
+        :param spectrum:
+            The observed spectrum.
+
+        :type spectrum:
+            :class:`sick.specutils.Spectrum1D`
+
+        :param indices:
+            The grid indices of the templates to compare against.
+
+        :type indices:
+            :class:`numpy.array`
+
+        :param intensities:
+            The model intensities for the entire grid.
+
+        :type intensities:
+            :class:`numpy.memmap` or :class:`storage.ChunkedIntensities`
+
+        :param z:
+            The redshift to apply to the model spectra.
+
+        :type z:
+            float
+
+        :param continuum_degree:
+            The degree of the continuum polynomial, or -1 for no continuum.
+
+        :type continuum_degree:
+            int
+
+        :param block_size: [optional]
+            The number of templates to read and evaluate at once.
+
+        :type block_size:
+            int
+
+        :returns:
+            The marginalised chi-squared value for each template.
+        """
+
+        # Get the rest-frame model wavelength indices that cover the data.
+        idx = np.clip(self.wavelengths.searchsorted(
+            [spectrum.disp[0]/(1 + z), spectrum.disp[-1]/(1 + z)]) + [-1, 2],
+            0, self.wavelengths.size)
+        wavelengths = self.wavelengths[idx[0]:idx[1]]
+
+        # Redshift and bin the model spectra onto the observed pixels.
+        matrix = specutils.sample.resample(wavelengths * (1 + z), spectrum.disp)
+
+        # Only use observed pixels that have data and are not affected by the
+        # model mask or the edges of the model spectra.
+        model_mask = np.ones(wavelengths.size)
+        model_mask[~self._model_mask(wavelengths)] = np.nan
+        use = np.isfinite(matrix.T.dot(model_mask)) \
+            * np.isfinite(spectrum.flux) * np.isfinite(spectrum.ivariance)
+        use[use] = spectrum.ivariance[use] > 0
+
+        matrix = matrix.tocsc()[:, use]
+        y, ivar = spectrum.flux[use], spectrum.ivariance[use]
+
+        if continuum_degree >= 0:
+            # Scale the dispersion so the polynomial basis is well-conditioned.
+            x = spectrum.disp[use]
+            V = np.vander((x - x.mean())/np.ptp(x), continuum_degree + 1)
+            K = V.shape[1]
+            VV = (V[:, :, None] * V[:, None, :]).reshape(-1, K**2)
+
+        chi_sq = np.nan * np.ones(len(indices))
+        for i in range(0, len(indices), block_size):
+            block = np.array(
+                intensities[indices[i:i + block_size], idx[0]:idx[1]],
+                dtype=float)
+            model = matrix.T.dot(block.T).T
+
+            # Observed pixels that are affected by non-finite template pixels
+            # are left out of the chi-squared value for that template.
+            finite = np.isfinite(model)
+            model[~finite] = 0
+            weights = ivar * finite
+
+            if continuum_degree < 0:
+                block_chi_sq = weights.dot(y**2) \
+                    - 2 * (model * weights).dot(y) \
+                    + (model**2 * weights).sum(axis=1)
+                block_chi_sq[~finite.any(axis=1)] = np.nan
+                chi_sq[i:i + block_size] = block_chi_sq
+                continue
+
+            # Normal equations for the continuum coefficients of each template.
+            G = (model**2 * weights).dot(VV).reshape(-1, K, K)
+            b = (model * weights * y).dot(V)
+            sign, ln_det = np.linalg.slogdet(G)
+            singular = ~(sign > 0)
+            G[singular] = np.eye(K)
+
+            coefficients = np.linalg.solve(G, b[:, :, None])[:, :, 0]
+            block_chi_sq = weights.dot(y**2) \
+                - np.sum(b * coefficients, axis=1) + ln_det
+            block_chi_sq[singular] = np.nan
+            chi_sq[i:i + block_size] = block_chi_sq
+
+        return chi_sq
+
+
+    def _grid_neighbours(self, indices, N):
+        """
+        Return the unique indices of the `N` nearest grid points to each of the
+        given grid points. Distances are measured in grid space with each
+        parameter scaled by its range.
+
+        :param indices:
+            The indices of the grid points to find neighbours for.
+
+        :type indices:
+            :class:`numpy.array`
+
+        :param N:
+            The number of nearest neighbours (including the point itself) to
+            return for each grid point.
+
+        :type N:
+            int
+        """
+
+        scaled_grid_points, scale = self._scaled_grid_points()
+        return np.unique(self._nearest_grid_indices(
+            scaled_grid_points[np.atleast_1d(indices)] * scale, N))
+
+
+    def _ccf_bank(self, channel, persist=True):
+        """
+        Return the bank of Fourier-transformed templates used to cross-correlate
+        data against the given model channel on a log-wavelength grid.
+
+        The bank is kept in memory for subsequent calls. If persisted, it is
+        stored next to the model intensities: it is built if it does not exist,
+        or rebuilt if it was created for a different model configuration (hash)
+        or channel.
+
+        :param channel:
+            The name of the model channel.
+
+        :type channel:
+            str
+
+        :param persist: [optional]
+            Load the bank from disk, or save it to disk once it is built.
+
+        :type persist:
+            bool
+        """
+
+        with self._cache_lock:
+            model_hash = self.hash
+            try:
+                return self._ccf_banks[(channel, model_hash)]
+
+            except AttributeError:
+                self._ccf_banks = {}
+
+            except KeyError:
+                None
+
+            prefix = "{0}-ccf-{1}".format(os.path.splitext(
+                self._configuration["model_grid"]["intensities"])[0], channel)
+
+            if not persist:
+                bank, prefix = (None, None)
+
+            else:
+                try:
+                    bank = specutils.ccf.CCFBank.load(prefix)
+
+                except IOError:
+                    bank = None
+
+                else:
+                    if bank.meta.get("model_hash", None) != model_hash \
+                    or bank.meta.get("channel", None) != channel:
+                        logger.info("Rebuilding CCF bank {0} because it was "
+                            "built for a different model".format(prefix))
+                        bank = None
+
+            if bank is None:
+                t = time()
+                index = list(self.channel_names).index(channel)
+                si = sum(self.meta["channel_sizes"][:index])
+                size = self.meta["channel_sizes"][index]
+                wavelengths = self.wavelengths[si:si + size]
+
+                intensities = self._intensities()
+                bank = specutils.ccf.CCFBank.build(wavelengths,
+                    intensities[:, si:si + size],
+                    mask=self._model_mask(wavelengths), prefix=prefix,
+                    meta={ "model_hash": model_hash, "channel": channel })
+                del intensities
+
+                logger.info("Built CCF bank for channel {0} in {1:.0f} seconds"
+                    "{2}".format(channel, time() - t, " and saved it to {}"\
+                        .format(prefix) if persist else ""))
+
+            self._ccf_banks[(channel, model_hash)] = bank
+            return bank
+
+
+    def infer(self, data, initial_proposal=None, full_output=False,
+        engine=None, **kwargs):
 
         """
         Infer the model parameters, given the data.
         auto_convergence=True,
         walkers=100, burn=2000, sample=2000, minimum_sample=2000,
-        convergence_check_frequency=1000, a=2.0, threads=1,
-
+        convergence_check_frequency=1000, a=2.0, threads=1, vectorised=False,
+        processes=1
+
+        With `vectorised=True` the log-probabilities of all walkers are
+        calculated together at each step (see
+        :func:`sick.inference.ln_probability_batch`), instead of once per
+        walker. With `processes` > 1 the walkers are split between a pool of
+        worker processes that each load the model and create the approximator
+        once (see :class:`sick.inference.ProcessPool`). The `threads` keyword
+        is passed to :class:`emcee.EnsembleSampler` and is deprecated in favour
+        of `processes`.
+
+        The approximator and convolution functions are kept in the given
+        :class:`sick.models.generate.SpectrumEngine`, or the model's default
+        engine.
         """
 
+        if engine is None:
+            engine = self.engine
+
         # Apply data masks now so we don't have to do it on the fly.
         data, pixels_affected = self._apply_data_mask(data)
 
@@ -305,7 +768,9 @@ class Model(BaseModel):
             "minimum_effective_independent_samples": 100,
             "check_convergence_frequency": 1000,
             "a": 2.0,
-            "threads": 1
+            "threads": 1,
+            "vectorised": False,
+            "processes": 1
         }
 
         # Update from the model, then update from any keyword arguments given.
@@ -317,7 +782,7 @@ class Model(BaseModel):
             raise ValueError("the number of walkers must be an even number and "
                 "be at least twice the number of model parameters")
 
-        check_keywords = ["threads", "a"]
+        check_keywords = ["threads", "processes", "a"]
         if kwd["auto_convergence"]:
             logger.info("Convergence will be estimated automatically.")
             check_keywords += ["minimum_sample", "check_convergence_frequency",
@@ -358,9 +823,13 @@ class Model(BaseModel):
 
             closest_point = [initial_proposal[p] \
                 for p in self.grid_points.dtype.names]
-            subset_bounds = self._initialise_approximator(
-                closest_point=closest_point, 
-                wavelengths_required=wavelengths_required, force=True, **kwargs)
+            approximator_kwargs = kwargs.copy()
+            approximator_kwargs.update({
+                "closest_point": closest_point,
+                "wavelengths_required": wavelengths_required
+            })
+            subset_bounds = self._initialise_approximator(force=True,
+                engine=engine, **approximator_kwargs)
 
             initial_proposal = self._initial_proposal_distribution(
                 parameters, initial_proposal, kwd["walkers"])
@@ -372,17 +841,49 @@ class Model(BaseModel):
                     "(N_parameters, N_walkers) ({0}, {1})".format(kwd["walkers"],
                         len(parameters)))
 
+            # Worker processes will initialise their approximator near the
+            # middle of the initial proposal.
+            fixed = kwd.get("fixed",
+                self._configuration.get("optimise", {}).get("fixed", None))
+            closest_point = self._proposal_closest_point(parameters,
+                initial_proposal, fixed)
+            approximator_kwargs = kwargs.copy()
+            approximator_kwargs["closest_point"] = closest_point
+
         # Prepare the convolution functions.
-        self._create_convolution_functions(matched_channels, data, parameters)
+        self._create_convolution_functions(matched_channels, data, parameters,
+            engine=engine)
 
-        # Create the sampler.
-        logger.info("Creating sampler with {0} walkers and {1} threads".format(
-            kwd["walkers"], kwd["threads"]))
+        # Create the sampler. The approximator cannot be sent to other
+        # processes, so each worker process creates its own approximator.
         debug = kwargs.get("debug", False)
+        if kwd["threads"] > 1 and kwd["processes"] == 1:
+            logger.warn("The threads keyword is deprecated because the emcee "
+                "workers do not share the approximator. Use processes instead.")
+
+        if kwd["processes"] > 1:
+            logger.info("Creating sampler with {0} walkers and {1} processes"\
+                .format(kwd["walkers"], kwd["processes"]))
+            pool = inference.ProcessPool(kwd["processes"], parameters, self,
+                data, approximator_kwargs, debug, kwd["vectorised"],
+                matched_channels=matched_channels)
+
+        elif kwd["vectorised"]:
+            logger.info("Creating sampler with {0} walkers evaluated together"\
+                .format(kwd["walkers"]))
+            pool = inference.BatchPool(parameters, self, data, debug,
+                matched_channels=matched_channels, engine=engine)
+
+        else:
+            logger.info("Creating sampler with {0} walkers and {1} threads"\
+                .format(kwd["walkers"], kwd["threads"]))
+            pool = None
+
         sampler = emcee.EnsembleSampler(kwd["walkers"], len(parameters),
             inference.ln_probability, a=kwd["a"], threads=kwd["threads"],
             args=(parameters, self, data, debug),
-            kwargs={"matched_channels": matched_channels})
+            kwargs={"matched_channels": matched_channels, "engine": engine},
+            pool=pool)
 
         # Regardless of whether we automatically check for convergence or not,
         # we will still need to burn in for some minimum amount of time.
@@ -530,7 +1031,7 @@ class Model(BaseModel):
 
         chi_sq, dof, model_fluxes = self._chi_sq(dict(zip(parameters, 
             [np.percentile(chains[:, burn:, i], 50) 
-                for i in range(len(parameters))])), data)
+                for i in range(len(parameters))])), data, engine=engine)
 
         # Convert velocity scales.
         symbol, scale, units = self._preferred_redshift_scale
@@ -561,7 +1062,7 @@ class Model(BaseModel):
 
         # Remove the convolution functions.
         if not kwargs.get("__keep_convolution_functions", False):
-            self._destroy_convolution_functions()
+            self._destroy_convolution_functions(engine)
 
         if full_output:
             metadata = {
@@ -638,9 +1139,10 @@ class Model(BaseModel):
                 raise RuntimeError("mean acceptance fraction is {0:.0f}".format(
                     mean_acceptance_fraction[i]))
         
-        curses.echo()
-        curses.nocbreak()
-        curses.endwin()
+        if progress_bar:
+            curses.echo()
+            curses.nocbreak()
+            curses.endwin()
 
         elapsed = time() - t_init
         logger.debug("Sampling{0} took {1:.1f} seconds".format(
@@ -650,7 +1152,7 @@ class Model(BaseModel):
 
 
     def _create_convolution_functions(self, matched_channels, data, 
-        free_parameters, fixed_parameters=None):
+        free_parameters, fixed_parameters=None, engine=None):
         """
         Pre-create binning matrix factories. The following options need to be
         followed on a per-matched channel basis.
@@ -697,8 +1199,21 @@ class Model(BaseModel):
 
         Consistent lambda function:
         lambda(obs_wavelength, obs_flux, z=0, *R)
+
+        The fluxes can also be an array of shape (N_theta, N_pixels), in which
+        case the redshift and resolution can be given for each row. Without
+        fast_binning, the rows are grouped by their redshift and resolution
+        (rounded as the factory caches them) and one matrix is created for
+        each group, so the factory still runs once for every distinct redshift
+        when the redshift is free (e.g., for each walker).
+
+        The convolution functions are kept in the given engine, or the model's
+        default engine.
         """
 
+        if engine is None:
+            engine = self.engine
+
         fast_binning = self._configuration.get("settings", {}).get(
             "fast_binning", 1)
 
@@ -729,8 +1244,7 @@ class Model(BaseModel):
                     logger.info("Doing static interpolation for channel {}"\
                         .format(channel))
                     convolution_function = lambda w, f, z, *a: \
-                        np.interp(w, generate.wavelengths[-1], f,
-                            left=np.nan, right=np.nan)
+                        _interpolate(w, engine.wavelengths, f)
 
 
                 else:
@@ -746,7 +1260,7 @@ class Model(BaseModel):
                     # Create the binning matrix based on the globally-scoped array
                     # of wavelengths.
                     matrix = specutils.sample.resample(
-                        generate.wavelengths[-1] * (1 + z),
+                        engine.wavelengths * (1 + z),
                         spectrum.disp)
 
                     # Wrap in a lambda function to be consistent with other options.
@@ -773,23 +1287,18 @@ class Model(BaseModel):
                             / (2.35482 * np.diff(spectrum.disp).mean())
                         """
                         convolution_function = lambda w, f, z, R, *a: \
-                            np.interp(w, generate.wavelengths[-1] * (1 + z),
+                            np.interp(w, engine.wavelengths * (1 + z),
                                 gaussian_filter1d(f, max(0, R_scale/R),
                                     mode="constant", cval=np.nan),
                                 left=np.nan, right=np.nan)
                         """
                         def convolution_function(w, f, z, R, *a):
-                            if R > 0:
-                                _ = gaussian_filter1d(f, R_scale/R)
-                            else:
-                                _ = f
-                            return np.interp(w, generate.wavelengths[-1] * (1 + z),
-                                _, left=np.nan, right=np.nan)
+                            return _interpolate(w, engine.wavelengths,
+                                _smooth(f, R_scale, R), z)
 
                     else:
                         convolution_function = lambda w, f, z, *a: \
-                            np.interp(w, generate.wavelengths[-1] * (1 + z), f,
-                                left=np.nan, right=np.nan)
+                            _interpolate(w, engine.wavelengths, f, z)
 
                 else:
                     if redshift and not resolution:
@@ -798,10 +1307,12 @@ class Model(BaseModel):
                             "in channel {}".format(channel))
 
                         matrix = specutils.sample._BoxFactory(
-                            spectrum.disp, generate.wavelengths[-1])
+                            spectrum.disp, engine.wavelengths)
 
                         # Wrap in a lambda function to be consistent.
-                        convolution_function = lambda w, f, z, *a: f * matrix(z)
+                        convolution_function = lambda w, f, z, R=0, *a: \
+                            _by_group(lambda f_, z_, R_: f_ * matrix(z_),
+                                f, z, R, decimals=(matrix.z_decimals, None))
 
                     else:
                         # Could be redshift and resolution, or just resolution.
@@ -810,31 +1321,41 @@ class Model(BaseModel):
                             "convolution in channel {}".format(channel))
 
                         matrix = specutils.sample._BlurryBoxFactory(
-                            spectrum.disp, generate.wavelengths[-1])
+                            spectrum.disp, engine.wavelengths)
 
                         # Wrap in a lambda function to be consistent.
-                        convolution_function \
-                            = lambda w, f, z, R, *a: f * matrix(R, z)
+                        convolution_function = lambda w, f, z, R, *a: \
+                            _by_group(lambda f_, z_, R_: f_ * matrix(R_, z_),
+                                f, z, R, decimals=(matrix.z_decimals,
+                                    matrix.resolution_decimals))
 
             # Append this channel's convolution function.
             convolution_functions.append(convolution_function)
 
-        # Put the convolution functions into the global scope.
-        generate.binning_matrices.append(convolution_functions)
+        engine.set_convolution_functions(convolution_functions)
         return True
 
 
-    def _destroy_convolution_functions(self):
+    def _destroy_convolution_functions(self, engine=None):
         logger.info("Removing run-time convolution functions.")
-        _ = generate.binning_matrices.pop(-1)
+        (self.engine if engine is None else engine)\
+            .set_convolution_functions(None)
         return True
 
 
-    def optimise(self, data, initial_theta=None, full_output=False, **kwargs):
+    def optimise(self, data, initial_theta=None, full_output=False,
+        engine=None, **kwargs):
         """
         Optimise the model parameters, given the data.
+
+        The approximator and convolution functions are kept in the given
+        :class:`sick.models.generate.SpectrumEngine`, or the model's default
+        engine.
         """
 
+        if engine is None:
+            engine = self.engine
+
         data = self._format_data(data)
 
         if initial_theta is None:
@@ -859,7 +1380,7 @@ class Model(BaseModel):
         closest_point = [initial_theta[p] for p in self.grid_points.dtype.names]
         subset_bounds = self._initialise_approximator(
             closest_point=closest_point, 
-            wavelengths_required=wavelengths_required, **kwargs)
+            wavelengths_required=wavelengths_required, engine=engine, **kwargs)
         
         # Get the optimisation keyword arguments.
         op_kwargs = self._configuration.get("optimise", {}).copy()
@@ -894,7 +1415,7 @@ class Model(BaseModel):
 
         # Prepare the convolution functions.
         self._create_convolution_functions(matched_channels, data, parameters,
-            fixed_parameters=fixed)
+            fixed_parameters=fixed, engine=engine)
 
         logger.info("Optimising parameters: {0}".format(", ".join(parameters)))
         logger.info("Optimisation keywords: {0}".format(op_kwargs))
@@ -910,7 +1431,7 @@ class Model(BaseModel):
                 t_ = np.append(theta, value)
 
             return -inference.ln_probability(t_, p_, self, data, debug,
-                matched_channels=matched_channels)
+                matched_channels=matched_channels, engine=engine)
 
         # Do the optimisation.
         p0 = np.array([initial_theta[p] for p in parameters])
@@ -923,20 +1444,132 @@ class Model(BaseModel):
 
         if full_output:
             # Create model fluxes and calculate some metric.
-            chi_sq, dof, model_fluxes = self._chi_sq(x_opt_theta, data)
+            chi_sq, dof, model_fluxes = self._chi_sq(x_opt_theta, data,
+                engine=engine)
 
 
             # Remove any prepared convolution functions.
-            self._destroy_convolution_functions()
+            self._destroy_convolution_functions(engine)
     
             return (x_opt_theta, chi_sq, dof, model_fluxes)
 
         # Remove any prepared convolution functions.
-        self._destroy_convolution_functions()
+        self._destroy_convolution_functions(engine)
 
         return x_opt_theta
 
 
+    def fit_many(self, spectra, stage="optimise", workers=1, processes=False,
+        **kwargs):
+        """
+        Fit many stars with a pool of workers, and yield the result for each
+        star as soon as its fit finishes.
+
+        Worker threads share the model (the grid points, memory-mapped
+        intensities and any cached triangulations or cross-correlation banks,
+        which are built by one thread at a time) and each thread has its own
+        :class:`sick.models.generate.SpectrumEngine`.
+        Worker processes each load the model once from its filename and
+        configuration.
+
+        :param spectra:
+            The observed spectra for each star. Each item is a spectrum or a
+            list of spectra, as given to :func:`Model.estimate`.
+
+        :type spectra:
+            iterable
+
+        :param stage: [optional]
+            The method to fit each star with: `estimate`, `optimise` or `infer`.
+
+        :type stage:
+            str
+
+        :param workers: [optional]
+            The number of stars to fit at once.
+
+        :type workers:
+            int
+
+        :param processes: [optional]
+            Use worker processes instead of threads.
+
+        :type processes:
+            bool
+
+        Any additional keyword arguments are passed to the `stage` method.
+
+        :returns:
+            A generator of `(index, result, elapsed)` tuples, in the order that
+            the fits finish. The index is the position of the star in `spectra`,
+            the result is what the `stage` method returns (or None if the fit
+            failed), and elapsed is the wall time for that star in seconds.
+        """
+
+        if stage not in ("estimate", "optimise", "infer"):
+            raise ValueError("stage must be estimate, optimise or infer")
+
+        if stage == "infer":
+            # Progress bars from concurrent samplers would overwrite each other.
+            kwargs.setdefault("__show_progress_bar", False)
+
+        stars = enumerate(spectra)
+        if 2 > workers:
+            for index, data in stars:
+                yield self._fit_one(index, data, stage, self.engine, **kwargs)
+            return
+
+        if processes:
+            pool = multiprocessing.Pool(workers,
+                initializer=_initialise_fit_worker, initargs=(self, stage,
+                    kwargs))
+            results = pool.imap_unordered(_fit_in_worker, stars)
+
+        else:
+            engines = threading.local()
+            def fit(star):
+                try:
+                    engine = engines.engine
+                except AttributeError:
+                    engine = engines.engine = generate.SpectrumEngine()
+                return self._fit_one(star[0], star[1], stage, engine, **kwargs)
+
+            pool = ThreadPool(workers)
+            results = pool.imap_unordered(fit, stars)
+
+        try:
+            for result in results:
+                yield result
+
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def _fit_one(self, index, data, stage, engine, **kwargs):
+        """
+        Fit one star and return the index, the result (or None if the fit
+        failed) and the time taken.
+        """
+
+        t_init = time()
+        try:
+            if stage == "estimate":
+                result = self.estimate(data, **kwargs)
+            else:
+                result = getattr(self, stage)(data, engine=engine, **kwargs)
+
+        except Exception:
+            if kwargs.get("debug", False): raise
+            logger.exception("Failed to {0} star {1}:".format(stage, index))
+            result = None
+
+        elapsed = time() - t_init
+        logger.info("Star {0} took {1:.2f} seconds to {2}".format(index,
+            elapsed, stage))
+        return (index, result, elapsed)
+
+
     def __call__(self, theta, data, debug=False, **kwargs):
 
         if not isinstance(data, (list, tuple)):
@@ -999,7 +1632,8 @@ class Model(BaseModel):
 
                 # Get the pre-calculated convolution function.
                 # (This will always be a callable)
-                convolution_function = generate.binning_matrices[-1][i]
+                convolution_function = (kwargs.get("engine", None) \
+                    or self.engine).convolution_function(i)
 
                 t = time()
                 channel_fluxes = convolution_function(
@@ -1051,6 +1685,172 @@ class Model(BaseModel):
 
         return model_fluxes
 
+    def batch_call(self, thetas, data, parameters=None, debug=False,
+        **kwargs):
+        """
+        Generate model fluxes for many points in parameter space at once.
+
+        This gives the same fluxes as calling the model for each point, but
+        the intensities for all points are approximated together, and they are
+        convolved, resampled and multiplied by their continuum as
+        (N_theta, N_pixels) arrays.
+
+        :param thetas:
+            An array of shape (N_theta, N_parameters) of the parameter values.
+
+        :type thetas:
+            :class:`numpy.array`
+
+        :param data:
+            The observed spectra.
+
+        :type data:
+            list of :class:`sick.specutils.Spectrum1D` objects
+
+        :param parameters: [optional]
+            The names of the parameters in each column of `thetas`. By default
+            these are the model parameters.
+
+        :type parameters:
+            list of str
+
+        :returns:
+            A list of arrays of shape (N_theta, N_pixels), with the model fluxes
+            for each observed channel. If `full_output` is true then the model
+            variances, matched channels and continua are also returned.
+        """
+
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+
+        thetas = np.atleast_2d(np.array(thetas, dtype=float))
+        theta = dict(zip(parameters or self.parameters, thetas.T))
+        N = thetas.shape[0]
+
+        model_wavelengths, model_intensities, model_variances \
+            = self._approximate_intensities_batch(theta, data, debug=debug,
+                **kwargs)
+        model_variances = np.zeros_like(model_intensities) + model_variances
+
+        continua = []
+        model_fluxes = []
+        model_flux_variances = []
+
+        matched_channels = kwargs.get("matched_channels", None)
+        if matched_channels is None:
+            matched_channels, _, __ = self._match_channels_to_data(data)
+
+        no_precomputed_binning = kwargs.get("__no_precomputed_binning", False)
+        for i, (channel, spectrum) in enumerate(zip(matched_channels, data)):
+            if channel is None:
+                _ = np.nan * np.ones((N, spectrum.disp.size))
+                continua.append(np.ones(N))
+                model_fluxes.append(_)
+                model_flux_variances.append(_)
+                continue
+
+            # Get the redshift and resolution for each theta.
+            z = theta.get("z", theta.get("z_{}".format(channel), 0)) \
+                * np.ones(N)
+            resolution = theta.get("resolution", theta.get("resolution_{}"\
+                .format(channel), 0)) * np.ones(N)
+
+            if no_precomputed_binning:
+                def convolution_function(w, f, z, R, *a):
+                    return _by_group(lambda f_, z_, R_: f_ * (
+                        specutils.sample.resample_and_convolve(
+                            self.wavelengths * (1 + z_), w, R_) if R_ > 0 \
+                        else specutils.sample.resample(
+                            self.wavelengths * (1 + z_), w)), f, z, R)
+
+            else:
+                convolution_function = (kwargs.get("engine", None) \
+                    or self.engine).convolution_function(i)
+
+            channel_fluxes = convolution_function(
+                spectrum.disp, model_intensities, z, resolution)
+            if np.any(model_variances):
+                channel_variance = convolution_function(
+                    spectrum.disp, model_variances, z, resolution)
+            else:
+                channel_variance = np.zeros_like(channel_fluxes)
+
+            # Apply continuum if it is present.
+            j, coeff = 0, []
+            while theta.get("continuum_{0}_{1}".format(channel, j), None) \
+            is not None:
+                coeff.append(theta["continuum_{0}_{1}".format(channel, j)])
+                j += 1
+
+            if coeff:
+                continuum = np.abs(np.dot(np.array(coeff).T,
+                    np.vander(spectrum.disp, j, increasing=True).T))
+            else:
+                continuum = np.ones((N, 1))
+            channel_fluxes *= continuum
+
+            continua.append(continuum)
+            model_fluxes.append(channel_fluxes)
+            model_flux_variances.append(channel_variance)
+
+        if kwargs.pop("full_output", False):
+            return (model_fluxes, model_flux_variances, matched_channels,
+                continua)
+        return model_fluxes
+
+
+    def _approximate_intensities_batch(self, theta, data, debug=False,
+        **kwargs):
+        """
+        Approximate model intensities for many points in parameter space.
+
+        Subclasses should overwrite this with a vectorised approximation. By
+        default each point is approximated in turn, and points that cannot be
+        approximated have non-finite intensities.
+
+        :param theta:
+            A dictionary with an array of values for each parameter.
+
+        :type theta:
+            dict
+
+        :returns:
+            The model wavelengths, the model intensities as an array of shape
+            (N_theta, N_pixels), and the model variances.
+        """
+
+        N = max([np.size(value) for value in theta.values()] + [1])
+        model_wavelengths = (kwargs.get("engine", None) or self.engine)\
+            .wavelengths
+        model_intensities = np.nan * np.ones((N, model_wavelengths.size))
+        model_variances = 0
+        for i in range(N):
+            result = self._approximate_intensities(
+                dict([(k, v[i]) for k, v in theta.items()]), data, debug=debug,
+                **kwargs)
+            if isinstance(result, tuple):
+                model_intensities[i] = result[1]
+                model_variances = result[2]
+
+        return (model_wavelengths, model_intensities, model_variances)
+
+
+    @property
+    def engine(self):
+        """
+        Return the default :class:`sick.models.generate.SpectrumEngine` for this
+        model, which is used when no engine is given.
+        """
+
+        try:
+            return self._engine
+
+        except AttributeError:
+            self._engine = generate.SpectrumEngine()
+
+        return self._engine
+
+
     # Functions that should be overwritten by subclasses..
     def _approximate_intensities(self, *args, **kwargs):
         raise NotImplementedError("this should be overwritten in a subclass")
@@ -1059,3 +1859,171 @@ class Model(BaseModel):
         raise NotImplementedError("this should be overwritten in a subclass")
 
 
+
+_fit_worker = {}
+
+def _initialise_fit_worker(model, stage, kwargs):
+    """ Prepare a worker process to fit stars with :func:`Model.fit_many`. """
+
+    # This also sets the resolution parameters used by the priors.
+    model.parameters
+    _fit_worker.update({ "model": model, "stage": stage, "kwargs": kwargs })
+
+
+def _fit_in_worker(star):
+    """ Fit one star in a worker process. """
+
+    model = _fit_worker["model"]
+    return model._fit_one(star[0], star[1], _fit_worker["stage"], model.engine,
+        **_fit_worker["kwargs"])
+
+
+
+def _interpolate(x, xp, fp, z=0):
+    """
+    Linearly interpolate fluxes, sampled at the rest wavelengths `xp` and
+    redshifted by `z`, onto the wavelengths `x`. Wavelengths outside the range
+    of `xp` are non-finite.
+
+    :param x:
+        The wavelengths to interpolate onto.
+
+    :type x:
+        :class:`numpy.array`
+
+    :param xp:
+        The (increasing) rest wavelengths of the fluxes.
+
+    :type xp:
+        :class:`numpy.array`
+
+    :param fp:
+        The fluxes, either as an array of shape (N_pixels, ) or as an array of
+        shape (N_theta, N_pixels).
+
+    :type fp:
+        :class:`numpy.array`
+
+    :param z: [optional]
+        The redshift, or an array of redshifts for each row of `fp`.
+
+    :type z:
+        float or :class:`numpy.array`
+    """
+
+    # The model wavelengths may be single precision, but redshifts are too
+    # small to apply to them without rounding.
+    xp = np.asarray(xp, dtype=float)
+    if np.ndim(fp) == 1 and np.ndim(z) == 0:
+        return np.interp(x, xp * (1 + z), fp, left=np.nan, right=np.nan)
+
+    fp = np.atleast_2d(fp)
+    rest = x[None, :]/(1 + np.ones(fp.shape[0]) * z)[:, None]
+    upper = np.clip(xp.searchsorted(rest), 1, xp.size - 1)
+    t = (rest - xp[upper - 1])/(xp[upper] - xp[upper - 1])
+
+    rows = np.arange(fp.shape[0])[:, None]
+    flux = fp[rows, upper - 1] * (1 - t) + fp[rows, upper] * t
+    flux[(rest < xp[0]) | (rest > xp[-1])] = np.nan
+    return flux
+
+
+def _smooth(flux, R_scale, R):
+    """
+    Smooth fluxes with a Gaussian kernel of `R_scale/R` pixels. Fluxes with a
+    non-positive resolution are not smoothed.
+
+    :param flux:
+        The fluxes, either as an array of shape (N_pixels, ) or as an array of
+        shape (N_theta, N_pixels).
+
+    :type flux:
+        :class:`numpy.array`
+
+    :param R_scale:
+        The kernel width in pixels at unit resolution.
+
+    :type R_scale:
+        float
+
+    :param R:
+        The resolution, or an array of resolutions for each row of `flux`.
+
+    :type R:
+        float or :class:`numpy.array`
+    """
+
+    if np.ndim(R) == 0:
+        return gaussian_filter1d(flux, R_scale/R) if R > 0 else flux
+
+    flux = np.array(flux, dtype=float)
+    R = np.ones(flux.shape[0]) * R
+    for value in np.unique(R[R > 0]):
+        rows = (R == value)
+        flux[rows] = gaussian_filter1d(flux[rows], R_scale/value, axis=-1)
+    return flux
+
+
+def _by_group(function, flux, z, R, decimals=None):
+    """
+    Apply a convolution function to each group of fluxes that share the same
+    redshift and resolution.
+
+    :param function:
+        A function that takes fluxes, a redshift and a resolution.
+
+    :type function:
+        callable
+
+    :param flux:
+        The fluxes, either as an array of shape (N_pixels, ) or as an array of
+        shape (N_theta, N_pixels).
+
+    :type flux:
+        :class:`numpy.array`
+
+    :param z:
+        The redshift, or an array of redshifts for each row of `flux`.
+
+    :type z:
+        float or :class:`numpy.array`
+
+    :param R:
+        The resolution, or an array of resolutions for each row of `flux`.
+
+    :type R:
+        float or :class:`numpy.array`
+
+    :param decimals: [optional]
+        The number of decimal places (or None) to round the redshift and the
+        resolution to before grouping them. This should match any rounding done
+        by the function (e.g., by its cache), so that rows which would share a
+        result are convolved together. By default they are not rounded.
+
+    :type decimals:
+        tuple
+    """
+
+    if np.ndim(flux) == 1 and np.ndim(z) == 0 and np.ndim(R) == 0:
+        return function(flux, z, R)
+
+    flux = np.atleast_2d(flux)
+    z = np.ones(flux.shape[0]) * z
+    R = np.ones(flux.shape[0]) * R
+    z_decimals, R_decimals = decimals or (None, None)
+    if z_decimals is not None:
+        z = np.round(z, z_decimals)
+    if R_decimals is not None:
+        R = np.round(R, R_decimals)
+
+    groups = OrderedDict()
+    for i, key in enumerate(zip(z, R)):
+        groups.setdefault(key, []).append(i)
+
+    output = None
+    for (z_, R_), rows in groups.items():
+        result = function(flux[rows], z_, R_)
+        if output is None:
+            output = np.zeros((flux.shape[0], result.shape[1]))
+        output[rows] = result
+    return output
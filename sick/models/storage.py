@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Storage formats for model intensities """
+
+from __future__ import division, print_function
+
+__all__ = ("ChunkedIntensities", "ChunkedIntensitiesWriter",
+    "load_intensities", "create_intensities", "transpose_intensities")
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import cPickle as pickle
+import logging
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger("sick")
+
+# Chunked files start with this, and end with the offset of the header.
+_MAGIC = b"SICKCHNK"
+_TRAILER = "<Q"
+
+# The filename suffixes for intensities in each storage format.
+suffixes = {
+    "memmap": "-intensities.memmap",
+    "chunked": "-intensities.chunks"
+}
+
+
+def _shuffle(buffer, itemsize):
+    """ Group the n-th bytes of every value together, which compresses well. """
+    return np.frombuffer(buffer, dtype=np.uint8)\
+        .reshape(-1, itemsize).T.tobytes()
+
+
+def _unshuffle(buffer, itemsize):
+    """ Reverse the byte shuffle applied by `_shuffle`. """
+    return np.frombuffer(buffer, dtype=np.uint8)\
+        .reshape(itemsize, -1).T.tobytes()
+
+
+class ChunkedIntensities(object):
+    """
+    Read-only access to model intensities that are stored in chunks of grid
+    points and channels. Indexing returns float32 arrays, as for a memory-mapped
+    intensities file, but only the chunks that are needed are read from disk.
+    If both the grid points and pixels are indexed by arrays then they are
+    indexed independently, as with :func:`numpy.ix_`.
+
+    :param filename:
+        The path of the chunked intensities file.
+
+    :type filename:
+        str
+
+    :param cache_size: [optional]
+        The number of decoded chunks to keep in memory, so that consecutive
+        reads from the same chunks do not read and decompress them again. By
+        default this is the number of channels.
+
+    :type cache_size:
+        int
+
+    :raises:
+        IOError if the file is not a chunked intensities file.
+    """
+
+    dtype = np.dtype("float32")
+    ndim = 2
+
+    def __init__(self, filename, cache_size=None):
+
+        self.filename = filename
+        with open(filename, "rb") as fp:
+            if fp.read(len(_MAGIC)) != _MAGIC:
+                raise IOError("{} is not a chunked intensities file".format(
+                    filename))
+
+            fp.seek(-struct.calcsize(_TRAILER), os.SEEK_END)
+            offset, = struct.unpack(_TRAILER,
+                fp.read(struct.calcsize(_TRAILER)))
+            fp.seek(offset)
+            header = pickle.load(fp)
+
+        self.shape = tuple(header["shape"])
+        self.block_size = header["block_size"]
+        self.channel_sizes = list(header["channel_sizes"])
+        self.storage_dtype = np.dtype(header["dtype"])
+        self.compression = header["compression"]
+        self._chunks = header["chunks"]
+        self._channel_edges = np.cumsum([0] + self.channel_sizes)
+
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_size = len(self.channel_sizes) \
+            if cache_size is None else cache_size
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+
+    def _read_chunk(self, fp, block, channel, rows=None):
+        """
+        Return the intensities stored in a chunk.
+
+        :param fp:
+            An open file handle to read from.
+
+        :type fp:
+            file
+
+        :param block:
+            The index of the block of grid points.
+
+        :type block:
+            int
+
+        :param channel:
+            The index of the channel.
+
+        :type channel:
+            int
+
+        :param rows: [optional]
+            The sorted rows of the chunk that are needed. If the chunk is not
+            compressed and is not already in memory, only the rows between the
+            first and last of these are read, and the returned array starts at
+            the first of them. The partial chunk is not cached.
+
+        :type rows:
+            :class:`numpy.array`
+        """
+
+        key = (block, channel)
+        try:
+            with self._cache_lock:
+                chunk = self._cache.pop(key)
+
+        except KeyError:
+            offset, length = self._chunks[block, channel]
+            num_rows = min(self.block_size, self.shape[0] - block*self.block_size)
+
+            if rows is not None and self.compression is None \
+            and rows[-1] - rows[0] + 1 < num_rows:
+                row_length = length // num_rows
+                fp.seek(offset + rows[0] * row_length)
+                buffer = fp.read((rows[-1] - rows[0] + 1) * row_length)
+                return np.frombuffer(buffer, dtype=self.storage_dtype)\
+                    .reshape(rows[-1] - rows[0] + 1, -1)
+
+            fp.seek(offset)
+            buffer = fp.read(length)
+            if self.compression == "zlib":
+                buffer = _unshuffle(zlib.decompress(buffer),
+                    self.storage_dtype.itemsize)
+
+            chunk = np.frombuffer(buffer, dtype=self.storage_dtype)\
+                .reshape(num_rows, -1)
+
+        if self._cache_size > 0:
+            with self._cache_lock:
+                self._cache.pop(key, None)
+                while len(self._cache) >= self._cache_size:
+                    self._cache.popitem(last=False)
+                self._cache[key] = chunk
+        if rows is not None:
+            return chunk[rows[0]:]
+        return chunk
+
+
+    def __getitem__(self, key):
+
+        rows_key, cols_key = key if isinstance(key, tuple) \
+            else (key, slice(None))
+
+        rows = np.arange(self.shape[0])[rows_key]
+        cols = np.arange(self.shape[1])[cols_key]
+        shape = rows.shape + cols.shape
+        rows, cols = np.atleast_1d(rows), np.atleast_1d(cols)
+
+        intensities = np.empty((rows.size, cols.size), dtype=self.dtype)
+        if intensities.size == 0:
+            return intensities.reshape(shape)
+
+        # Group the requested rows by block and the columns by channel, so that
+        # each chunk is read once no matter how the rows are ordered.
+        row_order = np.argsort(rows, kind="mergesort")
+        blocks, row_starts = np.unique(rows[row_order] // self.block_size,
+            return_index=True)
+        row_groups = np.split(row_order, row_starts[1:])
+
+        col_order = np.argsort(cols, kind="mergesort")
+        channels, col_starts = np.unique(self._channel_edges.searchsorted(
+            cols[col_order], side="right") - 1, return_index=True)
+        col_groups = np.split(col_order, col_starts[1:])
+
+        with open(self.filename, "rb") as fp:
+            for block, r in zip(blocks, row_groups):
+                chunk_rows = rows[r] - block*self.block_size
+                for channel, c in zip(channels, col_groups):
+                    chunk = self._read_chunk(fp, block, channel, chunk_rows)
+                    intensities[np.ix_(r, c)] = chunk[np.ix_(
+                        chunk_rows - chunk_rows[0],
+                        cols[c] - self._channel_edges[channel])]
+
+        return intensities.reshape(shape)
+
+
+
+class ChunkedIntensitiesWriter(object):
+    """
+    Write model intensities in chunks of grid points and channels. Values are
+    assigned like a memory-mapped array, but grid points must be written in
+    order because each block of grid points is written to disk once the next
+    block is started. Any values that are not assigned are zero. The file is
+    complete once `flush` is called.
+
+    :param filename:
+        The path to write the chunked intensities to.
+
+    :type filename:
+        str
+
+    :param shape:
+        The number of grid points and the total number of pixels.
+
+    :type shape:
+        tuple
+
+    :param channel_sizes:
+        The number of pixels in each channel.
+
+    :type channel_sizes:
+        list of int
+
+    :param block_size: [optional]
+        The number of grid points in each chunk.
+
+    :type block_size:
+        int
+
+    :param dtype: [optional]
+        The data type to store the intensities as: `float32` or `float16`.
+
+    :type dtype:
+        str
+
+    :param compression: [optional]
+        Compress each chunk losslessly. Available options are `None` or `zlib`.
+
+    :type compression:
+        str
+
+    :param compression_level: [optional]
+        The zlib compression level, between 1 (fastest) and 9 (smallest).
+
+    :type compression_level:
+        int
+    """
+
+    def __init__(self, filename, shape, channel_sizes, block_size=64,
+        dtype="float32", compression=None, compression_level=6):
+
+        if len(shape) != 2 or sum(channel_sizes) != shape[1]:
+            raise ValueError("the channel sizes must sum to the number of "
+                "pixels")
+
+        if np.dtype(dtype) not in (np.float16, np.float32):
+            raise ValueError("dtype must be either float16 or float32")
+
+        if compression not in (None, "zlib"):
+            raise ValueError("compression must be either None or `zlib`")
+
+        if 1 > block_size:
+            raise ValueError("block size must be a positive integer")
+
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.block_size = int(block_size)
+        self.channel_sizes = list(channel_sizes)
+        self.storage_dtype = np.dtype(dtype)
+        self.compression = compression
+        self.compression_level = compression_level
+
+        self._channel_edges = np.cumsum([0] + self.channel_sizes)
+        num_blocks = int(np.ceil(self.shape[0] / self.block_size))
+        self._chunks = np.zeros((num_blocks, len(self.channel_sizes), 2),
+            dtype=np.int64)
+        self._buffer = np.zeros((self.block_size, self.shape[1]),
+            dtype=np.float32)
+        self._block = 0
+
+        self._fp = open(filename, "wb")
+        self._fp.write(_MAGIC)
+
+
+    def __setitem__(self, key, value):
+
+        if self._fp is None:
+            raise IOError("{} has already been flushed".format(self.filename))
+
+        rows_key, cols_key = key if isinstance(key, tuple) \
+            else (key, slice(None))
+
+        rows = np.atleast_1d(np.arange(self.shape[0])[rows_key])
+        cols = np.atleast_1d(np.arange(self.shape[1])[cols_key])
+        values = np.empty((rows.size, cols.size), dtype=np.float32)
+        values[:] = value
+
+        blocks = rows // self.block_size
+        for block in np.unique(blocks):
+            if block < self._block:
+                raise ValueError("intensities must be written in order of grid "
+                    "point, but block {0} has already been written".format(
+                        block))
+
+            while block > self._block:
+                self._write_block()
+
+            r = np.where(blocks == block)[0]
+            self._buffer[np.ix_(rows[r] - block*self.block_size, cols)] \
+                = values[r]
+
+
+    def _write_block(self):
+        """ Write the current block of grid points to disk, one chunk per
+        channel. """
+
+        rows = min(self.block_size, self.shape[0] - self._block*self.block_size)
+        for channel, (start, end) \
+        in enumerate(zip(self._channel_edges[:-1], self._channel_edges[1:])):
+
+            buffer = self._buffer[:rows, start:end]\
+                .astype(self.storage_dtype).tobytes()
+            if self.compression == "zlib":
+                buffer = zlib.compress(
+                    _shuffle(buffer, self.storage_dtype.itemsize),
+                    self.compression_level)
+
+            self._chunks[self._block, channel] = (self._fp.tell(), len(buffer))
+            self._fp.write(buffer)
+
+        self._buffer[:] = 0
+        self._block += 1
+
+
+    def flush(self):
+        """
+        Write all remaining grid points and the file header to disk. No more
+        intensities can be written afterwards.
+        """
+
+        if self._fp is None:
+            return None
+
+        while self._chunks.shape[0] > self._block:
+            self._write_block()
+
+        offset = self._fp.tell()
+        pickle.dump({
+            "shape": self.shape,
+            "block_size": self.block_size,
+            "channel_sizes": self.channel_sizes,
+            "dtype": self.storage_dtype.str,
+            "compression": self.compression,
+            "chunks": self._chunks
+        }, self._fp, -1)
+        self._fp.write(struct.pack(_TRAILER, offset))
+        self._fp.close()
+        self._fp = None
+
+        logger.debug("Wrote {0} chunks of intensities to {1}".format(
+            self._chunks.shape[0] * self._chunks.shape[1], self.filename))
+
+
+
+def load_intensities(filename, shape, format="memmap", **kwargs):
+    """
+    Return read-only access to model intensities.
+
+    :param filename:
+        The path of the intensities file.
+
+    :type filename:
+        str
+
+    :param shape:
+        The number of grid points and the total number of pixels.
+
+    :type shape:
+        tuple
+
+    :param format: [optional]
+        The storage format of the intensities: `memmap` or `chunked`.
+
+    :type format:
+        str
+    """
+
+    if format == "memmap":
+        return np.memmap(filename, dtype="float32", mode="r", shape=shape)
+
+    elif format == "chunked":
+        intensities = ChunkedIntensities(filename, **kwargs)
+        if intensities.shape != tuple(shape):
+            raise ValueError("expected intensities of shape {0} in {1} but "
+                "found {2}".format(shape, filename, intensities.shape))
+        return intensities
+
+    raise ValueError("intensities format must be either `memmap` or `chunked`")
+
+
+def create_intensities(filename, shape, channel_sizes, format="memmap",
+    **kwargs):
+    """
+    Create a new intensities file to write to. The intensities are complete
+    once the `flush` method of the returned object has been called.
+
+    :param filename:
+        The path of the intensities file.
+
+    :type filename:
+        str
+
+    :param shape:
+        The number of grid points and the total number of pixels.
+
+    :type shape:
+        tuple
+
+    :param channel_sizes:
+        The number of pixels in each channel.
+
+    :type channel_sizes:
+        list of int
+
+    :param format: [optional]
+        The storage format of the intensities: `memmap` or `chunked`. Any
+        additional keyword arguments are passed to
+        :class:`ChunkedIntensitiesWriter`.
+
+    :type format:
+        str
+    """
+
+    if format == "memmap":
+        return np.memmap(filename, dtype="float32", mode="w+", shape=shape)
+
+    elif format == "chunked":
+        return ChunkedIntensitiesWriter(filename, shape, channel_sizes,
+            **kwargs)
+
+    raise ValueError("intensities format must be either `memmap` or `chunked`")
+
+
+def transpose_intensities(intensities, filename=None, block_size=64):
+    """
+    Return a pixel-major copy of model intensities, as an array of shape
+    (N_pixels, N_points), so that the intensities of each pixel across the grid
+    are contiguous. The intensities are copied in blocks of grid points to bound
+    memory use.
+
+    :param intensities:
+        The intensities of all grid points, in any storage format.
+
+    :param filename: [optional]
+        The path of a memory-mapped file to write the pixel-major intensities
+        to. By default they are kept in memory.
+
+    :type filename:
+        str
+
+    :param block_size: [optional]
+        The number of grid points to copy at once.
+
+    :type block_size:
+        int
+    """
+
+    N_points, N_pixels = intensities.shape
+    if filename is None:
+        transposed = np.empty((N_pixels, N_points), dtype="float32")
+    else:
+        transposed = np.memmap(filename, dtype="float32", mode="w+",
+            shape=(N_pixels, N_points))
+
+    for i in xrange(0, N_points, block_size):
+        transposed[:, i:i + block_size] = intensities[i:i + block_size].T
+
+    if filename is not None:
+        transposed.flush()
+        del transposed
+        transposed = np.memmap(filename, dtype="float32", mode="r",
+            shape=(N_pixels, N_points))
+    return transposed
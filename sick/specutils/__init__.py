@@ -1,4 +1,4 @@
 
 
-from . import sample
+from . import (ccf, sample)
 from spectrum1d import Spectrum1D
\ No newline at end of file
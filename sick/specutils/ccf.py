@@ -6,23 +6,74 @@ from __future__ import division, print_function
 
 __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
-__all__ = ["Spectrum1D"]
+__all__ = ["cross_correlate", "CCFBank"]
+
+import cPickle as pickle
 
 import numpy as np
 from scipy.optimize import curve_fit
 from astropy.constants import c as speed_of_light
 
+try:
+    from scipy.fftpack import next_fast_len
+
+except ImportError:
+    # Older versions of scipy do not have next_fast_len.
+    def next_fast_len(target):
+        """ Return the smallest 5-smooth number that is at least target. """
+        if target <= 6:
+            return max(1, int(target))
+        best = 2**int(np.ceil(np.log2(target)))
+        p5 = 1
+        while p5 < best:
+            p35 = p5
+            while p35 < best:
+                p235 = p35 * 2**int(np.ceil(np.log2(target / p35)))
+                if target <= p235 < best:
+                    best = p235
+                p35 *= 3
+            p5 *= 5
+        return best
+
 from .sample import resample
 
 c = speed_of_light.to("km/s").value
 
 def cross_correlate(observed, template_dispersion, template_fluxes,
     rebin="template", wavelength_range=None, continuum_degree=-1,
-    apodize=0.10, rescale=False, z_limits=None, full_output=False):
+    apodize=0.10, rescale=False, z_limits=None, full_output=False,
+    batch_size=256, pad=True, bank=None):
     """
     Cross-correlate the observed spectrum against template fluxes.
+
+    :param rebin: [optional]
+        Where to resample the spectra: onto the observed dispersion map
+        (`template`), onto the template dispersion map (`observed`), or put
+        both onto a shared uniform log-wavelength grid (`log`), where each lag
+        is a constant velocity step. The `rescale` option is ignored for `log`.
+        In `log` mode a :class:`CCFBank` is built from the templates on every
+        call, so pass a prebuilt `bank` when correlating many spectra against
+        the same templates.
+
+    :param batch_size: [optional]
+        The maximum number of templates to correlate at once.
+
+    :param pad: [optional]
+        Zero-pad the apodized spectra to a length that the FFT can transform
+        quickly. The redshift array is extended to account for the padding.
+
+    :param bank: [optional]
+        A prebuilt :class:`CCFBank` to cross-correlate against in `log` mode.
+        If given, the template dispersion and fluxes are not used and can be
+        `None`.
     """
 
+    if bank is not None:
+        if wavelength_range is not None:
+            raise ValueError("wavelength range cannot be used with a CCF bank")
+        return bank.cross_correlate(observed, continuum_degree=continuum_degree,
+            z_limits=z_limits, batch_size=int(batch_size))
+
     template_fluxes = np.atleast_2d(template_fluxes)
     template_dispersion = np.array(template_dispersion)
     if template_dispersion.shape[0] != template_fluxes.shape[1]:
@@ -37,7 +88,31 @@ def cross_correlate(observed, template_dispersion, template_fluxes,
     if not (1 > apodize >= 0):
         raise ValueError("apodize fraction must be between 0 and 1")
 
-    if rebin.lower() == "template":
+    batch_size = int(batch_size)
+    if 1 > batch_size:
+        raise ValueError("batch size must be a positive integer")
+
+    if rebin.lower() == "log":
+        # Put the observed and template fluxes onto a shared log-wavelength grid
+        # that spans the region where they overlap.
+        limits = [max(template_dispersion[0], observed.disp[0]),
+            min(template_dispersion[-1], observed.disp[-1])]
+        if wavelength_range is not None:
+            if not isinstance(wavelength_range, (tuple, list, np.ndarray)) \
+            or len(wavelength_range) != 2:
+                raise TypeError("wavelength range must be a two length tuple")
+            limits = [max(limits[0], wavelength_range[0]),
+                min(limits[1], wavelength_range[1])]
+
+        indices = np.clip(template_dispersion.searchsorted(limits) + [0, 1],
+            0, template_dispersion.size)
+        bank = CCFBank.build(template_dispersion[indices[0]:indices[1]],
+            template_fluxes[:, indices[0]:indices[1]], apodize=apodize,
+            batch_size=batch_size)
+        return bank.cross_correlate(observed, continuum_degree=continuum_degree,
+            z_limits=z_limits, batch_size=batch_size)
+
+    elif rebin.lower() == "template":
         # Put the template fluxes onto the observed dispersion map.
         dispersion = observed.disp
         template_flux = template_fluxes \
@@ -54,7 +129,8 @@ def cross_correlate(observed, template_dispersion, template_fluxes,
         observed_ivar = observed.ivariance.copy() * mat
         
     else:
-        raise ValueError("rebin must be either `template` or `observed`")
+        raise ValueError("rebin must be either `template`, `observed` or "\
+            "`log`")
 
     if wavelength_range is not None:
         if not isinstance(wavelength_range, (tuple, list, np.ndarray)) \
@@ -105,55 +181,27 @@ def cross_correlate(observed, template_dispersion, template_fluxes,
             + template_flux.min()
 
     # Apodize edges.
-    edge_buffer = apodize * (dispersion[-1] - dispersion[0])
-    low_w_indices = np.nonzero(dispersion < dispersion[0] + edge_buffer)[0]
-    high_w_indices = np.nonzero(dispersion > dispersion[-1] - edge_buffer)[0]
-
-    apod_curve = np.ones(N, dtype='d')
-    apod_curve[low_w_indices] = (1.0 + np.cos(np.pi*(
-        1.0 - (dispersion[low_w_indices] - dispersion[0])/edge_buffer)))/2.
-    apod_curve[high_w_indices] = (1.0 + np.cos(np.pi*(
-        1.0 - (dispersion[-1] - dispersion[high_w_indices])/edge_buffer)))/2.
-
+    apod_curve = _apodization_curve(dispersion, apodize)
     apod_observed_flux = observed_flux * apod_curve
     apod_template_flux = template_flux * apod_curve
 
-    fft_observed_flux = np.fft.fft(apod_observed_flux)
-    fft_template_flux = np.fft.fft(apod_template_flux)
-    template_flux_corr = (fft_observed_flux * fft_template_flux.conjugate())
-    template_flux_corr /= np.sqrt(
-        np.inner(apod_observed_flux, apod_observed_flux))
+    # The spectra are real, so we only need the positive frequencies.
+    L = next_fast_len(N) if pad else N
+    fft_observed_flux = np.fft.rfft(apod_observed_flux, L)
+    observed_norm = np.sqrt(np.inner(apod_observed_flux, apod_observed_flux))
 
-    z_array = np.array(dispersion.copy())/dispersion[N/2] - 1.0
+    z_array = _lag_redshifts(dispersion, L)
 
+    # Correlate the templates in batches, so that memory use is bounded by the
+    # batch size rather than the number of templates.
     z = np.ones(N_templates) * np.nan
     z_err = np.ones(N_templates) * np.nan
     R = np.ones(N_templates) * np.nan
-    for i in range(N_templates):
-
-        denominator = np.sqrt(
-            np.inner(apod_template_flux[i, :], apod_template_flux[i, :]))
-        flux_correlation = template_flux_corr[i, :] / denominator 
-        correlation = np.fft.ifft(flux_correlation).real
-
-        # Reflect about zero
-        ccf = np.zeros(N)
-        ccf[:N/2] = correlation[N/2:]
-        ccf[N/2:] = correlation[:N/2]
-
-        # Get height and redshift of best peak
-        h = ccf.max()
-
-        # Scale the CCF
-        #ccf -= ccf.min()
-        #ccf *= (h/ccf.max())
-        
-        R[i] = h
-        z[i] = z_array[ccf.argmax()]
-        try:
-            z_err[i] = (np.ptp(z_array[np.where(ccf >= 0.5*h)])/2.35482)**2
-        except ValueError:
-            continue
+    for start in range(0, N_templates, batch_size):
+        batch = slice(start, start + batch_size)
+        ccf = _correlate(fft_observed_flux, observed_norm,
+            apod_template_flux[batch], L)
+        z[batch], z_err[batch], R[batch] = _measure_peaks(ccf, z_array)
 
     # Limits:
     if z_limits is not None:
@@ -161,31 +209,10 @@ def cross_correlate(observed, template_dispersion, template_fluxes,
 
     # Re-measure the velocity at the best peak.
     index = np.nanargmax(R)
+    ccf = _correlate(fft_observed_flux, observed_norm,
+        apod_template_flux[[index]], L)[0]
 
-    denominator = np.sqrt(
-        np.inner(apod_template_flux[index, :], apod_template_flux[index, :]))
-
-    flux_correlation = template_flux_corr[index, :] / denominator
-    correlation = np.fft.ifft(flux_correlation).real
-
-    # FReflect about zero.
-    ccf = np.zeros(N)
-    ccf[:N/2] = correlation[N/2:]
-    ccf[N/2:] = correlation[:N/2]
-
-    h = ccf.max()
-    ccf -= ccf.min()
-    ccf *= h/ccf.max()
-
-    # Fit +/- 5 pixels
-    idx = np.argmax(ccf) - 3, np.argmax(ccf) + 3
-
-    coeffs = np.polyfit(z_array[idx[0]:idx[1]], ccf[idx[0]:idx[1]], 2)
-    x_i = np.linspace(z_array[idx[0]], z_array[idx[1]], 1000)
-    y_i = np.polyval(coeffs, x_i)
-
-    # Update the value
-    z[index] = x_i[y_i.argmax()]
+    z[index] = _refine_peak(ccf, z_array)
 
     """
     # Fit the profile peak.
@@ -214,3 +241,404 @@ def cross_correlate(observed, template_dispersion, template_fluxes,
     return (z * c, z_err * c, R)
 
 
+def _lag_redshifts(dispersion, L):
+    """
+    Return the redshift at each lag of a cross-correlation function of length
+    L that has been reflected about zero lag. Lags beyond the dispersion array
+    (from zero-padding) are extrapolated from the pixel size at each edge.
+    """
+
+    N = dispersion.size
+    positions = N//2 + np.arange(L) - L//2
+    wavelengths = np.interp(positions, np.arange(N), dispersion)
+
+    lower, upper = (positions < 0, positions > N - 1)
+    wavelengths[lower] = dispersion[0] \
+        + positions[lower] * (dispersion[1] - dispersion[0])
+    wavelengths[upper] = dispersion[-1] \
+        + (positions[upper] - N + 1) * (dispersion[-1] - dispersion[-2])
+    return wavelengths/dispersion[N//2] - 1.0
+
+
+def _apodization_curve(dispersion, apodize):
+    """
+    Return a cosine bell that tapers the edges of a spectrum to zero.
+
+    :param dispersion:
+        The dispersion points of the spectrum.
+
+    :param apodize:
+        The fraction of the dispersion range to taper at each edge.
+    """
+
+    edge_buffer = apodize * (dispersion[-1] - dispersion[0])
+    low_w_indices = np.nonzero(dispersion < dispersion[0] + edge_buffer)[0]
+    high_w_indices = np.nonzero(dispersion > dispersion[-1] - edge_buffer)[0]
+
+    apod_curve = np.ones(dispersion.size, dtype='d')
+    apod_curve[low_w_indices] = (1.0 + np.cos(np.pi*(
+        1.0 - (dispersion[low_w_indices] - dispersion[0])/edge_buffer)))/2.
+    apod_curve[high_w_indices] = (1.0 + np.cos(np.pi*(
+        1.0 - (dispersion[-1] - dispersion[high_w_indices])/edge_buffer)))/2.
+    return apod_curve
+
+
+def _correlate(fft_observed_flux, observed_norm, apod_template_flux, L):
+    """
+    Return the normalised cross-correlation functions of a block of apodized
+    template fluxes with shape (N_templates, N), zero-padded to length L and
+    reflected about zero lag.
+    """
+
+    return _correlate_transformed(fft_observed_flux, observed_norm,
+        np.fft.rfft(apod_template_flux, L, axis=1),
+        np.sqrt(np.sum(apod_template_flux**2, axis=1)), L)
+
+
+def _correlate_transformed(fft_observed_flux, observed_norm, fft_template_flux,
+    template_norms, L):
+    """
+    Return the normalised cross-correlation functions for a block of templates
+    that have already been apodized and Fourier-transformed to length L.
+    """
+
+    correlation = np.fft.irfft(
+        fft_observed_flux * fft_template_flux.conjugate(), L, axis=1)
+    correlation /= observed_norm * template_norms[:, None]
+    return np.fft.fftshift(correlation, axes=1)
+
+
+def _measure_peaks(ccf, z_array):
+    """
+    Return the redshift, squared peak width and height of the highest peak in
+    each row of a block of cross-correlation functions.
+    """
+
+    R = ccf.max(axis=1)
+    z = z_array[ccf.argmax(axis=1)]
+
+    # The width is measured from the points above half of the peak height.
+    above = ccf >= 0.5 * R[:, None]
+    first = above.argmax(axis=1)
+    last = ccf.shape[1] - 1 - above[:, ::-1].argmax(axis=1)
+    z_err = np.where(above.any(axis=1),
+        ((z_array[last] - z_array[first])/2.35482)**2, np.nan)
+    return (z, z_err, R)
+
+
+def _refine_peak(ccf, z_array):
+    """
+    Return the redshift of the highest peak in a cross-correlation function,
+    refined by fitting a quadratic to the points around the peak.
+    """
+
+    h = ccf.max()
+    ccf = ccf - ccf.min()
+    ccf *= h/ccf.max()
+
+    # Fit +/- 5 pixels
+    idx = np.argmax(ccf) - 3, np.argmax(ccf) + 3
+
+    coeffs = np.polyfit(z_array[idx[0]:idx[1]], ccf[idx[0]:idx[1]], 2)
+    x_i = np.linspace(z_array[idx[0]], z_array[idx[1]], 1000)
+    y_i = np.polyval(coeffs, x_i)
+
+    return x_i[y_i.argmax()]
+
+
+class CCFBank(object):
+
+    """
+    A bank of template spectra that have been resampled onto a uniform grid in
+    log-wavelength, apodized, and Fourier-transformed, so that many observed
+    spectra can be cross-correlated against the same templates without
+    repeating any work on the template side. On a log-wavelength grid each lag
+    is a constant velocity step, so redshift is a pure shift.
+
+    :param dispersion:
+        The uniform log-wavelength dispersion points of the bank.
+
+    :type dispersion:
+        :class:`numpy.array`
+
+    :param fft_fluxes:
+        The Fourier-transformed, apodized template fluxes with shape
+        (N_templates, L//2 + 1).
+
+    :type fft_fluxes:
+        :class:`numpy.array`
+
+    :param norms:
+        The norm of each apodized template flux.
+
+    :type norms:
+        :class:`numpy.array`
+
+    :param L:
+        The (padded) length of the Fourier transforms.
+
+    :type L:
+        int
+
+    :param apodize: [optional]
+        The fraction of the dispersion range that was apodized at each edge.
+
+    :type apodize:
+        float
+
+    :param meta: [optional]
+        Metadata describing where the templates came from.
+
+    :type meta:
+        dict
+    """
+
+    def __init__(self, dispersion, fft_fluxes, norms, L, apodize=0.10,
+        meta=None):
+
+        self.dispersion = np.array(dispersion)
+        self.fft_fluxes = fft_fluxes
+        self.norms = np.array(norms)
+        self.L = int(L)
+        self.apodize = apodize
+        self.meta = meta if meta is not None else {}
+
+        # The step in log-wavelength between neighbouring pixels.
+        self._log_step = np.log(self.dispersion[-1]/self.dispersion[0]) \
+            / (self.dispersion.size - 1)
+        return None
+
+
+    def __len__(self):
+        return self.norms.size
+
+
+    @classmethod
+    def build(cls, template_dispersion, template_fluxes, apodize=0.10,
+        mask=None, batch_size=256, prefix=None, meta=None):
+        """
+        Build a bank from template spectra.
+
+        :param template_dispersion:
+            The dispersion points of the templates.
+
+        :type template_dispersion:
+            :class:`numpy.array`
+
+        :param template_fluxes:
+            The template fluxes with shape (N_templates, N_pixels). This can be
+            a memory-mapped array, as it is only read `batch_size` rows at a
+            time.
+
+        :type template_fluxes:
+            :class:`numpy.array`
+
+        :param apodize: [optional]
+            The fraction of the dispersion range to apodize at each edge.
+
+        :type apodize:
+            float
+
+        :param mask: [optional]
+            A boolean array of template pixels to use. Pixels that are not
+            used are treated as continuum.
+
+        :type mask:
+            :class:`numpy.array`
+
+        :param batch_size: [optional]
+            The maximum number of templates to transform at once.
+
+        :type batch_size:
+            int
+
+        :param prefix: [optional]
+            If given, the bank is saved to `prefix`.memmap and `prefix`.pkl
+            and the returned bank reads from the memory-mapped file.
+
+        :type prefix:
+            str
+
+        :param meta: [optional]
+            Metadata to store with the bank.
+
+        :type meta:
+            dict
+        """
+
+        if not (1 > apodize >= 0):
+            raise ValueError("apodize fraction must be between 0 and 1")
+
+        template_dispersion = np.array(template_dispersion)
+        N_templates, N = template_fluxes.shape
+        if template_dispersion.size != N:
+            raise ValueError("template dispersion must have size (N_pixels,) "\
+                "and template fluxes must have size (N_models, N_pixels)")
+
+        # Uniform grid in log-wavelength with the same number of pixels.
+        dispersion = np.exp(np.linspace(np.log(template_dispersion[0]),
+            np.log(template_dispersion[-1]), N))
+        matrix = resample(template_dispersion, dispersion)
+        apod_curve = _apodization_curve(dispersion, apodize)
+
+        L = next_fast_len(N)
+        shape = (N_templates, L//2 + 1)
+        if prefix is None:
+            fft_fluxes = np.zeros(shape, dtype=np.complex64)
+        else:
+            fft_fluxes = np.memmap(prefix + ".memmap", dtype=np.complex64,
+                mode="w+", shape=shape)
+
+        norms = np.zeros(N_templates)
+        for start in range(0, N_templates, batch_size):
+            batch = slice(start, start + batch_size)
+            fluxes = np.array(template_fluxes[batch], dtype=float)
+            if mask is not None:
+                fluxes[:, ~mask] = 1.0
+            fluxes = fluxes * matrix
+
+            # Treat non-finite template pixels as continuum.
+            fluxes[~np.isfinite(fluxes)] = 1.0
+            fluxes *= apod_curve
+
+            norms[batch] = np.sqrt(np.sum(fluxes**2, axis=1))
+            fft_fluxes[batch] = np.fft.rfft(fluxes, L, axis=1)
+
+        bank = cls(dispersion, fft_fluxes, norms, L, apodize=apodize, meta=meta)
+        if prefix is not None:
+            fft_fluxes.flush()
+            bank.fft_fluxes = np.memmap(prefix + ".memmap", dtype=np.complex64,
+                mode="r", shape=shape)
+            with open(prefix + ".pkl", "wb") as fp:
+                pickle.dump({
+                    "dispersion": dispersion,
+                    "norms": norms,
+                    "L": L,
+                    "apodize": apodize,
+                    "meta": bank.meta
+                }, fp, -1)
+        return bank
+
+
+    @classmethod
+    def load(cls, prefix):
+        """
+        Load a bank that was saved to `prefix`.memmap and `prefix`.pkl.
+
+        :param prefix:
+            The filename prefix of the saved bank.
+
+        :type prefix:
+            str
+
+        :raises:
+            IOError if the bank files do not exist.
+        """
+
+        with open(prefix + ".pkl", "rb") as fp:
+            contents = pickle.load(fp)
+
+        fft_fluxes = np.memmap(prefix + ".memmap", dtype=np.complex64,
+            mode="r", shape=(contents["norms"].size, contents["L"]//2 + 1))
+        return cls(contents["dispersion"], fft_fluxes, contents["norms"],
+            contents["L"], apodize=contents["apodize"], meta=contents["meta"])
+
+
+    def cross_correlate(self, observed, continuum_degree=-1, z_limits=None,
+        indices=None, batch_size=256):
+        """
+        Cross-correlate an observed spectrum against the templates in the bank.
+
+        :param observed:
+            The observed spectrum.
+
+        :type observed:
+            :class:`sick.specutils.Spectrum1D`
+
+        :param continuum_degree: [optional]
+            The degree of the polynomial used to normalise the observed flux.
+
+        :type continuum_degree:
+            int
+
+        :param z_limits: [optional]
+            Lower and upper limits on the redshift of the peak.
+
+        :type z_limits:
+            two length tuple
+
+        :param indices: [optional]
+            The templates to correlate against. Defaults to all templates.
+
+        :param batch_size: [optional]
+            The maximum number of templates to correlate at once.
+
+        :type batch_size:
+            int
+
+        :returns:
+            The velocity (km/s), velocity error and peak height for each of the
+            selected templates.
+        """
+
+        try:
+            continuum_degree = int(continuum_degree)
+        except (TypeError, ValueError):
+            raise TypeError("continuum order must be an integer-like object")
+
+        rows = np.arange(len(self))
+        if indices is not None:
+            rows = rows[indices]
+
+        # Put the observed spectrum onto the log-wavelength grid of the bank.
+        matrix = resample(observed.disp, self.dispersion)
+        observed_flux = observed.flux.copy() * matrix
+        observed_ivar = observed.ivariance.copy() * matrix
+
+        finite = np.isfinite(observed_flux * observed_ivar) \
+            * (observed_flux > 1e-3)
+        if not np.any(finite):
+            raise ValueError("no finite observed fluxes overlap the bank")
+
+        # Continuum.
+        if continuum_degree >= 0:
+            coefficients = np.polyfit(self.dispersion[finite],
+                observed_flux[finite], continuum_degree)
+            observed_flux /= np.polyval(coefficients, self.dispersion)
+
+        # Interpolate over non-finite pixels, and treat pixels outside of the
+        # observed spectrum as continuum.
+        observed_flux[~finite] = np.interp(self.dispersion[~finite],
+            self.dispersion[finite], observed_flux[finite], left=1, right=1)
+
+        apod_observed_flux = observed_flux \
+            * _apodization_curve(self.dispersion, self.apodize)
+        fft_observed_flux = np.fft.rfft(apod_observed_flux, self.L)
+        observed_norm = np.sqrt(np.inner(apod_observed_flux, apod_observed_flux))
+
+        # Each lag is a constant step in log-wavelength.
+        z_array = np.exp(self._log_step
+            * (np.arange(self.L) - self.L//2)) - 1.0
+
+        z = np.ones(rows.size) * np.nan
+        z_err = np.ones(rows.size) * np.nan
+        R = np.ones(rows.size) * np.nan
+        for start in range(0, rows.size, batch_size):
+            batch = slice(start, start + batch_size)
+            ccf = _correlate_transformed(fft_observed_flux, observed_norm,
+                np.array(self.fft_fluxes[rows[batch]]), self.norms[rows[batch]],
+                self.L)
+            z[batch], z_err[batch], R[batch] = _measure_peaks(ccf, z_array)
+
+        # Limits:
+        if z_limits is not None:
+            R[~((z_limits[1] >= z) * (z >= z_limits[0]))] = np.nan
+
+        # Re-measure the velocity at the best peak.
+        index = np.nanargmax(R)
+        ccf = _correlate_transformed(fft_observed_flux, observed_norm,
+            np.array(self.fft_fluxes[rows[[index]]]), self.norms[rows[[index]]],
+            self.L)[0]
+        z[index] = _refine_peak(ccf, z_array)
+
+        return (z * c, z_err * c, R)
@@ -74,6 +74,93 @@ def resample(old_wavelengths, new_wavelengths):
         :class:`numpy.array`
     """
 
+    old_wavelengths = np.asarray(old_wavelengths)
+    new_wavelengths = np.asarray(new_wavelengths)
+    return _resampling_matrix(old_wavelengths, new_wavelengths,
+        np.abs(np.diff(old_wavelengths)),
+        np.clip(np.arange(1, new_wavelengths.size + 1), 0,
+            new_wavelengths.size - 1))
+
+
+def _resampling_matrix(old_wavelengths, new_wavelengths, old_pixel_widths,
+    next_indices):
+    """
+    Build the flux-conserving resampling matrix with bulk array operations.
+
+    :param old_wavelengths:
+        The original wavelengths array.
+
+    :param new_wavelengths:
+        The new wavelengths array to resample onto.
+
+    :param old_pixel_widths:
+        The absolute differences between consecutive old wavelengths.
+
+    :param next_indices:
+        The index of the next new wavelength pixel, for every new pixel
+        (clipped at the last pixel).
+    """
+
+    N, M = (new_wavelengths.size, old_wavelengths.size)
+
+    # These indices should span just over each new wavelength pixel.
+    lower = old_wavelengths.searchsorted(new_wavelengths, side="left")
+    upper = np.append(lower[1:], lower[-1])
+    lower, upper = (np.clip(lower - 1, 0, M - 1), np.clip(upper + 1, 0, M - 1))
+    lower, upper = (np.minimum(lower, upper), np.maximum(lower, upper))
+
+    # Pixels that span no old pixels are 'fake' pixels: they get a single NaN.
+    widths = upper - lower
+    fake = (widths == 0)
+    counts = np.where(fake, 1, widths)
+
+    # Positions of the first and last entry for every new pixel.
+    starts = np.cumsum(counts) - counts
+    ends = starts + counts - 1
+
+    # Edges are handled as fractions between rebinned pixels.
+    real = ~fake
+    l, u = (lower[real], upper[real])
+
+    data = np.ones(counts.sum())
+    data[starts[real]] = (old_wavelengths[l + 1] - new_wavelengths[real]) \
+        / old_pixel_widths[l]
+    data[ends[real]] = (new_wavelengths[next_indices[real]] \
+        - old_wavelengths[u - 1]) / old_pixel_widths[u - 1]
+
+    # Being binned to a single pixel. Prevent overflow from fringe cases.
+    data = np.clip(data, 0, 1)
+    data /= np.repeat(np.add.reduceat(data, starts), counts)
+    data[starts[fake]] = np.nan
+
+    # The old pixel indices are contiguous and sorted for every new pixel, so
+    # we can build the compressed sparse column structure directly.
+    old_px_indices = np.repeat(lower, counts) \
+        + np.arange(data.size) - np.repeat(starts, counts)
+    indptr = np.append(0, np.cumsum(counts))
+
+    return sparse.csc_matrix((data, old_px_indices, indptr), shape=(M, N))
+
+
+def _slow_resample(old_wavelengths, new_wavelengths):
+    """
+    Resample a spectrum to a new wavelengths map while conserving total flux,
+    one new pixel at a time. This is the reference implementation for
+    :func:`resample`.
+
+    :param old_wavelengths:
+        The original wavelengths array.
+
+    :type old_wavelengths:
+        :class:`numpy.array`
+
+    :param new_wavelengths:
+        The new wavelengths array to resample onto.
+
+    :type new_wavelengths:
+        :class:`numpy.array`
+    """
+
     data = []
     old_px_indices = []
     new_px_indices = []
@@ -170,115 +257,40 @@ class _BoxFactory(object):
 
     """
     For producing binning (box) matrices quickly on the fly.
+
+    Everything that does not depend on redshift is computed once when the
+    factory is created, so each new redshift only requires a vectorised fill
+    of the sparse matrix data and index arrays.
     """
 
     def __init__(self, to_wavelengths, from_wavelengths, linear_tolerance=1e-3):
 
-        self.to_wavelengths = to_wavelengths
-        self.from_wavelengths = from_wavelengths
+        self.to_wavelengths = np.asarray(to_wavelengths)
+        self.from_wavelengths = np.asarray(from_wavelengths)
         self.N, self.M = (to_wavelengths.size, from_wavelengths.size)
         self._scale = self.M/np.ptp(self.from_wavelengths)
         if not linear_tolerance >= np.std(np.diff(from_wavelengths)):
             logger.warn("from wavelengths scale might be non-linear")
 
+        # Redshift-independent structure of the binning matrix.
+        self._from_pixel_widths = np.abs(np.diff(self.from_wavelengths))
+        self._next_indices = np.clip(np.arange(1, self.N + 1), 0, self.N - 1)
+
 
-    @lru_cache(maxsize=LRU_SIZE, tol=6)
+    # Redshifts are rounded to this many decimal places, so that nearby
+    # redshifts share a cached matrix.
+    z_decimals = 6
+
+    @lru_cache(maxsize=LRU_SIZE, tol=z_decimals)
     def __call__(self, z=0, **kwargs):
         """
         Return a binning matrix for the given redshift based on the original
         wavelengths provided when the class was initiated.
         """
-        """
-        wavelengths = self.to_wavelengths * (1 + z)
-
-        # Map which pixels go to which index, assuming that the from_wavelengths
-        # scale is linear.
-        pixel_edges = np.hstack([
-            wavelengths[0] - (wavelengths[1] - wavelengths[0])/2.,
-            wavelengths[:-1] + np.diff(wavelengths)/2.,
-            wavelengths[-1] + (wavelengths[-1] - wavelengths[-2])/2.])
-
-        fractional_indices_scale = (pixel_edges - self.from_wavelengths[0]) \
-            * self._scale
-        int_fractional_indices_scale = fractional_indices_scale.astype(int)
-
-        upper_diagonals = 1 - fractional_indices_scale[:-1] % 1
-        lower_diagonals = fractional_indices_scale[1:] % 1
-        central_diagonal_pixel_width = np.diff(int_fractional_indices_scale) - 1
-
-        normalised_scale = 1.0/(upper_diagonals + central_diagonal_pixel_width \
-            + lower_diagonals)
-
-        # If the to_wavelength is linear then the normalised scale per pixel
-        # would be the same for every pixel. Let's not assume that..
-        px_normalised_scale = np.repeat(normalised_scale,
-            central_diagonal_pixel_width)
-
-        values = np.hstack([
-            upper_diagonals * normalised_scale,
-            lower_diagonals * normalised_scale,
-            np.ones(central_diagonal_pixel_width.sum()) * px_normalised_scale])
-
-        _ = np.arange(self.N)
-        y_indices = np.clip(
-            np.hstack([_, _, np.repeat(_, central_diagonal_pixel_width)]),
-                0, self.N - 1)
-        x_indices = np.clip(np.hstack([
-            int_fractional_indices_scale[:-1],
-            int_fractional_indices_scale[1:],
-            1 + np.repeat(int_fractional_indices_scale[:-1],
-                central_diagonal_pixel_width)
-            ]), 0, self.M - 1)
-
-        return sparse.coo_matrix((values, (x_indices, y_indices)),
-            shape=(self.M, self.N))
-        """
-
-        new_wavelengths = self.to_wavelengths * (1 + z)
-
-        data = []
-        old_px_indices = []
-        new_px_indices = []
-        for i, new_wl_i in enumerate(new_wavelengths):
 
-            # These indices should span just over the new wavelength pixel.
-            indices = np.unique(np.clip(
-                self.from_wavelengths.searchsorted(new_wavelengths[i:i + 2], side="left")\
-                    + [-1, +1], 0, self.from_wavelengths.size - 1))
-            N = np.ptp(indices)
-
-            if N == 0:
-                # 'Fake' pixel.
-                data.append(np.nan)
-                new_px_indices.append(i)
-                old_px_indices.extend(indices)
-                continue
-
-            # Sanity checks.
-            assert (self.from_wavelengths[indices[0]] <= new_wl_i \
-                or indices[0] == 0)
-            assert (new_wl_i <= self.from_wavelengths[indices[1]] \
-                or indices[1] == self.from_wavelengths.size - 1)
-
-            fractions = np.ones(N)
-
-            # Edges are handled as fractions between rebinned pixels.
-            _ = np.clip(i + 1, 0, new_wavelengths.size - 1)
-            lhs = self.from_wavelengths[indices[0]:indices[0] + 2]
-            rhs = self.from_wavelengths[indices[-1] - 1:indices[-1] + 1]
-            fractions[0]  = (lhs[1] - new_wavelengths[i])/np.ptp(lhs)
-            fractions[-1] = (new_wavelengths[_] - rhs[0])/np.ptp(rhs)
-
-            # Being binned to a single pixel. Prevent overflow from fringe cases.
-            fractions = np.clip(fractions, 0, 1)
-            fractions /= fractions.sum()
-
-            data.extend(fractions) 
-            new_px_indices.extend([i] * N) # Mark the new pixel indices affected.
-            old_px_indices.extend(np.arange(*indices)) # And the old pixel indices.
-
-        return sparse.csc_matrix((data, (old_px_indices, new_px_indices)),
-            shape=(self.from_wavelengths.size, new_wavelengths.size))
+        return _resampling_matrix(self.from_wavelengths,
+            self.to_wavelengths * (1 + z), self._from_pixel_widths,
+            self._next_indices)
 
 
 
@@ -301,7 +313,11 @@ class _BlurryBoxFactory(object):
         self.N, self.M = (to_wavelengths.size, from_wavelengths.size)
         
 
-    @lru_cache(maxsize=LRU_SIZE, tol=[0, 6])
+    # Resolutions and redshifts are rounded to these many decimal places, so
+    # that nearby values share a cached matrix.
+    resolution_decimals, z_decimals = 0, 6
+
+    @lru_cache(maxsize=LRU_SIZE, tol=[resolution_decimals, z_decimals])
     def __call__(self, resolution, z=0, **kwargs):
         """
         Return a binning matrix for the given resolution and optional redshift,
@@ -13,7 +13,7 @@ import os
 
 from astropy.io import fits
 
-from .ccf import cross_correlate as _cross_correlate
+from .ccf import (CCFBank, cross_correlate as _cross_correlate)
 
 logger = logging.getLogger("sick")
 
@@ -251,10 +251,14 @@ class Spectrum1D(object):
         # templates can be:
         # - a single Spectrum1D object
         # - (template_dispersion, template_fluxes)
+        # - a prebuilt CCFBank
 
         # templates can be a single spectrum or a tuple of (dispersion, fluxes)
 
-        if isinstance(templates, (Spectrum1D, )):
+        if isinstance(templates, CCFBank):
+            return _cross_correlate(self, None, None, bank=templates, **kwargs)
+
+        elif isinstance(templates, (Spectrum1D, )):
             template_dispersion = templates.disp
             template_fluxes = templates.flux
 
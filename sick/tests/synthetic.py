@@ -0,0 +1,166 @@
+# coding: utf-8
+
+""" Create small synthetic model grids for tests """
+
+from __future__ import division, print_function
+
+import cPickle as pickle
+import os
+import yaml
+
+import numpy as np
+
+import sick.specutils as specutils
+
+# The line centres, widths and sensitivities to the grid parameters are fixed so
+# that every grid point has a distinct spectrum.
+_random = np.random.RandomState(0)
+_centres = _random.uniform(5010, 5490, 40)
+_widths = _random.uniform(0.3, 0.8, 40)
+_depths = _random.uniform(0.2, 0.5, 40)
+_sensitivities = _random.normal(0, 0.15, size=(40, 3))
+
+
+def spectrum(wavelengths, point):
+    """
+    Return the synthetic spectrum at the given (teff, logg, feh) point.
+
+    :param wavelengths:
+        The rest wavelengths to calculate the spectrum at.
+
+    :type wavelengths:
+        :class:`numpy.array`
+
+    :param point:
+        The teff, logg and feh of the spectrum.
+
+    :type point:
+        iterable
+    """
+
+    teff, logg, feh = point
+    scaled = np.array([(teff - 5250)/750., (logg - 2.5)/1.5, (feh + 0.5)/0.5])
+    depths = np.clip(_depths + np.dot(_sensitivities, scaled), 0.02, 0.9)
+
+    flux = np.ones(len(wavelengths))
+    for centre, width, depth in zip(_centres, _widths, depths):
+        flux -= depth * np.exp(-0.5 * ((wavelengths - centre)/width)**2)
+    return flux
+
+
+def create_model(folder, teff=np.arange(4500, 6001, 250),
+    logg=np.arange(1, 4.1, 0.5), feh=np.arange(-1, 0.01, 0.25),
+    num_pixels=2000, configuration=None):
+    """
+    Create a model grid of synthetic spectra (in a single `blue` channel from
+    5000 to 5500 Angstroms) in the given folder, and return the filename of the
+    model configuration.
+
+    :param folder:
+        The folder to create the model files in.
+
+    :type folder:
+        str
+
+    :param teff: [optional]
+        The effective temperatures of the grid.
+
+    :param logg: [optional]
+        The surface gravities of the grid.
+
+    :param feh: [optional]
+        The metallicities of the grid.
+
+    :param num_pixels: [optional]
+        The number of model pixels.
+
+    :type num_pixels:
+        int
+
+    :param configuration: [optional]
+        Configuration entries to add to the default model configuration, which
+        has a redshift and a continuum of degree one.
+
+    :type configuration:
+        dict
+    """
+
+    prefix = os.path.join(folder, "synthetic")
+    names = ("teff", "logg", "feh")
+    grid_points = np.array([point for point in \
+        zip(*[_.flatten() for _ in np.meshgrid(teff, logg, feh, indexing="ij")])],
+        dtype=[(name, "<f8") for name in names])
+    wavelengths = np.linspace(5000, 5500, num_pixels)
+
+    memmap = np.memmap(prefix + "-wavelengths.memmap", dtype="float32",
+        mode="w+", shape=wavelengths.shape)
+    memmap[:] = wavelengths
+    memmap.flush()
+    del memmap
+
+    memmap = np.memmap(prefix + "-intensities.memmap", dtype="float32",
+        mode="w+", shape=(grid_points.size, num_pixels))
+    for i, point in enumerate(grid_points):
+        memmap[i] = spectrum(wavelengths, point)
+    memmap.flush()
+    del memmap
+
+    meta = {
+        "channel_names": ["blue"],
+        "channel_sizes": [num_pixels],
+        "channel_resolutions": [float("inf")]
+    }
+    with open(prefix + ".pkl", "wb") as fp:
+        pickle.dump((grid_points, meta), fp, -1)
+
+    content = {
+        "model_grid": {
+            "grid_points": prefix + ".pkl",
+            "intensities": prefix + "-intensities.memmap",
+            "wavelengths": prefix + "-wavelengths.memmap"
+        },
+        "model": {
+            "redshift": True,
+            "continuum": { "blue": 1 }
+        },
+        "settings": {}
+    }
+    for key, value in (configuration or {}).items():
+        content.setdefault(key, {}).update(value)
+
+    filename = prefix + ".yaml"
+    with open(filename, "w") as fp:
+        yaml.safe_dump(content, fp, default_flow_style=False)
+    return filename
+
+
+def observe(point, z=0, continuum=(1, 0), snr=100, seed=0,
+    wavelengths=np.linspace(5020, 5480, 1500)):
+    """
+    Return a noisy observation of the synthetic spectrum at the given point.
+
+    :param point:
+        The teff, logg and feh of the spectrum.
+
+    :param z: [optional]
+        The redshift of the spectrum.
+
+    :param continuum: [optional]
+        The continuum polynomial coefficients, with the constant term first.
+
+    :param snr: [optional]
+        The signal-to-noise ratio of the spectrum.
+
+    :param seed: [optional]
+        The seed for the random noise.
+
+    :param wavelengths: [optional]
+        The observed wavelengths.
+    """
+
+    flux = spectrum(wavelengths/(1 + z), point) \
+        * np.polyval(continuum[::-1], wavelengths)
+    sigma = np.median(flux)/snr
+    flux += np.random.RandomState(seed).normal(0, sigma, wavelengths.size)
+    return specutils.Spectrum1D(wavelengths, flux,
+        sigma**2 * np.ones(wavelengths.size))
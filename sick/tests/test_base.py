@@ -0,0 +1,49 @@
+# coding: utf-8
+
+""" Test the base model class """
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import sick.models as models
+from sick.tests import synthetic
+
+
+class NearestGridIndicesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.model = models.Model(synthetic.create_model(cls.folder))
+        cls.index = 123
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def test_nearest_grid_indices(self):
+        grid_points, scale = self.model._scaled_grid_points()
+        names = self.model.grid_points.dtype.names
+        random = np.random.RandomState(0)
+        points = np.vstack([
+            self.model.grid_points[[0, self.index]].view(float).reshape(2, -1),
+            random.uniform(grid_points.min(axis=0), grid_points.max(axis=0),
+                size=(3, len(names))) * scale])
+
+        # Both the k-d tree and the partial sort (for more than half of the
+        # grid) match a stable sort of all distances, including ties.
+        for N in (1, 7, 30, 200, grid_points.shape[0]):
+            indices = self.model._nearest_grid_indices(points, N)
+            self.assertEqual(indices.shape, (points.shape[0], N))
+            for point, actual in zip(points, indices):
+                distance = np.abs(grid_points - point/scale).sum(axis=1)
+                expected = np.argsort(distance, kind="mergesort")[:N]
+                self.assertEqual(list(actual), list(expected))
+
+            self.assertEqual(list(indices[0]),
+                list(self.model._nearest_grid_indices(points[0], N)))
@@ -0,0 +1,226 @@
+# coding: utf-8
+
+""" Test the log-probabilities of many walkers at once """
+
+from __future__ import division, print_function
+
+import cPickle as pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import sick.inference as inference
+import sick.models as models
+import sick.specutils as specutils
+from sick.models import generate
+from sick.tests import synthetic
+
+
+class SyntheticInferenceTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.model = models.Model(synthetic.create_model(cls.folder,
+            num_pixels=500, configuration={
+                "priors": { "teff": "uniform(4500, 6000)" }
+            }))
+        cls.data = [synthetic.observe([5250, 2.5, -0.5], z=1e-4,
+            continuum=(1.1, 0))]
+
+        cls.theta = cls.model.estimate(cls.data)
+        cls.matched_channels, _, ignore_parameters \
+            = cls.model._match_channels_to_data(cls.data)
+        cls.parameters = [p for p in cls.model.parameters \
+            if p not in ignore_parameters]
+        cls.model._initialise_approximator(force=True, closest_point=\
+            [cls.theta[p] for p in cls.model.grid_points.dtype.names])
+        cls.model._create_convolution_functions(cls.matched_channels, cls.data,
+            cls.parameters)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def _walkers(self):
+        random = np.random.RandomState(0)
+        theta = np.array([self.theta[p] for p in self.parameters])
+        scale = np.array([100, 0.2, 0.1, 0.01, 1e-7, 1e-5])
+        walkers = theta + scale * random.normal(size=(8, theta.size))
+
+        def walker(**kwargs):
+            position = theta.copy()
+            for parameter, value in kwargs.items():
+                position[self.parameters.index(parameter)] = value
+            return position
+
+        # Walkers outside the prior, outside the grid (non-finite model
+        # fluxes) and with a negative continuum.
+        return np.vstack([walkers, walker(teff=4400), walker(teff=7000),
+            walker(logg=0.5),
+            walker(continuum_blue_0=-1, continuum_blue_1=-1)])
+
+
+class BatchProbabilityTest(SyntheticInferenceTestCase):
+
+    def test_ln_probability_batch(self):
+        walkers = self._walkers()
+        expected = np.array([inference.ln_probability(walker, self.parameters,
+            self.model, self.data, matched_channels=self.matched_channels) \
+                for walker in walkers])
+        actual = inference.ln_probability_batch(walkers, self.parameters,
+            self.model, self.data, matched_channels=self.matched_channels)
+
+        self.assertTrue(np.all(np.isfinite(expected[:8])))
+        self.assertTrue(np.all(np.isneginf(expected[8:11])))
+
+        finite = np.isfinite(expected)
+        self.assertEqual(list(np.isfinite(actual)), list(finite))
+        self.assertTrue(np.all(np.isneginf(actual[~finite])))
+        self.assertTrue(np.allclose(actual[finite], expected[finite]))
+
+    def test_ln_prior_batch(self):
+        walkers = self._walkers()
+        theta = dict(zip(self.parameters, walkers.T))
+        theta.update({
+            "Po": np.linspace(-0.5, 1.5, walkers.shape[0]),
+            "Vo": np.linspace(-1, 1, walkers.shape[0])
+        })
+        expected = [inference.ln_prior(dict(zip(theta.keys(), values)),
+            self.model) for values in np.array(theta.values()).T]
+
+        priors = self.model._configuration["priors"]
+        self.assertTrue(np.allclose(inference.ln_prior_batch(theta,
+            self.model), expected))
+
+        # Priors that cannot be evaluated for arrays are evaluated per point.
+        priors["logg"] = "lambda x: 0 if x > 2.5 else -1"
+        try:
+            expected = [inference.ln_prior(dict(zip(theta.keys(), values)),
+                self.model) for values in np.array(theta.values()).T]
+            actual = inference.ln_prior_batch(theta, self.model)
+        finally:
+            del priors["logg"]
+        self.assertTrue(np.any(np.isfinite(expected)))
+        self.assertTrue(np.allclose(actual, expected))
+
+    def test_batch_pool(self):
+        walkers = self._walkers()
+        pool = inference.BatchPool(self.parameters, self.model, self.data,
+            matched_channels=self.matched_channels)
+        expected = inference.ln_probability_batch(walkers, self.parameters,
+            self.model, self.data, matched_channels=self.matched_channels)
+        self.assertTrue(np.allclose(pool.map(None, walkers), expected,
+            equal_nan=True))
+
+    def test_batch_call_without_fast_binning(self):
+        engine = generate.SpectrumEngine()
+        settings = self.model._configuration["settings"]
+        settings["fast_binning"] = 0
+        try:
+            self.model._initialise_approximator(engine=engine, closest_point=\
+                [self.theta[p] for p in self.model.grid_points.dtype.names])
+            self.model._create_convolution_functions(self.matched_channels,
+                self.data, self.parameters, engine=engine)
+        finally:
+            del settings["fast_binning"]
+
+        # Walkers with redshifts that the factory rounds together share one
+        # binning matrix.
+        z = self.parameters.index("z")
+        walkers = self._walkers()[:8]
+        walkers = np.vstack([walkers, walkers[0], walkers[0]])
+        walkers[-1, z] += 1e-9
+        redshifts = np.unique(np.round(walkers[:, z], 6)).size
+        self.assertLess(redshifts, 8)
+
+        factory = specutils.sample._BoxFactory.__call__
+        misses, hits = factory.cache_info().misses, factory.cache_info().hits
+        actual = self.model.batch_call(walkers, self.data, self.parameters,
+            engine=engine, matched_channels=self.matched_channels)[0]
+        self.assertEqual(factory.cache_info().misses - misses, redshifts)
+        self.assertEqual(factory.cache_info().hits - hits, 0)
+
+        for walker, fluxes in zip(walkers, actual):
+            expected = self.model(dict(zip(self.parameters, walker)),
+                self.data, engine=engine,
+                matched_channels=self.matched_channels)[0]
+            self.assertTrue(np.allclose(fluxes, expected, equal_nan=True))
+
+    def test_infer_vectorised(self):
+        # The sampler's log-probabilities are those of each walker.
+        engine = generate.SpectrumEngine()
+        np.random.seed(0)
+        theta, chains, ln_probability, acceptance_fractions, sampler, meta \
+            = self.model.infer(self.data, initial_proposal=dict(self.theta),
+                engine=engine, walkers=12, burn=5, sample=5, vectorised=True,
+                full_output=True, __show_progress_bar=False,
+                __keep_convolution_functions=True)
+
+        self.assertIsInstance(sampler.pool, inference.BatchPool)
+        self.assertEqual(chains.shape, (12, 10, len(self.parameters)))
+        expected = [inference.ln_probability(walker, self.parameters,
+            self.model, self.data, matched_channels=self.matched_channels,
+            engine=engine) for walker in chains[:, -1]]
+        self.assertTrue(np.allclose(ln_probability[:, -1], expected))
+
+
+class ProcessPoolTest(SyntheticInferenceTestCase):
+
+    def test_pickle_model(self):
+        model = pickle.loads(pickle.dumps(self.model, -1))
+        self.assertEqual(model._configuration, self.model._configuration)
+        self.assertEqual(list(model.parameters), list(self.model.parameters))
+        self.assertTrue(np.all(model.grid_points == self.model.grid_points))
+        self.assertTrue(np.all(model.wavelengths == self.model.wavelengths))
+        self.assertTrue(np.all(
+            model._intensities()[:] == self.model._intensities()[:]))
+
+        # The approximator is not pickled.
+        self.assertFalse(hasattr(model, "_engine"))
+
+    def test_process_pool(self):
+        walkers = self._walkers()
+        expected = np.array([inference.ln_probability(walker, self.parameters,
+            self.model, self.data, matched_channels=self.matched_channels) \
+                for walker in walkers])
+
+        approximator_kwargs = {"closest_point": \
+            [self.theta[p] for p in self.model.grid_points.dtype.names]}
+        for vectorised in (False, True):
+            pool = inference.ProcessPool(2, self.parameters, self.model,
+                self.data, approximator_kwargs, vectorised=vectorised,
+                matched_channels=self.matched_channels)
+            try:
+                actual = np.array(pool.map(None, walkers))
+            finally:
+                pool.close()
+                pool.join()
+
+            finite = np.isfinite(expected)
+            self.assertEqual(list(np.isfinite(actual)), list(finite))
+            self.assertTrue(np.allclose(actual[finite], expected[finite]))
+
+    def test_proposal_closest_point(self):
+        walkers = self._walkers()[:8]
+        names = self.model.grid_points.dtype.names
+        expected = [np.median(walkers[:, self.parameters.index(p)]) \
+            for p in names]
+        self.assertTrue(np.allclose(self.model._proposal_closest_point(
+            self.parameters, walkers), expected))
+
+        # Grid parameters that are not sampled take their fixed values, or
+        # the whole grid is used if they are not fixed.
+        index = self.parameters.index("feh")
+        parameters = self.parameters[:index] + self.parameters[index + 1:]
+        walkers = np.delete(walkers, index, axis=1)
+        self.assertIsNone(self.model._proposal_closest_point(parameters,
+            walkers))
+        self.assertIsNone(self.model._proposal_closest_point(parameters,
+            walkers, {"feh": None}))
+
+        closest_point = self.model._proposal_closest_point(parameters,
+            walkers, {"feh": -0.5})
+        self.assertTrue(np.allclose(closest_point, expected[:2] + [-0.5]))
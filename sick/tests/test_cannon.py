@@ -0,0 +1,436 @@
+# coding: utf-8
+
+""" Test Cannon model training """
+
+from __future__ import division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from sick.models import cannon
+from sick.tests import synthetic
+
+
+class TestCannonTraining(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        N_models, N_pixels = 200, 50
+
+        label_vector = [[(0, 1)], [(1, 1)], [(0, 2)], [(0, 1), (1, 1)]]
+        self.lv_array = cannon._build_label_vector_rows(label_vector,
+            random.uniform(-1, 1, size=(N_models, 2)))
+
+        coefficients = random.normal(0, 0.1,
+            size=(N_pixels, self.lv_array.shape[1]))
+        coefficients[:, 0] += 1
+        self.scatter = np.exp(random.uniform(-6, -3, N_pixels))
+        self.u_intensities = 1e-3 * np.ones((N_models, N_pixels))
+        self.intensities = np.dot(self.lv_array, coefficients.T) \
+            + random.normal(size=(N_models, N_pixels)) \
+                * np.sqrt(self.scatter**2 + self.u_intensities**2)
+
+    def _test_fit_pixels(self, u_intensities):
+        coefficients, scatter = cannon._fit_pixels(self.intensities,
+            u_intensities, self.lv_array)
+
+        for i in range(self.intensities.shape[1]):
+            expected_coefficients, expected_scatter = cannon._fit_pixel(
+                self.intensities[:, i], u_intensities[:, i], self.lv_array)
+
+            ln_likelihood = lambda s: cannon._pixel_scatter_ln_likelihood(
+                np.log(s), self.intensities[:, i], u_intensities[:, i],
+                self.lv_array)
+            self.assertGreaterEqual(ln_likelihood(scatter[i]) + 1e-6,
+                ln_likelihood(expected_scatter))
+            self.assertTrue(np.allclose(scatter[i], expected_scatter,
+                rtol=1e-3))
+            self.assertTrue(np.allclose(coefficients[i], expected_coefficients,
+                atol=1e-6))
+
+    def test_fit_pixels(self):
+        self._test_fit_pixels(self.u_intensities)
+
+    def test_fit_pixels_without_uncertainties(self):
+        self._test_fit_pixels(np.zeros(self.intensities.shape))
+
+    def test_singular(self):
+        # Duplicate terms in the label vector cannot be solved for.
+        coefficients, scatter = cannon._fit_pixels(self.intensities,
+            self.u_intensities, self.lv_array[:, [0, 1, 1]])
+        self.assertTrue(np.all(coefficients[scatter == 10e8] == 0))
+
+        # So do pixels without uncertainties.
+        lv_array = self.lv_array.copy()
+        lv_array[:, -1] = 0
+        coefficients, scatter = cannon._fit_pixels(self.intensities,
+            np.zeros(self.intensities.shape), lv_array)
+        self.assertTrue(np.all(coefficients == 0))
+        self.assertTrue(np.all(scatter == 10e8))
+
+    def test_train_block(self):
+        # Grid points and pixels are selected from the intensities of the grid.
+        intensities = np.vstack([self.intensities, np.ones(50)])
+        mask = np.ones(20, dtype=bool)
+        mask[5:10] = False
+        i, coefficients, scatter = cannon._train_block(intensities,
+            (3, 10, 30, mask), np.arange(self.intensities.shape[0]),
+            self.lv_array, None)
+
+        expected_coefficients, expected_scatter = cannon._fit_pixels(
+            self.intensities[:, 10:30][:, mask],
+            np.zeros((self.intensities.shape[0], mask.sum())), self.lv_array)
+
+        self.assertEqual(i, 3)
+        self.assertTrue(np.all(np.isnan(scatter[~mask])))
+        self.assertTrue(np.allclose(scatter[mask], expected_scatter))
+        self.assertTrue(np.allclose(coefficients[mask], expected_coefficients))
+
+        # The same block is read from pixel-major intensities.
+        i, pm_coefficients, pm_scatter = cannon._train_block(
+            np.ascontiguousarray(intensities.T), (3, 10, 30, mask),
+            np.arange(self.intensities.shape[0]), self.lv_array, None,
+            pixel_major=True)
+        self.assertEqual(i, 3)
+        self.assertTrue(np.allclose(pm_scatter, scatter, equal_nan=True))
+        self.assertTrue(np.allclose(pm_coefficients, coefficients,
+            equal_nan=True))
+
+
+class TestCannonLabels(unittest.TestCase):
+
+    label_vector = [[(0, 1)], [(1, 1)], [(0, 2)], [(0, 1), (1, 1)], [(1, 3)]]
+
+    def test_derivatives(self):
+        labels, h = np.array([0.3, -0.7]), 1e-6
+        derivatives, second_derivatives = \
+            cannon._build_label_vector_derivatives(self.label_vector, labels,
+                second=True)
+
+        for j in range(labels.size):
+            step = h * np.eye(labels.size)[j]
+            rows = cannon._build_label_vector_rows(self.label_vector,
+                np.array([labels + step, labels - step]))
+            self.assertTrue(np.allclose(derivatives[:, j],
+                (rows[0] - rows[1])/(2 * h), atol=1e-6))
+
+            d = [cannon._build_label_vector_derivatives(self.label_vector, l) \
+                for l in (labels + step, labels - step)]
+            self.assertTrue(np.allclose(second_derivatives[:, :, j],
+                (d[0] - d[1])/(2 * h), atol=1e-6))
+
+    def test_gauss_newton_labels(self):
+        random = np.random.RandomState(0)
+        coefficients = random.normal(size=(100, 1 + len(self.label_vector)))
+        expected_labels = np.array([0.3, -0.7])
+        flux = np.dot(coefficients, cannon._build_label_vector_rows(
+            self.label_vector, expected_labels)[0])
+
+        A, B = np.dot(coefficients.T, coefficients), np.dot(coefficients.T, flux)
+        labels, covariance = cannon._gauss_newton_labels(A, B,
+            self.label_vector, [0.2, -0.5])
+        self.assertTrue(np.allclose(labels, expected_labels, atol=1e-8))
+        self.assertEqual(covariance.shape, (2, 2))
+
+
+class TestCannonApproximator(unittest.TestCase):
+
+    label_vector = [[(0, 1)], [(1, 1)], [(0, 2)], [(0, 1), (1, 1)]]
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.coefficients = random.normal(size=(1000, 5))
+        self.offsets = np.array([0.1, -0.2])
+
+    def test_cache(self):
+        approximator = cannon._CannonApproximator(self.coefficients,
+            self.label_vector, self.offsets, cache_size=1, tolerance=3)
+        uncached = cannon._CannonApproximator(self.coefficients,
+            self.label_vector, self.offsets)
+
+        # Labels are rounded, and nearby labels share the same spectrum.
+        spectrum = approximator([0.3, -0.7])
+        self.assertTrue(np.allclose(spectrum, uncached([0.3, -0.7])))
+        self.assertTrue(np.all(approximator([0.3001, -0.6999]) == spectrum))
+        self.assertFalse(np.all(approximator([0.302, -0.7]) == spectrum))
+
+        info = approximator.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 2, 2))
+        self.assertAlmostEqual(info.hit_rate, 1/3.)
+        self.assertEqual(info.nbytes, 2 * 8 * self.coefficients.shape[0])
+
+        # Many points at once, and non-finite points, are not cached.
+        points = np.array([[0.3, -0.7], [0.1, 0.2]])
+        self.assertTrue(np.allclose(approximator(points), uncached(points)))
+        self.assertTrue(np.all(np.isnan(approximator([np.nan, 0.1]))))
+        self.assertEqual(approximator.cache_info().currsize, 2)
+
+    def test_eviction(self):
+        # Only as many spectra as fit in the memory limit are kept.
+        approximator = cannon._CannonApproximator(self.coefficients,
+            self.label_vector, self.offsets, cache_size=0.05)
+        self.assertEqual(approximator.cache_info().maxsize, 6)
+        for x in np.linspace(0, 1, 10):
+            approximator([x, x])
+        self.assertEqual(approximator.cache_info().currsize, 6)
+
+        approximator([0, 0])
+        approximator([1, 1])
+        info = approximator.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 11))
+
+    def test_disabled(self):
+        approximator = cannon._CannonApproximator(self.coefficients,
+            self.label_vector, self.offsets)
+        approximator([0.3, -0.7])
+        self.assertEqual(approximator.cache_info(), (0, 0, 0, 0, 0, 0))
+
+
+class TestCannonTrainingCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.folder, "test-cannon-checkpoint")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_resume(self):
+        lv_array = np.random.RandomState(0).uniform(size=(10, 3))
+        mask, grid_indices = np.ones(25, dtype=bool), np.arange(10)
+        shape = (25, 3, 10, True)
+
+        coefficients, scatter, done = cannon._training_checkpoint(self.prefix,
+            shape, lv_array, mask, grid_indices)
+        self.assertEqual(done.shape, (3, ))
+        self.assertFalse(np.any(done))
+
+        coefficients[:10], scatter[:10], done[0] = 1, 2, True
+        for array in (coefficients, scatter, done):
+            array.flush()
+        del coefficients, scatter, done
+
+        # The same set-up resumes from the finished blocks.
+        coefficients, scatter, done = cannon._training_checkpoint(self.prefix,
+            shape, lv_array, mask, grid_indices)
+        self.assertEqual(list(done), [True, False, False])
+        self.assertTrue(np.all(coefficients[:10] == 1))
+        self.assertTrue(np.all(scatter[:10] == 2))
+        self.assertTrue(np.all(np.isnan(scatter[10:])))
+        del coefficients, scatter, done
+
+        # A different set-up starts again.
+        mask[0] = False
+        coefficients, scatter, done = cannon._training_checkpoint(self.prefix,
+            shape, lv_array, mask, grid_indices)
+        self.assertFalse(np.any(done))
+        self.assertTrue(np.all(np.isnan(scatter)))
+        del coefficients, scatter, done
+
+        cannon._remove_training_checkpoint(self.prefix)
+        self.assertFalse(os.path.exists("{}-key".format(self.prefix)))
+
+
+class TestCannonModelTraining(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.model = cannon.CannonModel(synthetic.create_model(cls.folder,
+            num_pixels=500, configuration={
+                "model_grid": {
+                    "model_type": "cannon",
+                    "cannon_label_vector_description": "teff logg feh teff^2"
+                }
+            }))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def _train(self, **kwargs):
+        kwargs.setdefault("pixel_batch_size", 100)
+        return self.model.train_global(__progressbar=False, **kwargs)[:2]
+
+    def assertSameTraining(self, actual, expected):
+        for a, e in zip(actual, expected):
+            self.assertTrue(np.allclose(a, e, equal_nan=True))
+
+    def test_train_processes(self):
+        expected = self._train()
+        self.assertTrue(np.all(np.isfinite(expected[1])))
+        self.assertSameTraining(self._train(processes=2), expected)
+
+    def test_train_pixel_major(self):
+        self.assertSameTraining(self._train(pixel_major=True), self._train())
+
+    def test_train_resume(self):
+        expected = self._train()
+        checkpoint = os.path.join(self.folder, "checkpoint")
+
+        # Record the blocks that are trained, and interrupt the training once
+        # two blocks have finished.
+        train_block, trained = cannon._train_block, []
+        def recorded_train_block(*args, **kwargs):
+            if len(trained) == limit:
+                raise KeyboardInterrupt
+            trained.append(args[1][0])
+            return train_block(*args, **kwargs)
+
+        cannon._train_block = recorded_train_block
+        try:
+            limit = 2
+            self.assertRaises(KeyboardInterrupt, self._train,
+                checkpoint=checkpoint)
+
+            done = np.memmap("{}-done.memmap".format(checkpoint), dtype=bool,
+                mode="r")
+            self.assertEqual(list(done), [True, True, False, False, False])
+            del done
+
+            # Only the unfinished blocks are trained when resuming.
+            limit, trained[:] = None, []
+            actual = self._train(checkpoint=checkpoint)
+
+        finally:
+            cannon._train_block = train_block
+
+        self.assertEqual(trained, [2, 3, 4])
+        self.assertSameTraining(actual, expected)
+
+
+class TestPixelMajorIntensities(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.model = cannon.CannonModel(synthetic.create_model(self.folder,
+            num_pixels=100, configuration={
+                "model_grid": {
+                    "cannon_label_vector_description": "teff logg feh"
+                }
+            }))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_pixel_major_intensities(self):
+        intensities = np.array(self.model._intensities())
+        pixel_major = self.model._pixel_major_intensities()
+        self.assertIsInstance(pixel_major, np.memmap)
+        self.assertTrue(np.all(pixel_major == intensities.T))
+        self.assertIs(self.model._pixel_major_intensities(), pixel_major)
+
+        # The saved copy is loaded by another model.
+        key_path = os.path.join(self.folder, "synthetic-intensities-pixel-major"
+            ".key")
+        key = open(key_path).read()
+        model = cannon.CannonModel(self.model._filename)
+        self.assertTrue(np.all(model._pixel_major_intensities() == pixel_major))
+        self.assertEqual(open(key_path).read(), key)
+
+        # Changing the model intensities invalidates the saved copy.
+        memmap = np.memmap(self.model._configuration["model_grid"]\
+            ["intensities"], dtype="float32", mode="r+",
+            shape=intensities.shape)
+        memmap[0] += 1
+        memmap.flush()
+        del memmap, pixel_major
+
+        pixel_major = self.model._pixel_major_intensities()
+        self.assertNotEqual(open(key_path).read(), key)
+        self.assertTrue(np.all(pixel_major[:, 0] == intensities[0] + 1))
+        self.assertTrue(np.all(pixel_major[:, 1:] == intensities[1:].T))
+
+        # The saved copy is also used when a copy is not to be persisted.
+        self.assertIs(self.model._pixel_major_intensities(False), pixel_major)
+
+
+class TestCannonSolveLabels(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.model = cannon.CannonModel(synthetic.create_model(cls.folder,
+            num_pixels=500, configuration={
+                "model_grid": {
+                    "cannon_label_vector_description": \
+                        "teff logg feh teff^2 logg*feh"
+                }
+            }))
+        cls.model.train_global(__progressbar=False)
+        cls.truth = {"teff": 5321., "logg": 2.2, "feh": -0.4}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def _spectrum(self, labels):
+        labels = np.array([labels[name] for name in ("teff", "logg", "feh")])
+        row = cannon._build_label_vector_rows(self.model._cannon_label_vector,
+            labels - self.model._cannon_offsets)
+        return np.dot(self.model._cannon_coefficients, row.T).flatten()
+
+    def _chi_sq(self, labels, flux, variance):
+        return np.sum((flux - self._spectrum(labels))**2 \
+            / (self.model._cannon_scatter**2 + variance))
+
+    def assertLabelsEqual(self, actual, expected, **kwargs):
+        self.assertEqual(sorted(actual.keys()), sorted(expected.keys()))
+        for name, value in expected.items():
+            self.assertTrue(np.allclose(actual[name], value, **kwargs))
+
+    def test_offsets(self):
+        # The labels are solved for relative to the offsets.
+        self.assertTrue(np.all(np.abs(self.model._cannon_offsets) > 0.1))
+        labels = self.model._solve_labels(self._spectrum(self.truth))
+        self.assertLabelsEqual(labels, self.truth, rtol=1e-6)
+
+    def test_initial_labels(self):
+        flux = self._spectrum(self.truth)
+        initial_labels = {"teff": 5400., "logg": 2., "feh": -0.5}
+        labels = self.model._solve_labels(flux, initial_labels=initial_labels,
+            max_iterations=0)
+        self.assertLabelsEqual(labels, initial_labels)
+
+        labels = self.model._solve_labels(flux, initial_labels=initial_labels)
+        self.assertLabelsEqual(labels, self.truth, rtol=1e-6)
+
+        # Incomplete initial labels are ignored.
+        self.assertLabelsEqual(self.model._solve_labels(flux,
+            initial_labels={"teff": 5400.}, max_iterations=0),
+            self.model._solve_labels(flux, max_iterations=0))
+
+    def test_no_linear_terms(self):
+        N = self.model.wavelengths.size
+        trained_model = (np.random.RandomState(0).normal(size=(N, 4)),
+            np.ones(N), [[(0, 2)], [(1, 2)], [(2, 2)]], np.zeros(3), None)
+        self.assertRaises(ValueError, self.model._solve_labels, np.ones(N),
+            trained_model=trained_model)
+
+    def test_singular_covariance(self):
+        # Without any information about the labels, they cannot be improved
+        # and their covariance is infinite.
+        p0 = np.array([5000, 2.5, -0.5])
+        labels, covariance = cannon._gauss_newton_labels(np.zeros((4, 4)),
+            np.zeros(4), [[(0, 1)], [(1, 1)], [(2, 1)]], p0)
+        self.assertTrue(np.all(labels == p0))
+        self.assertEqual(covariance.shape, (3, 3))
+        self.assertTrue(np.all(np.isposinf(covariance)))
+
+    def test_curve_fit(self):
+        flux = self._spectrum(self.truth)
+        variance = (0.01 * np.ones(flux.size))**2
+        flux += np.random.RandomState(0).normal(0, 0.01, size=flux.size)
+
+        labels = self.model._solve_labels(flux, variance)
+        curve_fit_labels = self.model._solve_labels(flux, variance,
+            method="curve_fit")
+        self.assertLabelsEqual(labels, curve_fit_labels, rtol=1e-4)
+        chi_sq = self._chi_sq(labels, flux, variance)
+        curve_fit_chi_sq = self._chi_sq(curve_fit_labels, flux, variance)
+        self.assertTrue(np.allclose(chi_sq, curve_fit_chi_sq, rtol=1e-6))
+        self.assertLessEqual(chi_sq, curve_fit_chi_sq * (1 + 1e-9))
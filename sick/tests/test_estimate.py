@@ -0,0 +1,152 @@
+# coding: utf-8
+
+""" Test model parameter estimation """
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import sick.models as models
+from sick.tests import synthetic
+
+
+class EstimateTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.model = models.Model(synthetic.create_model(cls.folder))
+
+        # The true grid point is not in a coarse search of every 10th point.
+        cls.index = 123
+        cls.data = [synthetic.observe(list(cls.model.grid_points[cls.index]),
+            z=1e-4, continuum=(1.1, 0))]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def _grid_index(self, theta):
+        return np.where(np.all([self.model.grid_points[name] == theta[name] \
+            for name in self.model.grid_points.dtype.names], axis=0))[0][0]
+
+    def test_refine(self):
+        N = self.model.grid_points.size
+        full = self._grid_index(self.model.estimate(self.data,
+            num_model_comparisons=N))
+        self.assertEqual(full, self.index)
+
+        coarse = self._grid_index(self.model.estimate(self.data,
+            num_model_comparisons=N // 10))
+        self.assertNotEqual(self.index % 10, 0)
+        self.assertNotEqual(coarse, full)
+
+        refined = self._grid_index(self.model.estimate(self.data,
+            num_model_comparisons=N // 10, refine=True, refine_top_k=5,
+            refine_neighbours=10, refine_iterations=3))
+        self.assertEqual(refined, full)
+
+    def test_grid_neighbours(self):
+        neighbours = self.model._grid_neighbours([0, self.index], 7)
+        self.assertIn(0, neighbours)
+        self.assertIn(self.index, neighbours)
+        self.assertLessEqual(neighbours.size, 14)
+        self.assertTrue(np.all(np.diff(neighbours) > 0))
+
+    def test_chi_sq_grid(self):
+        indices = np.arange(self.model.grid_points.size)
+        intensities = self.model._intensities()
+        chi_sq = self.model._chi_sq_grid(self.data[0], indices, intensities,
+            1e-4, 1)
+        self.assertEqual(np.nanargmin(chi_sq), self.index)
+
+        # The block size only changes how many templates are read at once.
+        for block_size in (1, 7, 1000):
+            self.assertTrue(np.allclose(chi_sq, self.model._chi_sq_grid(
+                self.data[0], indices, intensities, 1e-4, 1,
+                block_size=block_size), equal_nan=True))
+
+    def test_chi_sq_grid_non_finite(self):
+        indices = np.arange(self.model.grid_points.size)
+        intensities = np.array(self.model._intensities())
+        intensities[self.index, 900:1000] = np.nan
+        intensities[0, :] = np.nan
+
+        # Non-finite template pixels are left out, not treated as zero flux.
+        for continuum_degree in (-1, 1):
+            chi_sq = self.model._chi_sq_grid(self.data[0], indices,
+                intensities, 1e-4, continuum_degree)
+            self.assertTrue(np.isnan(chi_sq[0]))
+            self.assertTrue(np.all(np.isfinite(chi_sq[1:])))
+            self.assertEqual(np.nanargmin(chi_sq), self.index)
+
+    def test_chisq_estimate(self):
+        self.model._configuration["settings"]["estimate_method"] = "chisq"
+        try:
+            theta = self.model.estimate(self.data,
+                num_model_comparisons=self.model.grid_points.size)
+        finally:
+            del self.model._configuration["settings"]["estimate_method"]
+        self.assertEqual(self._grid_index(theta), self.index)
+
+    def test_channel_intensities_cache(self):
+        self.model.__dict__.pop("_channel_intensities_cache", None)
+        self.model.estimate(self.data)
+        cache = self.model._channel_intensities_cache
+        self.assertEqual(len(cache), 1)
+        key, (wavelengths, intensities) = list(cache.items())[0]
+
+        # A second call reuses the cached arrays.
+        self.model.estimate(self.data)
+        self.assertEqual(list(cache.keys()), [key])
+        self.assertIs(cache[key][1], intensities)
+
+        # Changing the model mask invalidates them.
+        self.model._configuration["masks"] = {"model": [[5100, 5110]]}
+        try:
+            self.model.estimate(self.data)
+        finally:
+            del self.model._configuration["masks"]
+        masked_key = list(cache.keys())[-1]
+        self.assertNotEqual(masked_key, key)
+        self.assertLess(cache[masked_key][0].size, wavelengths.size)
+
+    def test_channel_intensities_cache_size(self):
+        settings = self.model._configuration["settings"]
+        self.model.__dict__.pop("_channel_intensities_cache", None)
+        intensities = self.model._channel_intensities("blue", 1)[1]
+
+        # The least recently used arrays are released to stay within budget.
+        settings["channel_intensities_cache_size"] = intensities.nbytes/1024.**2
+        try:
+            self.model._channel_intensities("blue", 2)
+            self.assertEqual([key[1] for key in \
+                self.model._channel_intensities_cache.keys()], [2])
+
+            settings["channel_intensities_cache_size"] = 0
+            self.model.__dict__.pop("_channel_intensities_cache", None)
+            self.model._channel_intensities("blue", 2)
+            self.assertEqual(len(self.model._channel_intensities_cache), 0)
+        finally:
+            del settings["channel_intensities_cache_size"]
+
+    def test_estimate_block_size(self):
+        settings = self.model._configuration["settings"]
+        settings["estimate_method"] = "chisq"
+        self.model.__dict__.pop("_channel_intensities_cache", None)
+        expected = self.model.estimate(self.data)
+
+        # The templates are read from the cached intensities in any blocks.
+        self.model._configuration["estimate"] = {"block_size": 3}
+        try:
+            actual = self.model.estimate(self.data)
+        finally:
+            del settings["estimate_method"]
+            del self.model._configuration["estimate"]
+        self.assertEqual(len(self.model._channel_intensities_cache), 1)
+        for parameter, value in expected.items():
+            self.assertAlmostEqual(actual[parameter], value)
@@ -0,0 +1,112 @@
+# coding: utf-8
+
+""" Test fitting many stars with a pool of workers """
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+import sick.models as models
+from sick.tests import synthetic
+
+
+class FitManyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.filename = synthetic.create_model(cls.folder, num_pixels=1000,
+            configuration={
+                "settings": { "ccf_bank": True },
+                "estimate": { "refine": True }
+            })
+        cls.stars = [[synthetic.observe(point, z=z, seed=seed)] \
+            for seed, (point, z) in enumerate([
+                ([5000, 2.5, -0.5], 1e-4),
+                ([5750, 1.5, -0.25], -2e-4),
+                ([4750, 3.5, -0.75], 0)])]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def test_fit_many(self):
+        model = models.Model(self.filename)
+        expected = [model._fit_one(i, star, "estimate", model.engine)[1] \
+            for i, star in enumerate(self.stars)]
+
+        # Each fit starts with empty caches that the workers then share.
+        for processes in (False, True):
+            model = models.Model(self.filename)
+            results = dict([(index, result) for index, result, elapsed \
+                in model.fit_many(self.stars, stage="estimate", workers=2,
+                    processes=processes)])
+
+            self.assertEqual(sorted(results.keys()), range(len(self.stars)))
+            for index, theta in enumerate(expected):
+                self.assertEqual(sorted(results[index].keys()),
+                    sorted(theta.keys()))
+                for parameter, value in theta.items():
+                    self.assertAlmostEqual(results[index][parameter], value)
+
+    def test_fit_one_failures(self):
+        model = models.Model(self.filename)
+        def fail(exception):
+            def estimate(*args, **kwargs):
+                raise exception
+            model.estimate = estimate
+
+        # Failed fits give no result, but interrupts are not caught.
+        fail(ValueError)
+        self.assertEqual([result for index, result, elapsed \
+            in model.fit_many(self.stars, stage="estimate")],
+            [None] * len(self.stars))
+
+        fail(KeyboardInterrupt)
+        self.assertRaises(KeyboardInterrupt, list,
+            model.fit_many(self.stars, stage="estimate"))
+
+
+class CannonFitManyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.filename = synthetic.create_model(cls.folder, num_pixels=500,
+            configuration={
+                "model_grid": {
+                    "model_type": "cannon",
+                    "cannon_label_vector_description": "teff logg feh teff^2"
+                },
+                "settings": { "grid_subset": 60 }
+            })
+        cls.stars = [[synthetic.observe(point, z=z, seed=seed)] \
+            for seed, (point, z) in enumerate([
+                ([5000, 2.5, -0.5], 1e-4),
+                ([5750, 1.5, -0.25], -2e-4),
+                ([4750, 3.5, -0.75], 0)])]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def test_fit_many(self):
+        model = models.Model(self.filename)
+        expected = [model._fit_one(i, star, "optimise", model.engine,
+            __progressbar=False)[1] for i, star in enumerate(self.stars)]
+
+        # Each thread trains a local Cannon model around its own star.
+        model = models.Model(self.filename)
+        results = dict([(index, result) for index, result, elapsed \
+            in model.fit_many(self.stars, stage="optimise", workers=3,
+                __progressbar=False)])
+
+        # The locally trained models are kept in the engines, not the model.
+        self.assertFalse(hasattr(model, "_cannon_coefficients"))
+        self.assertEqual(sorted(results.keys()), range(len(self.stars)))
+        for index, theta in enumerate(expected):
+            self.assertEqual(results[index].keys(), theta.keys())
+            for parameter, value in theta.items():
+                self.assertAlmostEqual(results[index][parameter], value)
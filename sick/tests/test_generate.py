@@ -0,0 +1,66 @@
+# coding: utf-8
+
+""" Test the spectrum engine used to generate model spectra """
+
+from __future__ import division, print_function
+
+import threading
+import unittest
+
+import numpy as np
+
+from sick.models import generate
+
+
+class TestSpectrumEngine(unittest.TestCase):
+
+    def test_approximator(self):
+        engine = generate.SpectrumEngine()
+        self.assertFalse(engine.initialised)
+        self.assertRaises(RuntimeError, engine.approximator)
+
+        wavelengths = np.linspace(5000, 5100, 11)
+        approximator = lambda *point: np.ones(wavelengths.size) * sum(point)
+        engine.set_approximator(wavelengths, approximator,
+            subset_bounds={ "teff": (5000, 6000) })
+
+        self.assertTrue(engine.initialised)
+        self.assertEqual(engine.approximator(), (wavelengths, approximator, 0))
+        self.assertEqual(engine.subset_bounds, { "teff": (5000, 6000) })
+
+        engine.reset()
+        self.assertFalse(engine.initialised)
+
+    def test_convolution_functions(self):
+        engine = generate.SpectrumEngine()
+        self.assertRaises(RuntimeError, engine.convolution_function, 0)
+
+        engine.set_approximator(np.arange(10), lambda *point: np.ones(10))
+        engine.set_convolution_functions([None, lambda w, f, *a: f])
+        self.assertIsNone(engine.convolution_function(0))
+        self.assertTrue(np.all(engine.convolution_function(1)(None, 3) == 3))
+
+        # The convolution functions are removed with the approximator.
+        engine.set_approximator(np.arange(5), lambda *point: np.ones(5))
+        self.assertRaises(RuntimeError, engine.convolution_function, 0)
+
+    def test_independent_engines(self):
+        engines = [generate.SpectrumEngine() for i in range(4)]
+        results = [None] * len(engines)
+
+        def fit(i):
+            engine = engines[i]
+            for j in range(100):
+                engine.set_approximator(np.arange(i + 1),
+                    lambda *point: np.ones(i + 1) * i)
+                wavelengths, approximator, variances = engine.approximator()
+                results[i] = (wavelengths.size, approximator()[0])
+
+        threads = [threading.Thread(target=fit, args=(i, )) \
+            for i in range(len(engines))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [(i + 1, i) for i in range(len(engines))])
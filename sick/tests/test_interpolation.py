@@ -0,0 +1,269 @@
+# coding: utf-8
+
+""" Test the interpolators used by the interpolation model """
+
+from __future__ import division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import sick.models as models
+from sick.models import (generate, interpolation)
+from sick.tests import synthetic
+
+
+def _multilinear_grid(shape=(4, 3, 5), num_pixels=20, seed=0):
+    """
+    Return a regular grid of points (in a random order) and intensities that
+    are multilinear in the grid parameters, so multilinear interpolation is
+    exact everywhere.
+    """
+
+    random = np.random.RandomState(seed)
+    axes = [np.sort(random.uniform(0, 10, size=n)) for n in shape]
+    grid_points = np.array([_.flatten() for _ in \
+        np.meshgrid(*axes, indexing="ij")]).T
+    grid_points = grid_points[random.permutation(grid_points.shape[0])]
+
+    coefficients = random.normal(size=(2**len(shape), num_pixels))
+    def intensities(points):
+        points = np.atleast_2d(points)
+        terms = np.array([np.prod(points**np.array(powers), axis=1) for powers \
+            in np.ndindex(*([2] * len(shape)))]).T
+        return np.dot(terms, coefficients)
+
+    return (grid_points, intensities(grid_points), intensities)
+
+
+class TestMultilinearInterpolator(unittest.TestCase):
+
+    def test_regular_grid(self):
+        grid_points, _, __ = _multilinear_grid()
+        axes, lookup = interpolation._regular_grid(grid_points)
+        self.assertEqual(lookup.shape, (4, 3, 5))
+        self.assertTrue(np.all(grid_points[lookup[1, 2, 3]] \
+            == [axes[0][1], axes[1][2], axes[2][3]]))
+
+        # Remove a point and it is no longer regular.
+        self.assertIsNone(interpolation._regular_grid(grid_points[1:]))
+
+    def test_interpolation(self):
+        grid_points, intensities, truth = _multilinear_grid()
+        interpolator = interpolation.MultilinearInterpolator(
+            *interpolation._regular_grid(grid_points), intensities=intensities)
+
+        random = np.random.RandomState(1)
+        lower, upper = grid_points.min(axis=0), grid_points.max(axis=0)
+        for point in random.uniform(lower, upper, size=(20, 3)):
+            self.assertTrue(np.allclose(interpolator(*point), truth(point)))
+
+        # Grid points and the edges of the grid.
+        for point in (grid_points[0], lower, upper):
+            self.assertTrue(np.allclose(interpolator(*point), truth(point)))
+
+        # Outside the grid.
+        self.assertTrue(np.all(np.isnan(interpolator(*(upper + 1)))))
+
+    def test_mask(self):
+        grid_points, intensities, truth = _multilinear_grid()
+        mask = np.ones(intensities.shape[1], dtype=bool)
+        mask[5:8] = False
+        interpolator = interpolation.MultilinearInterpolator(
+            *interpolation._regular_grid(grid_points), intensities=intensities,
+            mask=mask)
+
+        flux = interpolator(*grid_points.mean(axis=0))
+        self.assertTrue(np.all(np.isnan(flux[~mask])))
+        self.assertTrue(np.all(np.isfinite(flux[mask])))
+
+    def test_pixels(self):
+        grid_points, intensities, truth = _multilinear_grid()
+        axes, lookup = interpolation._regular_grid(grid_points)
+        point = grid_points.mean(axis=0)
+
+        for pixels in (np.arange(3, 12), np.array([0, 1, 2, 10, 11, 19])):
+            interpolator = interpolation.MultilinearInterpolator(axes, lookup,
+                intensities=intensities, pixels=pixels)
+            self.assertTrue(np.allclose(interpolator(*point),
+                truth(point)[0, pixels]))
+
+    def test_cache(self):
+        grid_points, intensities, truth = _multilinear_grid()
+        interpolator = interpolation.MultilinearInterpolator(
+            *interpolation._regular_grid(grid_points), intensities=intensities,
+            cache_size=8)
+
+        point = grid_points.mean(axis=0)
+        interpolator(*point)
+        self.assertEqual(interpolator.cache_info().misses, 8)
+        self.assertEqual(interpolator.cache_info().currsize, 8)
+
+        interpolator(*point)
+        self.assertEqual(interpolator.cache_info().hits, 8)
+
+        # The cache size is bounded.
+        interpolator(*grid_points.min(axis=0))
+        self.assertEqual(interpolator.cache_info().currsize, 8)
+
+    def test_batch(self):
+        grid_points, intensities, truth = _multilinear_grid()
+        interpolator = interpolation.MultilinearInterpolator(
+            *interpolation._regular_grid(grid_points), intensities=intensities)
+
+        random = np.random.RandomState(2)
+        lower, upper = grid_points.min(axis=0), grid_points.max(axis=0)
+        points = np.vstack([random.uniform(lower, upper, size=(30, 3)),
+            [upper + 1, lower]])
+        batch = interpolator.batch(points)
+
+        self.assertEqual(batch.shape, (32, intensities.shape[1]))
+        self.assertTrue(np.allclose(batch[:-2], truth(points[:-2])))
+        self.assertTrue(np.all(np.isnan(batch[-2])))
+        self.assertTrue(np.allclose(batch[-1], interpolator(*lower)))
+
+
+
+class TestDelaunayInterpolator(unittest.TestCase):
+
+    def test_interpolation(self):
+        from scipy.interpolate import LinearNDInterpolator
+
+        random = np.random.RandomState(0)
+        points = random.uniform(0, 10, size=(40, 3))
+        intensities = random.normal(size=(50, 20))
+        indices = random.permutation(50)[:40]
+
+        interpolator = interpolation.DelaunayInterpolator(points, indices,
+            intensities, rescale=False)
+        expected = LinearNDInterpolator(points, intensities[indices])
+
+        for point in random.uniform(0, 10, size=(20, 3)):
+            if np.all(np.isnan(expected(*point))):
+                self.assertTrue(np.all(np.isnan(interpolator(*point))))
+            else:
+                self.assertTrue(np.allclose(interpolator(*point),
+                    expected(*point).flatten(), atol=1e-6))
+
+        # Only the vertices of one simplex were read for each point.
+        self.assertTrue(interpolator.cache_info().misses <= 4 * 20)
+
+    def test_batch(self):
+        random = np.random.RandomState(0)
+        points = random.uniform(0, 10, size=(40, 3))
+        intensities = random.normal(size=(40, 20))
+        interpolator = interpolation.DelaunayInterpolator(points,
+            np.arange(40), intensities)
+
+        queries = random.uniform(0, 10, size=(50, 3))
+        batch = interpolator.batch(queries)
+        for query, flux in zip(queries, batch):
+            expected = interpolator(*query)
+            self.assertEqual(np.all(np.isnan(flux)), np.all(np.isnan(expected)))
+            if np.all(np.isfinite(expected)):
+                self.assertTrue(np.allclose(flux, expected))
+
+
+
+class TestInterpolationModel(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.model = models.Model(synthetic.create_model(cls.folder,
+            num_pixels=200))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def _initialise(self, closest_point=None, **settings):
+        self.model._configuration["settings"].update(settings)
+        engine = generate.SpectrumEngine()
+        try:
+            subset_bounds = self.model._initialise_approximator(
+                closest_point=closest_point, engine=engine)
+        finally:
+            for key in settings:
+                del self.model._configuration["settings"][key]
+        return (engine.approximator()[1], subset_bounds)
+
+    def test_regular_grid_subset(self):
+        names = self.model.grid_points.dtype.names
+        interpolator, subset_bounds = self._initialise([5250, 2.5, -0.5],
+            grid_subset=20)
+        self.assertIsInstance(interpolator,
+            interpolation.MultilinearInterpolator)
+
+        # The regular grid only covers the bounding box of the grid subset.
+        self.assertLess(interpolator.lookup.size, self.model.grid_points.size)
+        for name, axis in zip(names, interpolator.axes):
+            self.assertEqual((axis[0], axis[-1]), subset_bounds[name])
+
+        intensities = self.model._intensities()
+        for index in np.where(np.all([(self.model.grid_points[name] >= lower) \
+            * (upper >= self.model.grid_points[name]) \
+            for name, (lower, upper) in subset_bounds.items()], axis=0))[0]:
+            self.assertTrue(np.allclose(
+                interpolator(*self.model.grid_points[index]),
+                intensities[index]))
+
+        # Points outside the subset are not interpolated.
+        self.assertTrue(np.all(np.isnan(interpolator(4500, 2.5, -0.5))))
+
+        # Without a closest point the whole grid is used.
+        interpolator, subset_bounds = self._initialise()
+        self.assertEqual(interpolator.lookup.size, self.model.grid_points.size)
+        self.assertEqual(subset_bounds["teff"], (4500, 6000))
+
+    def test_triangulation_cache(self):
+        interpolation._triangulations.clear()
+        grid_points = self.model._scaled_grid_points()[0]
+        subsets = [np.sort(self.model._nearest_grid_indices(point, 30)) \
+            for point in self.model.grid_points[::25][:9].tolist()]
+
+        # The second call for the same subset returns the cached object.
+        triangulation = self.model._triangulation(grid_points, subsets[0])
+        self.assertIs(self.model._triangulation(grid_points, subsets[0]),
+            triangulation)
+
+        # A ninth subset evicts the least recently used triangulation.
+        for subset in subsets[1:]:
+            self.model._triangulation(grid_points, subset)
+        self.assertEqual(len(interpolation._triangulations),
+            interpolation._MAX_TRIANGULATIONS)
+        self.assertIsNot(self.model._triangulation(grid_points, subsets[0]),
+            triangulation)
+        interpolation._triangulations.clear()
+
+    def test_persist_triangulation(self):
+        interpolation._triangulations.clear()
+        grid_points = self.model._scaled_grid_points()[0]
+        indices = np.sort(self.model._nearest_grid_indices([5250, 2.5, -0.5],
+            30))
+
+        settings = self.model._configuration["settings"]
+        settings["persist_triangulation"] = True
+        spatial = interpolation.spatial
+        try:
+            triangulation = self.model._triangulation(grid_points, indices)
+            paths = [path for path in os.listdir(self.folder) \
+                if "-delaunay-" in path]
+            self.assertEqual(len(paths), 1)
+
+            # The saved triangulation is loaded instead of being computed.
+            interpolation._triangulations.clear()
+            interpolation.spatial = None
+            loaded = self.model._triangulation(grid_points, indices)
+
+        finally:
+            interpolation.spatial = spatial
+            del settings["persist_triangulation"]
+            interpolation._triangulations.clear()
+
+        self.assertIsNot(loaded, triangulation)
+        self.assertTrue(np.all(loaded.simplices == triangulation.simplices))
+        os.unlink(os.path.join(self.folder, paths[0]))
@@ -5,6 +5,8 @@
 from __future__ import print_function
 
 import os
+import shutil
+import tempfile
 import numpy as np
 
 import unittest
@@ -88,3 +90,163 @@ class TestSpectrum1D(unittest.TestCase):
     def runTest(self):
         pass
         
+
+
+class TestResample(unittest.TestCase):
+
+    def assertSameMatrix(self, old_wavelengths, new_wavelengths):
+        expected = specutils.sample._slow_resample(old_wavelengths,
+            new_wavelengths).toarray()
+        actual = specutils.sample.resample(old_wavelengths,
+            new_wavelengths).toarray()
+        self.assertIsNone(np.testing.assert_allclose(actual, expected,
+            atol=1e-12))
+
+    def test_resample_downsampling(self):
+        self.assertSameMatrix(np.linspace(4000, 5000, 3000),
+            np.linspace(4100, 4900, 700))
+
+    def test_resample_upsampling(self):
+        self.assertSameMatrix(np.linspace(4000, 5000, 3000),
+            np.linspace(4100, 4200, 2000))
+
+    def test_resample_with_fake_pixels(self):
+        # Pixels outside the old wavelength range are 'fake' (NaN) pixels.
+        self.assertSameMatrix(np.linspace(4000, 5000, 3000).astype("float32"),
+            np.linspace(3900, 5100, 900))
+
+    def test_resample_non_uniform(self):
+        old_wavelengths = np.sort(np.random.uniform(4000, 5000, size=1000))
+        new_wavelengths = np.sort(np.random.uniform(3990, 5010, size=400))
+        self.assertSameMatrix(old_wavelengths, new_wavelengths)
+
+    def runTest(self):
+        pass
+
+
+class TestBoxFactory(unittest.TestCase):
+
+    def test_box_factory_matches_resample(self):
+        model_wavelengths = np.linspace(4000, 5000, 3000)
+        observed_wavelengths = np.linspace(4100, 4900, 700)
+        factory = specutils.sample._BoxFactory(observed_wavelengths,
+            model_wavelengths)
+
+        for z in (0, 1e-4, -3.3e-4, 0.01):
+            expected = specutils.sample._slow_resample(model_wavelengths,
+                observed_wavelengths * (1 + z)).toarray()
+            self.assertIsNone(np.testing.assert_allclose(
+                factory(z).toarray(), expected, atol=1e-12))
+
+    def runTest(self):
+        pass
+
+
+def _toy_ccf_data(N_templates=20, z=3e-4):
+
+    np.random.seed(42)
+    model_wavelengths = np.linspace(5000, 5500, 4000)
+    centers = np.random.uniform(5000, 5500, size=80)
+    depths = np.random.uniform(0.1, 0.8, size=80)
+
+    def spectrum(wavelengths, scale):
+        flux = np.ones_like(wavelengths)
+        for center, depth in zip(centers, depths):
+            flux -= scale * depth \
+                * np.exp(-0.5 * ((wavelengths - center)/0.3)**2)
+        return flux
+
+    templates = np.array([spectrum(model_wavelengths, scale) \
+        for scale in np.linspace(0.3, 1.5, N_templates)])
+    disp = np.linspace(5050, 5450, 1501)
+    observed = specutils.Spectrum1D(disp, spectrum(disp/(1 + z), 0.9)
+        + np.random.normal(0, 0.01, size=disp.size), 1e-4 * np.ones(disp.size))
+    return (observed, model_wavelengths, templates)
+
+
+class TestCrossCorrelate(unittest.TestCase):
+
+    def test_ccf_batch_sizes(self):
+        observed, model_wavelengths, templates = _toy_ccf_data()
+        expected = observed.cross_correlate((model_wavelengths, templates),
+            batch_size=1)
+        for batch_size in (3, 256):
+            actual = observed.cross_correlate((model_wavelengths, templates),
+                batch_size=batch_size)
+            for a, e in zip(actual, expected):
+                self.assertIsNone(np.testing.assert_allclose(a, e))
+
+    def test_ccf_padding(self):
+        observed, model_wavelengths, templates = _toy_ccf_data()
+        observed = specutils.Spectrum1D(observed.disp[:1487],
+            observed.flux[:1487], observed.variance[:1487])
+        v, v_err, R = observed.cross_correlate((model_wavelengths, templates),
+            pad=False)
+        v_pad, v_err_pad, R_pad = observed.cross_correlate(
+            (model_wavelengths, templates), pad=True)
+        self.assertEqual(np.nanargmax(R), np.nanargmax(R_pad))
+        self.assertAlmostEqual(v[np.nanargmax(R)], v_pad[np.nanargmax(R)],
+            delta=1)
+
+    def test_ccf_recovers_velocity(self):
+        observed, model_wavelengths, templates = _toy_ccf_data()
+        v, v_err, R = observed.cross_correlate((model_wavelengths, templates))
+        self.assertAlmostEqual(v[np.nanargmax(R)], 3e-4 * 299792.458,
+            delta=10)
+
+    def test_ccf_log_rebin_recovers_velocity(self):
+        observed, model_wavelengths, templates = _toy_ccf_data()
+        v, v_err, R = observed.cross_correlate((model_wavelengths, templates),
+            rebin="log")
+        self.assertEqual(v.size, templates.shape[0])
+        self.assertAlmostEqual(v[np.nanargmax(R)], 3e-4 * 299792.458,
+            delta=10)
+
+    def test_ccf_log_rebin_with_bank(self):
+        observed, model_wavelengths, templates = _toy_ccf_data()
+        bank = specutils.ccf.CCFBank.build(model_wavelengths, templates)
+        expected = bank.cross_correlate(observed)
+
+        # A prebuilt bank is used instead of building one from the templates.
+        for actual in (observed.cross_correlate(bank),
+            specutils.ccf.cross_correlate(observed, None, None, rebin="log",
+                bank=bank)):
+            for a, e in zip(actual, expected):
+                self.assertIsNone(np.testing.assert_allclose(a, e))
+
+        self.assertRaises(ValueError, observed.cross_correlate, bank,
+            wavelength_range=(5100, 5400))
+
+    def runTest(self):
+        pass
+
+
+class TestCCFBank(unittest.TestCase):
+
+    def test_ccf_bank_recovers_velocity(self):
+        observed, model_wavelengths, templates = _toy_ccf_data()
+        bank = specutils.ccf.CCFBank.build(model_wavelengths, templates)
+        v, v_err, R = bank.cross_correlate(observed)
+        self.assertEqual(v.size, templates.shape[0])
+        self.assertAlmostEqual(v[np.nanargmax(R)], 3e-4 * 299792.458,
+            delta=10)
+
+    def test_ccf_bank_save_load(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        prefix = os.path.join(folder, "test-bank")
+
+        observed, model_wavelengths, templates = _toy_ccf_data()
+        bank = specutils.ccf.CCFBank.build(model_wavelengths, templates,
+            prefix=prefix, meta={"channel": "blue"})
+        loaded = specutils.ccf.CCFBank.load(prefix)
+        self.assertEqual(loaded.meta["channel"], "blue")
+
+        indices = slice(None, None, 2)
+        expected = bank.cross_correlate(observed, indices=indices)
+        actual = loaded.cross_correlate(observed, indices=indices)
+        for a, e in zip(actual, expected):
+            self.assertIsNone(np.testing.assert_allclose(a, e))
+
+    def runTest(self):
+        pass
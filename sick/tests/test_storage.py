@@ -0,0 +1,125 @@
+# coding: utf-8
+
+""" Test the storage formats for model intensities """
+
+from __future__ import division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from sick.models import storage
+
+
+class TestChunkedIntensities(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test-intensities.chunks")
+        random = np.random.RandomState(0)
+        self.channel_sizes = [50, 30, 41]
+        self.intensities = random.uniform(0, 1,
+            size=(23, sum(self.channel_sizes))).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, **kwargs):
+        writer = storage.create_intensities(self.filename,
+            self.intensities.shape, self.channel_sizes, format="chunked",
+            **kwargs)
+        for i, row in enumerate(self.intensities):
+            writer[i] = row
+        writer.flush()
+        return storage.load_intensities(self.filename,
+            self.intensities.shape, format="chunked")
+
+    def test_round_trip(self):
+        for kwds in ({}, { "compression": "zlib" }, { "block_size": 1 },
+            { "block_size": 100, "compression": "zlib" }):
+            intensities = self.write(**kwds)
+            self.assertEqual(intensities.shape, self.intensities.shape)
+            self.assertTrue(np.all(intensities[:] == self.intensities))
+
+    def test_float16(self):
+        intensities = self.write(dtype="float16", compression="zlib")
+        self.assertTrue(np.allclose(intensities[:], self.intensities,
+            rtol=1e-3, atol=0))
+
+    def test_indexing(self):
+        intensities = self.write(block_size=5)
+        mask = np.zeros(self.intensities.shape[1], dtype=bool)
+        mask[10:90:3] = True
+
+        for key in (3, -1, slice(2, 17), slice(None, None, 4),
+            np.array([0, 7, 22, 8]), (4, slice(45, 60)),
+            (slice(None, None, 2), slice(20, 100)),
+            (slice(3, 9), 55)):
+            self.assertTrue(np.all(intensities[key] == self.intensities[key]))
+            self.assertEqual(intensities[key].shape,
+                self.intensities[key].shape)
+
+        # Arrays of grid points and pixels are indexed independently.
+        rows = np.array([1, 19])
+        self.assertTrue(np.all(intensities[rows, mask] \
+            == self.intensities[np.ix_(rows, mask)]))
+
+    def test_fancy_indexing(self):
+        rows = np.array([22, 3, 0, 17, 4, 3, 11])
+        cols = np.array([100, 2, 60, 49, 50])
+        for kwds in ({}, { "compression": "zlib" }):
+            intensities = self.write(block_size=5, **kwds)
+
+            # Every chunk is read once, however the rows are ordered.
+            reads = []
+            read_chunk = intensities._read_chunk
+            def counted_read_chunk(fp, block, channel, rows=None):
+                reads.append((block, channel))
+                return read_chunk(fp, block, channel, rows)
+            intensities._read_chunk = counted_read_chunk
+
+            for key in ((rows, slice(None)), (slice(None, None, 7), cols),
+                (rows[::-1], cols)):
+                del reads[:]
+                self.assertTrue(np.all(intensities[key] \
+                    == self.intensities[np.ix_(
+                        np.arange(23)[key[0]], np.arange(121)[key[1]])]))
+                self.assertEqual(len(reads), len(set(reads)))
+
+        # Uncompressed chunks are only partly read, and not cached.
+        intensities = self.write(block_size=5)
+        self.assertTrue(np.all(intensities[[11, 13]] \
+            == self.intensities[[11, 13]]))
+        self.assertEqual(len(intensities._cache), 0)
+
+    def test_write_in_order(self):
+        writer = storage.ChunkedIntensitiesWriter(self.filename,
+            self.intensities.shape, self.channel_sizes, block_size=5)
+        writer[10:12, 5:] = self.intensities[10:12, 5:]
+        with self.assertRaises(ValueError):
+            writer[0] = self.intensities[0]
+        writer.flush()
+
+        intensities = storage.ChunkedIntensities(self.filename)
+        self.assertTrue(np.all(intensities[:10] == 0))
+        self.assertTrue(np.all(
+            intensities[10:12, 5:] == self.intensities[10:12, 5:]))
+        self.assertTrue(np.all(intensities[10:12, :5] == 0))
+
+    def test_not_chunked(self):
+        with open(self.filename, "wb") as fp:
+            fp.write(self.intensities.tobytes())
+        self.assertRaises(IOError, storage.ChunkedIntensities, self.filename)
+
+    def test_transpose(self):
+        intensities = self.write(block_size=4)
+        for filename in (None,
+            os.path.join(self.folder, "test-intensities-pixel-major.memmap")):
+            transposed = storage.transpose_intensities(intensities, filename,
+                block_size=5)
+            self.assertEqual(transposed.shape, self.intensities.T.shape)
+            self.assertTrue(np.all(transposed == self.intensities.T))
+            del transposed
@@ -45,4 +45,18 @@ def test_human_readable_digit():
 def test_wrapper():
     func = lambda x, y, z: x**2 + y**3 - z
     func_wrap = utils.wrapper(func, [5, 3])
-    assert func_wrap(1.23) == 123.5129
\ No newline at end of file
+    assert func_wrap(1.23) == 123.5129
+
+
+def test_lru_cache_tolerance():
+    calls = []
+    @utils.lru_cache(maxsize=10, tol=2)
+    def func(x):
+        calls.append(x)
+        return x
+
+    assert func(1.234) == 1.23
+    assert func(1.231) == 1.23
+    assert func(1.239) == 1.24
+    assert calls == [1.23, 1.24]
+    assert func.cache_info().hits == 1
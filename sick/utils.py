@@ -105,6 +105,10 @@ def lru_cache(maxsize=100, typed=False, **kwargs):
 
     Arguments to the cached function must be hashable.
 
+    If *tol* is given, float arguments are rounded to *tol* decimal places (or
+    to the corresponding entry of *tol*, if it is a list) before the function
+    is called, and calls that round to the same arguments share a cache entry.
+
     View the cache statistics named tuple (hits, misses, maxsize, currsize) with
     f.cache_info().  Clear the cache and statistics with f.cache_clear().
     Access the underlying function with f.__wrapped__.
@@ -151,12 +155,12 @@ def lru_cache(maxsize=100, typed=False, **kwargs):
 
             def wrapper(*args, **kwds):
                 # simple caching without ordering or size limit
-                key = make_key(args, kwds, typed)
+                _args, _kwds = rounded_args(*args, **kwds)
+                key = make_key(_args, _kwds, typed)
                 result = cache_get(key, root)   # root used here as a unique not-found sentinel
                 if result is not root:
                     stats[HITS] += 1
                     return result
-                _args, _kwds = rounded_args(*args, **kwds)
                 result = user_function(*_args, **_kwds)
                 cache[key] = result
                 stats[MISSES] += 1
@@ -166,7 +170,8 @@ def lru_cache(maxsize=100, typed=False, **kwargs):
 
             def wrapper(*args, **kwds):
                 # size limited caching that tracks accesses by recency
-                key = make_key(args, kwds, typed) if kwds or typed else args
+                _args, _kwds = rounded_args(*args, **kwds)
+                key = make_key(_args, _kwds, typed) if _kwds or typed else _args
                 with lock:
                     link = cache_get(key)
                     if link is not None:
@@ -181,7 +186,6 @@ def lru_cache(maxsize=100, typed=False, **kwargs):
                         link[NEXT] = root
                         stats[HITS] += 1
                         return result
-                _args, _kwds = rounded_args(*args, **kwds)
                 result = user_function(*_args, **_kwds)
                 with lock:
                     root, = nonlocal_root